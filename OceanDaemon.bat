@@ -0,0 +1,2 @@
+@echo off
+C:\Users\OCEANHR_User\.conda\envs\OceanHR\python.exe C:\Users\OCEANHR_User\Spectrometer\OOSpec_Control\main.py --daemon
\ No newline at end of file
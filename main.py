@@ -1,19 +1,51 @@
 import os
 import sys
-import psutil
-import numpy as np
 import time
-import matplotlib.pyplot as plt
 import json
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from src.com.spec import OceanHR
+# Resident acquisition daemon (python main.py --daemon), only reachable locally
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 12346
+
+def forward_shot(shot_number, num: int=10, t_int: float=7200, timeout: float=0.2, **kwargs):
+    """
+    Ask the resident daemon to measure and save the shot.
+
+    Parameters:
+    - shot_number: Name of the shot file (without extension).
+    - num: Number of frames to measure.
+    - t_int: Integration time in us.
+    - timeout: Seconds to wait for the daemon to accept the connection.
+
+    Returns:
+    - filename: Path of the saved shot, or None if no daemon is running.
+    """
+    from src.server.client import OHRClient
+    from src.server import protocol
+
+    try:
+        client = OHRClient(DAEMON_HOST, DAEMON_PORT, timeout=timeout)
+    except OSError:
+        return None
+    client.settimeout(None)
+    with client:
+        # WAIT: the daemon replies once the shot is written, not just queued
+        replies = client.send_commands(f'PREP {int(t_int)}', f'TRIG {int(num)}', f'SAVE {shot_number} WAIT')
+    for status, body in replies:
+        if status != protocol.STATUS_OK:
+            raise RuntimeError(f'Daemon failed with status {status}: {body}')
+    return replies[-1][1]
+
+def run_daemon(**kwargs):
+    from src.server.server import OHRServer
+
+    OHRS = OHRServer(PORT=DAEMON_PORT, HOST=DAEMON_HOST, **kwargs)
+    OHRS.run()
 
-# p = psutil.Process(os.getpid())
-# p.cpu_affinity([0])
 def manual_spec(num: int=10, t_int: float=7200, plot=False, **kwargs):
-
+    from src.com.spec import OceanHR
 
     # Load the class that detects the spectrometers and sets their integration time 
     OHR = OceanHR(t_int=t_int)
@@ -28,6 +60,7 @@ def manual_spec(num: int=10, t_int: float=7200, plot=False, **kwargs):
 
     wavelengths = OHR.devs[0].get_wavelengths()
     if plot:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         for i in range(num):
             plt.plot(wavelengths, measurement[2][i])
@@ -36,8 +69,8 @@ def manual_spec(num: int=10, t_int: float=7200, plot=False, **kwargs):
     
     data = {
         'wave': wavelengths,
-        'spectra': measurement,
-        'time': t_array,
+        'waves': {id: dev.get_wavelengths() for id, dev in zip(OHR.ids, OHR.devs)},
+        **measurement.to_dict(),
     }
     return data
 
@@ -45,6 +78,13 @@ if __name__=="__main__":
     path_spectrometer = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     path_shots = os.path.join(path_spectrometer, 'shots')
 
+    if '--daemon' in sys.argv:
+        # e.g. --daemon --cores=2,3 keeps the acquisition thread on cores 2 and 3,
+        # --index adds every saved shot to the feature index
+        cores = [a.split('=')[1] for a in sys.argv if a.startswith('--cores=')]
+        cores = [int(c) for c in cores[0].split(',')] if cores else None
+        run_daemon(cores=cores, priority=True, index='--index' in sys.argv)
+
     arguments = {}
     match len(sys.argv):
         case 1:
@@ -59,6 +99,11 @@ if __name__=="__main__":
             arguments['num'] = int(sys.argv[2])
             arguments['t_int'] = int(sys.argv[3])
     
+    filename = forward_shot(**arguments)
+    if filename is not None:
+        print(f'Saved by the acquisition daemon in {filename}')
+        sys.exit(0)
+
     data = manual_spec(**arguments)
     filename = os.path.join(path_shots, f'{arguments["shot_number"]}.json')
     print(f'Saving in {filename}...')
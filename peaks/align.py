@@ -0,0 +1,175 @@
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.check import device_time
+from plots.aniplot import load_shot
+from src import tracing
+
+
+def device_streams(data, devices=None):
+    """
+    Timestamps and spectra of every device of a shot, separated.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - devices: Device keys to keep; all of data['spectra'] if None.
+
+    Returns:
+    - streams: Dictionary device -> (time (frames,), spectra (frames, pixels)),
+      sorted by time.
+    """
+    streams = {}
+    for device in data['spectra'] if devices is None else devices:
+        time_array = device_time(data, device)
+        spectra = np.asarray(data['spectra'][device], dtype=float)[:len(time_array)]
+        time_array = time_array[:len(spectra)]
+        if np.any(np.diff(time_array) < 0):
+            order = np.argsort(time_array, kind='stable')
+            time_array, spectra = time_array[order], spectra[order]
+        streams[device] = (time_array, spectra)
+    return streams
+
+
+def common_timebase(times, step: float=None, span: str='overlap'):
+    """
+    Uniform timebase for several devices.
+
+    Parameters:
+    - times: Dictionary device -> timestamps.
+    - step: Frame period of the timebase in s; the period of the slowest
+      device (median interval) if None, so every frame is a new readout
+      of every device.
+    - span: 'overlap' covers only the time all devices were acquiring,
+      'union' from the first to the last timestamp of any device.
+
+    Returns:
+    - grid: Timestamps of the timebase.
+    """
+    periods = [np.median(np.diff(t)) for t in times.values() if len(t) > 1]
+    if step is None:
+        step = max(periods) if periods else 1.0
+    starts = [t[0] for t in times.values() if len(t)]
+    stops = [t[-1] for t in times.values() if len(t)]
+    if span == 'overlap':
+        t_start, t_stop = max(starts), min(stops)
+    elif span == 'union':
+        t_start, t_stop = min(starts), max(stops)
+    else:
+        raise ValueError(f'Unknown span {span}')
+    if t_stop < t_start:
+        raise ValueError('The devices were never acquiring at the same time')
+    return t_start + step * np.arange(int(np.floor((t_stop - t_start) / step + 1e-9)) + 1)
+
+
+def resample_frames(time_array, spectra, grid, method: str='linear'):
+    """
+    Frames of one device at the timestamps of grid.
+
+    Parameters:
+    - time_array: Sorted timestamps of the frames.
+    - spectra: (frames, pixels) array.
+    - grid: Timestamps wanted.
+    - method: 'linear' interpolates between the two nearest frames,
+      'nearest' takes the closest frame as is.
+
+    Returns:
+    - resampled: (grid, pixels) array. Outside the device time range the
+      first or last frame is held.
+    - inside: (grid,) bool array, False where the frame was held.
+    """
+    n = len(time_array)
+    inside = (grid >= time_array[0]) & (grid <= time_array[-1])
+    if n == 1:
+        return np.repeat(spectra, len(grid), axis=0), inside
+    right = np.clip(np.searchsorted(time_array, grid, side='right'), 1, n - 1)
+    left = right - 1
+    interval = time_array[right] - time_array[left]
+    fraction = np.clip((grid - time_array[left]) / np.where(interval > 0, interval, 1), 0, 1)
+    if method == 'nearest':
+        return spectra[np.where(fraction < 0.5, left, right)], inside
+    if method != 'linear':
+        raise ValueError(f'Unknown method {method}')
+    resampled = spectra[left] * (1 - fraction)[:, None]
+    resampled += spectra[right] * fraction[:, None]
+    return resampled, inside
+
+
+@tracing.traced('align_shot')
+def align_shot(data, grid=None, step: float=None, span: str='overlap', method: str='linear',
+               devices=None):
+    """
+    Spectra of all devices on one common timebase.
+
+    The shot keeps its layout, so the result can be passed to stitch_shot,
+    line_traces or animate_spectra instead of the shot itself: every
+    device has the same timestamps in 'times' and 'time', and its spectra
+    are views of the synchronized cube.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - grid: Timestamps of the timebase; common_timebase(step, span) if None.
+    - step, span: See common_timebase.
+    - method: 'linear' or 'nearest', see resample_frames.
+    - devices: Device keys to align; all if None.
+
+    Returns:
+    - aligned: Shot dictionary plus 'cube' (time, device, pixel), zero
+      padded for devices with fewer pixels, 'devices' (cube order),
+      'pixels' per device and 'inside' (time, device), False where a
+      device frame was held beyond its time range.
+    """
+    streams = device_streams(data, devices)
+    if grid is None:
+        grid = common_timebase({device: t for device, (t, _) in streams.items()}, step, span)
+    grid = np.asarray(grid, dtype=float)
+    order = list(streams)
+    pixels = [streams[device][1].shape[1] for device in order]
+    cube = np.zeros((len(grid), len(order), max(pixels)))
+    inside = np.zeros((len(grid), len(order)), dtype=bool)
+    for i, device in enumerate(order):
+        time_array, spectra = streams[device]
+        cube[:, i, :pixels[i]], inside[:, i] = resample_frames(time_array, spectra, grid, method)
+
+    aligned = {key: value for key, value in data.items() if key not in ('spectra', 'time', 'times')}
+    aligned.update({
+        'spectra': {device: cube[:, i, :pixels[i]] for i, device in enumerate(order)},
+        'time': grid,
+        'times': {device: grid for device in order},
+        'cube': cube,
+        'devices': order,
+        'pixels': pixels,
+        'inside': inside,
+    })
+    return aligned
+
+
+def timing_skew(data):
+    """
+    Offset of the frames of every device against the first one, before aligning.
+
+    Returns:
+    - skew: Dictionary device -> median offset (s) of its frame timestamps
+      from the nearest frame of the first device.
+    """
+    streams = device_streams(data)
+    reference = next(iter(streams.values()))[0]
+    skew = {}
+    for device, (time_array, _) in streams.items():
+        nearest, _ = resample_frames(reference, reference[:, None], time_array, 'nearest')
+        skew[device] = float(np.median(time_array - nearest[:, 0]))
+    return skew
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+
+    shot_number = "000211"
+    data = load_shot(shot_number, path_shots)
+    print(f'Skew of the devices: {timing_skew(data)}')
+    aligned = align_shot(data)
+    print(f"Cube {aligned['cube'].shape} (time, device, pixel), "
+          f"{np.median(np.diff(aligned['time'])) * 1e3:.2f} ms per frame")
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import numpy as np
+from scipy.signal import find_peaks
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.peak2d import detect_peaks
+
+# Settings compared, those of shot_peaks first
+CASES = [{'prominence': 50, 'wlen': 51}, {'prominence': 50, 'wlen': 201}, {'prominence': 5, 'wlen': 51},
+         {'prominence': None}, {'height': 1000}]
+
+
+def synthetic_shot(n_frames: int=750, n_pixels: int=2048, n_lines: int=60, seed: int=0):
+    """
+    Background corrected spectra of a simulated shot: Gaussian lines rising
+    and decaying over the shot, with Poisson noise on a 100 counts offset.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(n_pixels)
+    lines = rng.uniform(0, n_pixels, n_lines)
+    amplitudes = rng.uniform(50, 5e4, n_lines)
+    envelope = np.exp(-((np.arange(n_frames) - 0.4 * n_frames) / (0.16 * n_frames)) ** 2)
+    profile = (amplitudes[:, None] * np.exp(-((x[None, :] - lines[:, None]) / 1.5) ** 2)).sum(axis=0)
+    return rng.poisson(100 + envelope[:, None] * profile[None, :]).astype(float) - 100
+
+
+def scipy_peaks(spectra, **kwargs):
+    # Reference: scipy.signal.find_peaks frame by frame
+    frames, pixels, prominences = [], [], []
+    for frame, spectrum in enumerate(spectra):
+        found, properties = find_peaks(spectrum, **kwargs)
+        frames.append(np.full(len(found), frame))
+        pixels.append(found)
+        prominences.append(properties.get('prominences', np.full(len(found), np.nan)))
+    return np.concatenate(frames), np.concatenate(pixels), np.concatenate(prominences)
+
+
+def best_time(function, repeat: int=5):
+    function()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def benchmark(spectra=None, cases=None, repeat: int=5):
+    """
+    Time detect_peaks against scipy.signal.find_peaks in a loop over the
+    frames and check that both find the same peaks.
+
+    Parameters:
+    - spectra: (frames, pixels) array, synthetic_shot() if None.
+    - cases: List of find_peaks keyword arguments, CASES by default.
+    - repeat: Runs per case, the best one is reported.
+
+    Returns:
+    - results: List of dictionaries with the case, the number of peaks,
+      both times (s), the speed-up and whether the peaks are the same.
+    """
+    spectra = synthetic_shot() if spectra is None else spectra
+    results = []
+    for case in CASES if cases is None else cases:
+        frames, pixels, prominences = scipy_peaks(spectra, **case)
+        peaks = detect_peaks(spectra, **case)
+        same = (len(peaks) == len(frames) and np.array_equal(peaks['frame'], frames)
+                and np.array_equal(peaks['pixel'], pixels)
+                and np.allclose(peaks['prominence'], prominences, rtol=1e-6, equal_nan=True))
+        t_loop = best_time(lambda: scipy_peaks(spectra, **case), repeat)
+        t_array = best_time(lambda: detect_peaks(spectra, **case), repeat)
+        results.append({'case': case, 'peaks': len(peaks), 'loop_s': t_loop, 'detect_s': t_array,
+                        'speedup': t_loop / t_array, 'same': same})
+    return results
+
+
+if __name__ == "__main__":
+    # e.g. python peaks/benchmark.py --frames=750 --pixels=2048 --lines=60
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    spectra = synthetic_shot(int(options.get('frames', 750)), int(options.get('pixels', 2048)),
+                             int(options.get('lines', 60)))
+    print(f"{'case':36s}{'peaks':>8s}{'loop (ms)':>11s}{'detect (ms)':>13s}{'speed-up':>10s}  same")
+    for r in benchmark(spectra):
+        case = ', '.join(f'{k}={v}' for k, v in r['case'].items())
+        print(f"{case:36s}{r['peaks']:8d}{r['loop_s'] * 1e3:11.1f}{r['detect_s'] * 1e3:13.1f}"
+              f"{r['speedup']:9.2f}x  {r['same']}")
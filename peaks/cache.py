@@ -0,0 +1,124 @@
+import os
+import json
+import pickle
+import hashlib
+
+
+class ProductCache:
+    """
+    On-disk cache of derived analysis products (max spectra, peaks, matches).
+
+    Entries are keyed by the content hash of the shot file, the stage name
+    and its parameters; parameters that are paths to existing files are
+    keyed by their content too (calibration, line lists). When the cache
+    exceeds max_bytes the least recently used entries are removed.
+
+    Parameters:
+    - path: Directory where the entries are stored.
+    - max_bytes: Maximum total size of the entries.
+    """
+
+    def __init__(self, path: str, max_bytes: int=2 * 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._hashes = {}
+        os.makedirs(path, exist_ok=True)
+
+    def file_hash(self, file_path: str):
+        """
+        SHA-256 of a file, remembered while its size and mtime do not change.
+        """
+        stat = os.stat(file_path)
+        memo = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if memo not in self._hashes:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self._hashes[memo] = digest.hexdigest()
+        return self._hashes[memo]
+
+    def _param(self, value):
+        if isinstance(value, str) and os.path.isfile(value):
+            return {'file': self.file_hash(value)}
+        if isinstance(value, (list, tuple)):
+            return [self._param(v) for v in value]
+        if isinstance(value, dict):
+            return {str(k): self._param(v) for k, v in value.items()}
+        return value
+
+    def key(self, stage: str, shot_file: str, params: dict=None):
+        description = {
+            'shot': self.file_hash(shot_file),
+            'stage': stage,
+            'params': self._param(params or {}),
+        }
+        text = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, f'{key}.pkl')
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        # Mark as recently used
+        os.utime(entry)
+        return value
+
+    def put(self, key, value):
+        entry = self._entry(key)
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def get_or_compute(self, stage: str, shot_file: str, params: dict, compute):
+        """
+        Return the cached product or compute and store it.
+
+        Parameters:
+        - stage: Name of the analysis stage, e.g. 'max_spectrum'.
+        - shot_file: Path of the shot file the product derives from.
+        - params: Parameters of the stage that change its result.
+        - compute: Callable without arguments producing the product.
+
+        Returns:
+        - value: The product.
+        """
+        key = self.key(stage, shot_file, params)
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def size(self):
+        return sum(e.stat().st_size for e in os.scandir(self.path) if e.name.endswith('.pkl'))
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits max_bytes.
+        """
+        entries = [e for e in os.scandir(self.path) if e.name.endswith('.pkl')]
+        stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+        total = sum(s[1] for s in stats)
+        for _, size, entry in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for e in os.scandir(self.path):
+            if e.name.endswith('.pkl'):
+                os.remove(e.path)
@@ -7,13 +7,48 @@ import os
 from peaks.load_NIST import load_NIST_data
 from scipy.signal import find_peaks
 from plots.aniplot import load_data, load_shot
+from src.com.dark import shot_background
+from peaks.drift import corrected_wave
+from src import tracing
 
-def multimax(data_list):
+def device_time(data, device='2'):
+    """
+    Timestamps of the frames of one device.
+
+    Parameters:
+    - data: Dictionary containing 'spectra' and 'time' (and 'times' in
+      shots saved with per-device timestamps).
+    - device: Device key in data['spectra'].
+
+    Returns:
+    - time_array: One timestamp per frame of the device.
+    """
+    if 'times' in data:
+        return np.asarray(data['times'][device], dtype=float)
+    # Older shots interleave the timestamps of all devices frame by frame
+    time_array = np.asarray(data['time'], dtype=float)
+    devices = list(data['spectra'].keys())
+    n_frames = len(data['spectra'][device])
+    if len(time_array) == n_frames * len(devices):
+        return time_array[devices.index(device)::len(devices)]
+    return time_array[:n_frames]
+
+def device_wave(data, device='2', drift: bool=True):
+    # Axis of the device the spectra come from, without its drift
+    wave = np.asarray(data.get('waves', {}).get(device, data['wave']), dtype=float)
+    if drift and data.get('drift', {}).get(device, {}).get('valid'):
+        wave = corrected_wave(wave, data['drift'][device])
+    return wave
+
+@tracing.traced('multimax')
+def multimax(data_list, dark=None, drift: bool=True):
     """
     Find the maximum spectrum across multiple data sets.
     
     Parameters:
     - data_list: List of dictionaries containing 'wave', 'spectra', and 'time'.
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    - drift: Remove the wavelength drift stored with the shot, if any.
     
     Returns:
     - max_spectrum: Maximum spectrum for each data sets.
@@ -24,13 +59,11 @@ def multimax(data_list):
         'time': []
     }
     for data in data_list:
-        wavelengths = np.array(data['wave'])
-        spectra = np.array(data['spectra']['2'])
-        time_array = np.array(data['time'])
+        wavelengths = device_wave(data, '2', drift)
+        time_array = device_time(data, '2')
 
         # Normalize and align time
-        spectra = spectra - spectra[0, :]
-        spectra = np.clip(spectra, 0, None)
+        spectra = shot_background(data, '2', dark)
         time_array = time_array - time_array[0]
         
 
@@ -42,12 +75,15 @@ def multimax(data_list):
         max_spectrum['time'].append(time_array[max_time_index])
     return max_spectrum
 
-def multisum(data_list):
+@tracing.traced('multisum')
+def multisum(data_list, dark=None, drift: bool=True):
     """
     Sum the spectra across multiple data sets.
     
     Parameters:
     - data_list: List of dictionaries containing 'wave', 'spectra', and 'time'.
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    - drift: Remove the wavelength drift stored with the shot, if any.
     
     Returns:
     - summed_spectrum: Summed spectrum for each data sets.
@@ -58,13 +94,11 @@ def multisum(data_list):
         'time': []
     }
     for data in data_list:
-        wavelengths = np.array(data['wave'])
-        spectra = np.array(data['spectra']['2'])
-        time_array = np.array(data['time'])
+        wavelengths = device_wave(data, '2', drift)
+        time_array = device_time(data, '2')
 
         # Normalize and align time
-        spectra = spectra - spectra[0, :]
-        spectra = np.clip(spectra, 0, None)
+        spectra = shot_background(data, '2', dark)
         time_array = time_array - time_array[0]
         
         # Update summed_spectrum
@@ -76,6 +110,7 @@ def multisum(data_list):
         
     return summed_spectrum
 
+@tracing.traced('compare_peaks_with_nist')
 def compare_peaks_with_nist(peaks, peak_wavelengths, peak_counts, nist_data,
                             tolerance=0.1, species=None):
     """
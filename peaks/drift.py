@@ -0,0 +1,163 @@
+import numpy as np
+import os
+import sys
+from scipy.ndimage import uniform_filter1d
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.com.dark import subtract_background, shot_background
+
+
+def _prepare(spectrum, width: int=31):
+    # Lines only: log counts without the slowly varying continuum, tapered
+    # at the ends so the FFT does not see a step
+    x = np.log1p(np.clip(np.asarray(spectrum, dtype=float), 0, None))
+    x = x - uniform_filter1d(x, width, mode='nearest')
+    x = (x - x.mean()) * np.hanning(len(x))
+    return x / max(np.linalg.norm(x), 1e-12)
+
+
+def xcorr_shift(spectrum, reference, max_shift: int=20):
+    """
+    Sub-pixel shift of spectrum with respect to reference.
+
+    The cross-correlation is computed with FFTs, its maximum searched
+    within max_shift pixels and refined with a parabola through the
+    three points around it.
+
+    Parameters:
+    - spectrum, reference: Prepared spectra (see _prepare) of equal length.
+    - max_shift: Largest shift considered, in pixels.
+
+    Returns:
+    - shift: Pixels; positive when the lines of spectrum are at higher
+      pixels than in reference.
+    - correlation: Height of the correlation peak (1 for identical spectra).
+    """
+    n = len(spectrum)
+    nfft = 1 << int(np.ceil(np.log2(2 * n)))
+    c = np.fft.irfft(np.fft.rfft(spectrum, nfft) * np.conj(np.fft.rfft(reference, nfft)), nfft)
+    lags = np.concatenate((c[-max_shift:], c[:max_shift + 1]))
+    i = int(np.argmax(lags))
+    shift = float(i - max_shift)
+    if 0 < i < len(lags) - 1:
+        left, centre, right = lags[i - 1], lags[i], lags[i + 1]
+        denominator = left - 2 * centre + right
+        if denominator != 0:
+            shift += 0.5 * (left - right) / denominator
+    return float(shift), float(lags[i])
+
+
+def estimate_drift(spectrum, reference, max_shift: int=20, stretch: bool=False, n_windows: int=4,
+                   min_correlation: float=0.3):
+    """
+    Shift (and optionally stretch) of a spectrum against a reference.
+
+    Parameters:
+    - spectrum, reference: Max spectra of the same device (counts).
+    - max_shift: Largest shift considered, in pixels.
+    - stretch: Also fit a shift varying linearly with pixel, from the
+      shifts of n_windows parts of the spectrum.
+    - min_correlation: Below it (too few common lines) the estimate is
+      marked as not valid.
+
+    Returns:
+    - drift: Dictionary with 'shift' (pixels at 'center'), 'stretch'
+      (pixels per pixel), 'center', 'correlation' and 'valid'.
+    """
+    n = len(spectrum)
+    center = (n - 1) / 2
+    shift, correlation = xcorr_shift(_prepare(spectrum), _prepare(reference), max_shift)
+    valid = correlation >= min_correlation and abs(shift) < max_shift
+    drift = {'shift': shift, 'stretch': 0.0, 'center': center, 'correlation': correlation,
+             'valid': bool(valid)}
+    if stretch:
+        edges = np.linspace(0, n, n_windows + 1).astype(int)
+        centers, shifts, weights = [], [], []
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            s, c = xcorr_shift(_prepare(spectrum[lo:hi]), _prepare(reference[lo:hi]), max_shift)
+            centers.append((lo + hi - 1) / 2)
+            shifts.append(s)
+            weights.append(max(c, 0))
+        if valid and np.count_nonzero(weights) >= 2:
+            slope, intercept = np.polyfit(np.array(centers) - center, shifts, 1, w=weights)
+            drift['shift'], drift['stretch'] = float(intercept), float(slope)
+    return drift
+
+
+def corrected_wave(wave, drift):
+    """
+    Wavelength of every pixel once the drift is removed.
+
+    A line found at pixel p was at pixel p - shift(p) in the reference, so
+    its wavelength is the reference wavelength there. The axis is evaluated
+    through its cubic pixel polynomial (the form of the factory
+    calibration) so the edge pixels are extrapolated.
+    """
+    wave = np.asarray(wave, dtype=float)
+    pixels = np.arange(len(wave))
+    shift = drift['shift'] + drift.get('stretch', 0.0) * (pixels - drift.get('center', 0.0))
+    return np.polyval(np.polyfit(pixels, wave, 3), pixels - shift)
+
+
+class DriftReference:
+    """
+    Reference max spectra of every device, against which each shot's
+    wavelength drift is estimated when it is saved.
+
+    Parameters:
+    - path: .npz file of the reference.
+    - max_shift: Largest drift searched, in pixels.
+    - stretch: Also estimate a stretch of the axis.
+    """
+
+    def __init__(self, path: str, max_shift: int=20, stretch: bool=False):
+        self.path = path
+        self.max_shift = max_shift
+        self.stretch = stretch
+        self.spectra = {}
+        self.name = None
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as f:
+                self.spectra = {key[5:]: f[key] for key in f.files if key.startswith('spec_')}
+                self.name = str(f['name'])
+
+    def set(self, data, name, dark=None):
+        """
+        Use the max spectra of a shot (e.g. right after a lamp calibration).
+
+        Parameters:
+        - data: Shot dictionary as returned by load_shot.
+        - name: Shot number, stored with every correction.
+        - dark: Optional DarkLibrary.
+        """
+        self.spectra = {str(device): np.amax(shot_background(data, device, dark), axis=0)
+                        for device in data['spectra']}
+        self.name = str(name)
+        tmp = f'{self.path}.tmp.npz'
+        np.savez(tmp, name=np.array(self.name),
+                 **{f'spec_{device}': spectrum for device, spectrum in self.spectra.items()})
+        os.replace(tmp, self.path)
+
+    def estimate(self, spectra, darks=None):
+        """
+        Drift of every device with a reference.
+
+        Parameters:
+        - spectra: Mapping device -> (frames, pixels) array (a Measurement works).
+        - darks: Optional mapping device -> dark spectrum.
+
+        Returns:
+        - drift: Dictionary device -> estimate_drift output plus 'reference'.
+        """
+        drift = {}
+        for device in spectra.keys():
+            reference = self.spectra.get(str(device))
+            frames = spectra[device]
+            if reference is None or len(frames) == 0 or len(reference) != frames.shape[1]:
+                continue
+            dark = None if darks is None else darks.get(device)
+            spectrum = np.amax(subtract_background(frames, dark), axis=0)
+            drift[str(device)] = {**estimate_drift(spectrum, reference, self.max_shift, self.stretch),
+                                  'reference': self.name}
+        return drift
@@ -0,0 +1,268 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.check import device_time
+from peaks.traces import line_windows
+from src.com.dark import subtract_background
+from plots.aniplot import load_shot
+
+
+class FeatureIndex:
+    """
+    Columnar index of per-shot, per-device summary features.
+
+    Every row is one device of one shot. The columns are numpy arrays
+    stored together in a single .npz file, so a query only touches the
+    columns it needs and never opens the shot files. Shots indexed as
+    they are saved (append) go to small segment files next to it, which
+    save() folds back into the main file.
+
+    Columns:
+    - shot, device: Row identification.
+    - peak_time: Time (s from the first frame) of the brightest frame.
+    - max_counts: Highest count of the shot.
+    - saturated: Number of pixels that reached the saturation level.
+    - max_spectrum, max_wave: Max spectrum max-pooled to n_bins.
+    - line_peak, line_sum: Per configured line, peak and time integral of
+      its background corrected intensity.
+
+    Parameters:
+    - path: Path of the .npz index file.
+    - lines: Lines to index, dictionary from peaks.traces.select_lines.
+    - n_bins: Size of the downsampled max spectrum.
+    - saturation: Counts at which a pixel is considered saturated.
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    - compact_every: Segments appended before they are folded into the main file.
+    """
+
+    def __init__(self, path: str, lines: dict=None, n_bins: int=256, saturation: float=65000,
+                 dark=None, compact_every: int=200):
+        self.path = path
+        self.path_segments = f'{os.path.splitext(path)[0]}_segments'
+        self.compact_every = compact_every
+        self.dark = dark
+        self.n_bins = n_bins
+        self.saturation = saturation
+        self.columns = None
+        self._windows = {}
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as f:
+                self.columns = {key: f[key] for key in f.files}
+            self.lines = {'wave': self.columns.pop('line_wave'),
+                          'species': self.columns.pop('line_species')}
+        else:
+            if lines is None:
+                raise ValueError('A new index needs the lines to index')
+            self.lines = {'wave': np.asarray(lines['wave'], dtype=float),
+                          'species': np.asarray(lines['species'], dtype=str)}
+        for segment in self.segments():
+            with np.load(segment, allow_pickle=False) as f:
+                self._merge({key: f[key] for key in f.files})
+
+    def segments(self):
+        if not os.path.isdir(self.path_segments):
+            return []
+        return sorted(os.path.join(self.path_segments, f) for f in os.listdir(self.path_segments)
+                      if f.endswith('.npz') and not f.endswith('.tmp.npz'))
+
+    def __len__(self):
+        return 0 if self.columns is None else len(self.columns['shot'])
+
+    def shots(self):
+        return set() if self.columns is None else set(self.columns['shot'].tolist())
+
+    def features(self, shot_number, data, device):
+        spectra = np.asarray(data['spectra'][device], dtype=float)
+        wavelengths = np.asarray(data.get('waves', {}).get(device, data['wave']), dtype=float)
+        time_array = device_time(data, device)
+        time_array = time_array - time_array[0]
+
+        saturated = int(np.count_nonzero(np.amax(spectra, axis=0) >= self.saturation))
+        dark = self.dark.for_shot(data, device) if self.dark is not None else None
+        spectra = subtract_background(spectra, dark)
+        max_spectrum = np.amax(spectra, axis=0)
+
+        # Max-pool to n_bins, the last bin takes the remainder
+        edges = np.linspace(0, len(max_spectrum), self.n_bins + 1).astype(int)
+        edges = np.minimum(edges, len(max_spectrum) - 1)
+        pooled = np.maximum.reduceat(max_spectrum, edges[:-1])
+        pooled_wave = wavelengths[(edges[:-1] + edges[1:]) // 2]
+
+        key = wavelengths.tobytes()
+        if key not in self._windows:
+            self._windows[key] = line_windows(wavelengths, self.lines['wave'])
+        traces = np.asarray((self._windows[key].T @ spectra.T).T)
+
+        return {
+            'shot': str(shot_number),
+            'device': str(device),
+            'peak_time': float(time_array[np.argmax(spectra.sum(axis=1))]),
+            'max_counts': float(max_spectrum.max()),
+            'saturated': saturated,
+            'max_spectrum': pooled.astype(np.float32),
+            'max_wave': pooled_wave.astype(np.float32),
+            'line_peak': traces.max(axis=0).astype(np.float32),
+            'line_sum': traces.sum(axis=0).astype(np.float32),
+        }
+
+    def add(self, shot_number, data):
+        """
+        Index (or re-index) every device of a shot.
+
+        Parameters:
+        - shot_number: Shot number.
+        - data: Shot dictionary as returned by load_shot.
+        """
+        rows = [self.features(shot_number, data, device) for device in data['spectra']]
+        new = {key: np.array([row[key] for row in rows]) for key in rows[0]}
+        self._merge(new)
+        return new
+
+    def _merge(self, new):
+        # Rows of new replace the rows of the same shots
+        if self.columns is None:
+            self.columns = new
+            return
+        keep = ~np.isin(self.columns['shot'], new['shot'])
+        self.columns = {key: np.concatenate((self.columns[key][keep], new[key]))
+                        for key in self.columns}
+
+    def append(self, shot_number, data):
+        """
+        Index a shot and store only its rows, in a new segment file.
+
+        Cheap enough to run on every saved shot: the main file is only
+        rewritten every compact_every segments.
+        """
+        new = self.add(shot_number, data)
+        if not os.path.exists(self.path):
+            return self.save()
+        segments = self.segments()
+        if len(segments) >= self.compact_every:
+            return self.save()
+        os.makedirs(self.path_segments, exist_ok=True)
+        number = int(os.path.basename(segments[-1])[:-4]) + 1 if segments else 0
+        segment = os.path.join(self.path_segments, f'{number:08d}.npz')
+        tmp = f'{segment[:-4]}.tmp.npz'
+        np.savez(tmp, **new)
+        os.replace(tmp, segment)
+
+    def ingest(self, path_shots, shot_numbers=None):
+        """
+        Index the shots of a directory that are not indexed yet.
+
+        Returns:
+        - added: List of the shots added.
+        """
+        if shot_numbers is None:
+            shot_numbers = sorted(f[:-5] for f in os.listdir(path_shots) if f.endswith('.json'))
+        indexed = self.shots()
+        added = []
+        for shot in shot_numbers:
+            if shot in indexed:
+                continue
+            try:
+                self.add(shot, load_shot(shot, path_shots))
+                added.append(shot)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error indexing shot {shot}: {e}")
+        return added
+
+    def save(self):
+        tmp = f'{self.path}.tmp.npz'
+        np.savez(tmp, line_wave=self.lines['wave'], line_species=self.lines['species'],
+                 **self.columns)
+        os.replace(tmp, self.path)
+        # Their rows are in the main file now
+        for segment in self.segments():
+            os.remove(segment)
+
+    def line(self, wave: float, tolerance: float=0.5):
+        # Column index of the indexed line closest to wave
+        i = int(np.argmin(np.abs(self.lines['wave'] - wave)))
+        if abs(self.lines['wave'][i] - wave) > tolerance:
+            raise ValueError(f'No indexed line within {tolerance} nm of {wave} nm')
+        return i
+
+    def query(self, line: float=None, min: float=None, max: float=None, device=None,
+              saturated: bool=None, column: str='line_peak', t_min: float=None, t_max: float=None):
+        """
+        Rows matching all the given conditions.
+
+        Parameters:
+        - line: Line wavelength (nm) the min/max thresholds apply to; if
+          None they apply to max_counts.
+        - min, max: Threshold range of the line (or max_counts) value.
+        - device: Only this device.
+        - saturated: True/False to keep only (un)saturated rows.
+        - column: 'line_peak' or 'line_sum'.
+        - t_min, t_max: Range of the peak time.
+
+        Returns:
+        - result: Dictionary with 'shot', 'device', 'value' and 'peak_time'
+          of the matching rows.
+        """
+        if self.columns is None:
+            return {'shot': np.array([], dtype=str), 'device': np.array([], dtype=str),
+                    'value': np.array([]), 'peak_time': np.array([])}
+        c = self.columns
+        value = c['max_counts'] if line is None else c[column][:, self.line(line)]
+        mask = np.ones(len(value), dtype=bool)
+        if min is not None:
+            mask &= value >= min
+        if max is not None:
+            mask &= value <= max
+        if device is not None:
+            mask &= c['device'] == str(device)
+        if saturated is not None:
+            mask &= (c['saturated'] > 0) == saturated
+        if t_min is not None:
+            mask &= c['peak_time'] >= t_min
+        if t_max is not None:
+            mask &= c['peak_time'] <= t_max
+        return {'shot': c['shot'][mask], 'device': c['device'][mask],
+                'value': value[mask], 'peak_time': c['peak_time'][mask]}
+
+    def top_k(self, line: float=None, k: int=10, **kwargs):
+        """
+        The k rows with the highest line (or max_counts) value.
+
+        Parameters are those of query, which filters the rows first.
+        """
+        result = self.query(line=line, **kwargs)
+        order = np.argsort(-result['value'], kind='stable')[:k]
+        return {key: value[order] for key, value in result.items()}
+
+
+def open_index(path_shots, lines_files=None, dark=None, **kwargs):
+    """
+    The index of a Shots directory (features.npz), created if needed.
+
+    Parameters:
+    - path_shots: Directory with the shot files.
+    - lines_files: Line files of a new index; Ar I and Ar II of ArNIST.txt by default.
+    - dark: Optional DarkLibrary.
+    - **kwargs: Passed to FeatureIndex.
+    """
+    from peaks.traces import select_lines
+
+    index_path = os.path.join(path_shots, 'features.npz')
+    if os.path.exists(index_path):
+        return FeatureIndex(index_path, dark=dark, **kwargs)
+    if lines_files is None:
+        lines_files = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ArNIST.txt')]
+    lines = select_lines(lines_files, species=['Ar I', 'Ar II'], min_intensity=100, min_separation=0.8)
+    return FeatureIndex(index_path, lines, dark=dark, **kwargs)
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+
+    index = open_index(path_shots)
+    print(f'Indexed {len(index.ingest(path_shots))} new shots')
+    index.save()
+    print(index.top_k(line=480.6, k=5, saturated=False))
@@ -0,0 +1,352 @@
+import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.check import device_time
+from plots.aniplot import load_shot
+from src.com.dark import shot_background
+from src import tracing
+
+PEAK_DTYPE = np.dtype([('frame', '<i4'), ('pixel', '<i4'), ('height', '<f4'), ('prominence', '<f4'),
+                       ('track', '<i4')])
+TRACK_DTYPE = np.dtype([('track', '<i4'), ('birth', '<i4'), ('death', '<i4'), ('count', '<i4'),
+                        ('pixel', '<f4'), ('wave', '<f4'), ('max_height', '<f4'), ('max_frame', '<i4'),
+                        ('birth_time', '<f8'), ('death_time', '<f8')])
+
+
+def _range_tables(values, reduce, out):
+    # out[k, j] = reduce of values[j:j + 2**k]; the last entries of every
+    # level are left unset, the lookups stay inside the padded rows
+    out[0] = values
+    for k in range(1, len(out)):
+        half = 2 ** (k - 1)
+        reduce(out[k - 1, :-half], out[k - 1, half:], out=out[k, :-half])
+    return out
+
+
+def _side_minimum(highest, lowest, position, heights, side, direction):
+    # Lowest point between every peak and the nearest higher point (or the
+    # edge) within side pixels. The extent is found by binary lifting on the
+    # range maxima and its minimum from two range minima, so every peak
+    # takes a few lookups whatever the window. The lifting can go beyond
+    # side (not beyond the padding, higher than anything) and is cut after
+    extent = np.zeros(len(position), dtype=np.intp)
+    for k in range(len(highest) - 1, -1, -1):
+        first = position - extent - 2 ** k if direction < 0 else position + extent + 1
+        extent += (highest[k][first] <= heights) * 2 ** k
+    extent = np.minimum(extent, side)
+    # Range of extent + 1 values including the peak, which changes nothing,
+    # covered by two ranges of 2**k values (at most side)
+    k = np.log2(np.minimum(np.arange(1, side + 2), side)).astype(np.intp)[extent]
+    first = position - extent if direction < 0 else position
+    index = k * lowest.shape[1] + first
+    lowest = lowest.ravel()
+    return np.minimum(lowest[index], lowest[index + extent + 1 - 2 ** k])
+
+
+def _run_middles(step, start):
+    # Middle of the runs of equal values starting at the positions start
+    # (step[start - 1] > 0), for the runs that fall afterwards. The rows are
+    # padded with inf, whose steps are never 0 nor negative
+    end = start.copy()
+    # Flat tops: move end to the last value of the run (they are short)
+    flat = np.flatnonzero(step[end] == 0)
+    while len(flat):
+        end[flat] += 1
+        flat = flat[step[end[flat]] == 0]
+    falls = step[end] < 0
+    return start[falls] + (end[falls] - start[falls]) // 2
+
+
+def _pad(block, pad, out=None):
+    # Rows of block between pad inf on each side, flattened
+    rows, n_pixels = block.shape
+    if out is None:
+        out = np.full((rows, n_pixels + 2 * pad), np.inf)
+    out[:rows, pad:pad + n_pixels] = block
+    return out[:rows].ravel()
+
+
+def local_maxima(block):
+    """
+    Local maxima of every row, flat ones included, as scipy.signal.find_peaks.
+
+    A maximum is a run of equal pixels with lower neighbours on both sides;
+    its pixel is the middle of the run (the left one of the two middle
+    pixels for even runs). Runs touching the edges are not maxima.
+
+    Returns:
+    - frames, pixels: Row and pixel of every maximum.
+    """
+    values = _pad(block, 1)
+    with np.errstate(invalid='ignore'):
+        step = np.diff(values)
+    # Rising from the left neighbour and not rising to the right one
+    start = np.flatnonzero((step[:-1] > 0) & (step[1:] <= 0)) + 1
+    frames, pixels = np.divmod(_run_middles(step, start), block.shape[1] + 2)
+    return frames, pixels - 1
+
+
+def detect_peaks(spectra, height: float=None, prominence: float=None, wlen: int=51,
+                 chunk: int=32):
+    """
+    Local maxima of every frame of a (frames, pixels) block at once.
+
+    The peaks, heights and prominences of scipy.signal.find_peaks(height,
+    prominence, wlen) on every frame, flat peaks included (see
+    local_maxima), done as array operations on the flattened frames.
+    Maxima that cannot reach prominence, as the lowest point of the pixel
+    blocks around them is too high, are discarded on whole arrays; the
+    bases of the rest come from range maxima and minima tables (sparse
+    tables), so the cost does not grow with wlen.
+
+    Parameters:
+    - spectra: (frames, pixels) array, background corrected.
+    - height: Minimum counts of a peak.
+    - prominence: Minimum prominence of a peak. Without it the bases are
+      not searched and 'prominence' is NaN.
+    - wlen: Window in pixels for the prominence bases, wlen // 2 on each
+      side of the peak as in scipy.
+    - chunk: Frames processed at a time, small enough for the cache.
+
+    Returns:
+    - peaks: Structured array (PEAK_DTYPE) sorted by frame and pixel,
+      'track' set to -1.
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    n_frames, n_pixels = spectra.shape
+    side = max(int(wlen) // 2, 1)
+    # Beyond the edges nothing is lower, so the bases stop there
+    pad, width = 1, n_pixels + 2
+    if prominence is not None:
+        # Rows of whole blocks of side pixels, at least side inf on each side
+        pad, width = side, (-(-n_pixels // side) + 3) * side
+    padded = np.full((min(chunk, n_frames), width), np.inf)
+    if prominence is not None:
+        levels = int(np.log2(side)) + 1
+        highest = np.empty((levels, padded.size))
+        lowest = np.empty((levels, padded.size))
+    found = []
+    for start in range(0, n_frames, chunk):
+        values = _pad(spectra[start:start + chunk], pad, padded)
+        size = len(values)
+        with np.errstate(invalid='ignore'):
+            step = np.diff(values)
+        # Candidates at the positions pad .. size - pad of values
+        inner = slice(pad, size - pad)
+        candidates = step[pad - 1:size - pad - 1] > 0
+        candidates &= step[inner] <= 0
+        if height is not None:
+            candidates &= values[inner] >= height
+        if prominence is not None:
+            # Lowest point of every pair of pixel blocks: the window on the
+            # left of position q lies in the pair q // side - 1, the one on
+            # the right in the pair q // side
+            pairs = values.reshape(-1, side).min(axis=1)
+            pairs = np.minimum(pairs[:-1], pairs[1:]) + prominence
+            limit = np.repeat(pairs, side)
+            candidates &= values[inner] >= limit[pad - side:size - pad - side]
+        position = _run_middles(step, np.flatnonzero(candidates) + pad)
+        heights = values[position]
+        prominences = np.full(len(position), np.nan)
+        if prominence is not None:
+            # Same bound on the right of the middle of the run
+            selected = heights >= limit[position]
+            position, heights = position[selected], heights[selected]
+        if prominence is not None and len(position):
+            _range_tables(values, np.maximum, highest[:, :size])
+            _range_tables(values, np.minimum, lowest[:, :size])
+            left = _side_minimum(highest, lowest, position, heights, side, -1)
+            right = _side_minimum(highest, lowest, position, heights, side, 1)
+            prominences = heights - np.maximum(left, right)
+            selected = prominences >= prominence
+            position, heights, prominences = position[selected], heights[selected], prominences[selected]
+        frames, pixels = np.divmod(position, width)
+        peaks = np.empty(len(position), dtype=PEAK_DTYPE)
+        peaks['frame'] = frames + start
+        peaks['pixel'] = pixels - pad
+        peaks['height'] = heights
+        peaks['prominence'] = prominences
+        peaks['track'] = -1
+        found.append(peaks)
+    return np.concatenate(found) if found else np.empty(0, dtype=PEAK_DTYPE)
+
+
+def link_peaks(peaks, max_jump: float=2, max_gap: int=1):
+    """
+    Join the peaks of consecutive frames into tracks, in place.
+
+    A peak continues the track whose last peak is the nearest within
+    max_jump pixels; a track may miss up to max_gap frames. Conflicts are
+    resolved in favour of the smallest jump, the other peaks start new
+    tracks.
+
+    Parameters:
+    - peaks: Structured array from detect_peaks, sorted by frame.
+    - max_jump: Largest pixel distance between linked peaks.
+    - max_gap: Frames a track can miss and still continue.
+
+    Returns:
+    - n_tracks: Number of tracks; peaks['track'] holds the track of every peak.
+    """
+    frames = peaks['frame']
+    bounds = np.searchsorted(frames, np.arange(frames[0], frames[-1] + 2)) if len(peaks) else []
+    track_ids = np.empty(0, dtype=np.int32)
+    track_pixels = np.empty(0)
+    track_frames = np.empty(0, dtype=np.int32)
+    n_tracks = 0
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        frame = frames[lo]
+        alive = frame - track_frames <= max_gap + 1
+        track_ids, track_pixels, track_frames = track_ids[alive], track_pixels[alive], track_frames[alive]
+        pixels = peaks['pixel'][lo:hi].astype(float)
+        assigned = np.full(hi - lo, -1, dtype=np.int32)
+        if len(track_ids):
+            # Nearest peak of this frame to every live track
+            right = np.clip(np.searchsorted(pixels, track_pixels), 0, len(pixels) - 1)
+            left = np.clip(right - 1, 0, len(pixels) - 1)
+            nearest = np.where(np.abs(pixels[left] - track_pixels) <= np.abs(pixels[right] - track_pixels),
+                               left, right)
+            distance = np.abs(pixels[nearest] - track_pixels)
+            order = np.argsort(distance, kind='stable')
+            order = order[distance[order] <= max_jump]
+            _, first = np.unique(nearest[order], return_index=True)
+            winners = order[first]
+            assigned[nearest[winners]] = track_ids[winners]
+        new = assigned < 0
+        assigned[new] = n_tracks + np.arange(np.count_nonzero(new), dtype=np.int32)
+        n_tracks += np.count_nonzero(new)
+        peaks['track'][lo:hi] = assigned
+
+        # The peaks of this frame are the new ends of their tracks
+        continued = ~np.isin(track_ids, assigned)
+        track_ids = np.concatenate((track_ids[continued], assigned))
+        track_pixels = np.concatenate((track_pixels[continued], pixels))
+        track_frames = np.concatenate((track_frames[continued], np.full(hi - lo, frame, dtype=np.int32)))
+    return n_tracks
+
+
+def summarize_tracks(peaks, n_tracks, wave=None, time_array=None, min_count: int=1):
+    """
+    Birth, death and strength of every track.
+
+    Parameters:
+    - peaks: Linked peaks (see link_peaks).
+    - n_tracks: Number of tracks.
+    - wave: Wavelength of every pixel, for the 'wave' of the tracks.
+    - time_array: Time of every frame, for 'birth_time' and 'death_time'.
+    - min_count: Tracks with fewer peaks are dropped.
+
+    Returns:
+    - tracks: Structured array (TRACK_DTYPE).
+    """
+    if not len(peaks) or not n_tracks:
+        return np.empty(0, dtype=TRACK_DTYPE)
+    ids = peaks['track']
+    count = np.bincount(ids, minlength=n_tracks)
+    birth = np.full(n_tracks, np.iinfo(np.int32).max)
+    np.minimum.at(birth, ids, peaks['frame'])
+    death = np.full(n_tracks, -1)
+    np.maximum.at(death, ids, peaks['frame'])
+    heights = peaks['height'].astype(float)
+    pixel = np.bincount(ids, weights=peaks['pixel'] * heights, minlength=n_tracks)
+    pixel /= np.maximum(np.bincount(ids, weights=heights, minlength=n_tracks), 1e-12)
+    # Strongest peak of every track: the last one in height order wins
+    order = np.argsort(heights, kind='stable')
+    max_index = np.zeros(n_tracks, dtype=np.int64)
+    max_index[ids[order]] = order
+
+    tracks = np.empty(n_tracks, dtype=TRACK_DTYPE)
+    tracks['track'] = np.arange(n_tracks)
+    tracks['birth'] = birth
+    tracks['death'] = death
+    tracks['count'] = count
+    tracks['pixel'] = pixel
+    tracks['max_height'] = heights[max_index]
+    tracks['max_frame'] = peaks['frame'][max_index]
+    if wave is not None:
+        wave = np.asarray(wave, dtype=float)
+        tracks['wave'] = np.interp(pixel, np.arange(len(wave)), wave)
+    else:
+        tracks['wave'] = np.nan
+    if time_array is not None:
+        time_array = np.asarray(time_array, dtype=float)
+        tracks['birth_time'] = time_array[birth]
+        tracks['death_time'] = time_array[death]
+    else:
+        tracks['birth_time'] = tracks['death_time'] = np.nan
+    return tracks[count >= min_count]
+
+
+@tracing.traced('shot_peaks')
+def shot_peaks(data, device='2', dark=None, height: float=None, prominence: float=50, wlen: int=51,
+               max_jump: float=2, max_gap: int=1, min_count: int=3):
+    """
+    Peaks of every frame of a shot and the tracks they form.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - device: Device key in data['spectra'].
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    - height, prominence, wlen: See detect_peaks.
+    - max_jump, max_gap: See link_peaks.
+    - min_count: Tracks with fewer peaks are dropped.
+
+    Returns:
+    - peaks: Structured array (PEAK_DTYPE).
+    - tracks: Structured array (TRACK_DTYPE); 'birth_time' and
+      'death_time' from the first frame of the shot.
+    """
+    spectra = shot_background(data, device, dark)
+    peaks = detect_peaks(spectra, height, prominence, wlen)
+    n_tracks = link_peaks(peaks, max_jump, max_gap)
+    time_array = device_time(data, device)[:len(spectra)]
+    wave = data.get('waves', {}).get(device, data['wave'])
+    tracks = summarize_tracks(peaks, n_tracks, wave, time_array - time_array[0], min_count)
+    return peaks, tracks
+
+
+def campaign_tracks(shot_numbers, path_shots, **kwargs):
+    """
+    Tracks of many shots in one structured array, for campaign statistics.
+
+    Parameters:
+    - shot_numbers: List of shot numbers.
+    - path_shots: Path to the directory containing the shot files.
+    - **kwargs: Passed to shot_peaks.
+
+    Returns:
+    - tracks: Structured array with a 'shot' field followed by TRACK_DTYPE.
+    """
+    dtype = np.dtype([('shot', 'U12')] + TRACK_DTYPE.descr)
+    found = []
+    for shot in shot_numbers:
+        try:
+            data = load_shot(shot, path_shots)
+        except FileNotFoundError as e:
+            print(f"Error loading shot {shot}: {e}")
+            continue
+        _, tracks = shot_peaks(data, **kwargs)
+        with_shot = np.empty(len(tracks), dtype=dtype)
+        with_shot['shot'] = shot
+        for name in TRACK_DTYPE.names:
+            with_shot[name] = tracks[name]
+        found.append(with_shot)
+    return np.concatenate(found) if found else np.empty(0, dtype=dtype)
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+
+    tracks = campaign_tracks(["000181", "000210", "000211"], path_shots)
+    for shot in np.unique(tracks['shot']):
+        shot_tracks = tracks[tracks['shot'] == shot]
+        strongest = shot_tracks[np.argsort(shot_tracks['max_height'])[::-1][:5]]
+        print(f"Shot {shot}: {len(shot_tracks)} tracks, strongest at "
+              + ', '.join(f"{t['wave']:.2f} nm ({t['birth_time']:.3f}-{t['death_time']:.3f} s)"
+                          for t in strongest))
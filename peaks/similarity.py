@@ -0,0 +1,272 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.check import device_time
+from src.com.dark import shot_background
+from plots.aniplot import load_shot
+
+
+def randomized_svd(X, rank: int, oversample: int=10, n_iter: int=4, seed: int=0):
+    """
+    Truncated SVD of X from a random projection of its range.
+
+    Falls back to the exact SVD when X is small.
+
+    Returns:
+    - U, s, Vt: Factors truncated to rank.
+    """
+    n, p = X.shape
+    k = min(rank + oversample, n, p)
+    if k >= min(n, p) // 2:
+        U, s, Vt = np.linalg.svd(X, full_matrices=False)
+        return U[:, :rank], s[:rank], Vt[:rank]
+    rng = np.random.default_rng(seed)
+    Q = np.linalg.qr(X @ rng.standard_normal((p, k)))[0]
+    for _ in range(n_iter):
+        # Power iterations sharpen the decay of the spectrum
+        Q = np.linalg.qr(X.T @ Q)[0]
+        Q = np.linalg.qr(X @ Q)[0]
+    U, s, Vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+    return (Q @ U)[:, :rank], s[:rank], Vt[:rank]
+
+
+class SpectralBasis:
+    """
+    Principal components of spectra, updated incrementally.
+
+    Every partial_fit merges the new spectra with the current components
+    (incremental PCA), so archives of any size are fitted block by block.
+
+    Parameters:
+    - rank: Number of components kept.
+    """
+
+    def __init__(self, rank: int=16):
+        self.rank = rank
+        self.mean = None
+        self.components = None
+        self.singular_values = None
+        self.n_samples = 0
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=float)
+        n = len(X)
+        mean_X = X.mean(axis=0)
+        if self.mean is None:
+            stack = X - mean_X
+            mean = mean_X
+        else:
+            n0 = self.n_samples
+            mean = (n0 * self.mean + n * mean_X) / (n0 + n)
+            # Old components, new data and the shift between both means
+            stack = np.vstack((self.singular_values[:, None] * self.components, X - mean_X,
+                               np.sqrt(n0 * n / (n0 + n)) * (self.mean - mean_X)))
+        _, s, Vt = randomized_svd(stack, self.rank)
+        self.mean, self.components, self.singular_values = mean, Vt, s
+        self.n_samples += n
+        return self
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=float) - self.mean) @ self.components.T
+
+    def inverse_transform(self, Z):
+        return np.asarray(Z) @ self.components + self.mean
+
+    def to_arrays(self, prefix=''):
+        return {f'{prefix}mean': self.mean, f'{prefix}components': self.components,
+                f'{prefix}singular_values': self.singular_values,
+                f'{prefix}n_samples': np.array(self.n_samples), f'{prefix}rank': np.array(self.rank)}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        basis = cls(int(arrays[f'{prefix}rank']))
+        basis.mean = arrays[f'{prefix}mean']
+        basis.components = arrays[f'{prefix}components']
+        basis.singular_values = arrays[f'{prefix}singular_values']
+        basis.n_samples = int(arrays[f'{prefix}n_samples'])
+        return basis
+
+
+def max_spectrum_vector(data, device='2', dark=None):
+    # Shape of the max spectrum: log counts scaled to unit norm, so similar
+    # shots are close whatever their brightness
+    vector = np.log1p(np.amax(shot_background(data, device, dark), axis=0))
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+class SimilarityIndex:
+    """
+    Low-dimensional embedding of the max spectrum of every shot.
+
+    The embeddings are the coordinates of the max spectra in a
+    SpectralBasis fitted over the archive itself. When new shots update
+    the basis, the stored embeddings are projected onto the new one.
+
+    Parameters:
+    - path: Path of the .npz index file.
+    - rank: Number of components of a new index.
+    - device: Device key whose max spectrum is embedded.
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    """
+
+    def __init__(self, path: str, rank: int=16, device='2', dark=None):
+        self.path = path
+        self.device = str(device)
+        self.dark = dark
+        self.basis = SpectralBasis(rank)
+        self.shots = np.array([], dtype=str)
+        self.embeddings = np.empty((0, rank))
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as f:
+                arrays = {key: f[key] for key in f.files}
+            self.basis = SpectralBasis.from_arrays(arrays)
+            self.shots = arrays['shots']
+            self.embeddings = arrays['embeddings']
+            self.device = str(arrays['device'])
+
+    def __len__(self):
+        return len(self.shots)
+
+    def add(self, spectra):
+        """
+        Fit the basis with new max spectra and embed them.
+
+        Parameters:
+        - spectra: Dictionary shot_number -> max_spectrum_vector.
+        """
+        if not spectra:
+            return
+        X = np.array(list(spectra.values()))
+        if len(self.shots):
+            old = self.basis.inverse_transform(self.embeddings)
+        self.basis.partial_fit(X)
+        embeddings = self.basis.transform(X)
+        if len(self.shots):
+            keep = ~np.isin(self.shots, list(spectra))
+            embeddings = np.vstack((self.basis.transform(old[keep]), embeddings))
+            self.shots = self.shots[keep]
+        self.shots = np.concatenate((self.shots, np.array(list(spectra), dtype=str)))
+        self.embeddings = embeddings
+
+    def ingest(self, path_shots, shot_numbers=None, block: int=64):
+        """
+        Embed the shots of a directory that are not indexed yet.
+
+        Returns:
+        - added: List of the shots added.
+        """
+        if shot_numbers is None:
+            shot_numbers = sorted(f[:-5] for f in os.listdir(path_shots) if f.endswith('.json'))
+        indexed = set(self.shots.tolist())
+        n_pixels = None if self.basis.mean is None else len(self.basis.mean)
+        added, spectra = [], {}
+        for shot in shot_numbers:
+            if shot in indexed:
+                continue
+            try:
+                vector = max_spectrum_vector(load_shot(shot, path_shots), self.device, self.dark)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error embedding shot {shot}: {e}")
+                continue
+            n_pixels = len(vector) if n_pixels is None else n_pixels
+            if len(vector) != n_pixels:
+                print(f"Shot {shot} has {len(vector)} pixels and the index {n_pixels}, skipped")
+                continue
+            spectra[shot] = vector
+            if len(spectra) == block:
+                self.add(spectra)
+                added += list(spectra)
+                spectra = {}
+        self.add(spectra)
+        return added + list(spectra)
+
+    def save(self):
+        tmp = f'{self.path}.tmp.npz'
+        np.savez(tmp, shots=self.shots, embeddings=self.embeddings, device=np.array(self.device),
+                 **self.basis.to_arrays())
+        os.replace(tmp, self.path)
+
+    def nearest(self, query, k: int=5):
+        """
+        The k indexed shots most similar to a shot or spectrum.
+
+        Parameters:
+        - query: Indexed shot number, shot dictionary or max_spectrum_vector.
+        - k: Number of neighbours.
+
+        Returns:
+        - result: Dictionary with 'shot' and 'distance' arrays, closest first.
+          An indexed query shot is not returned as its own neighbour, a shot
+          number that is not indexed raises KeyError.
+        """
+        if isinstance(query, str):
+            found = np.flatnonzero(self.shots == query)
+            if not len(found):
+                raise KeyError(f'Shot {query} is not indexed')
+            i = int(found[0])
+            z, mask = self.embeddings[i], self.shots != query
+        else:
+            if isinstance(query, dict):
+                query = max_spectrum_vector(query, self.device, self.dark)
+            z, mask = self.basis.transform(query[None, :])[0], np.ones(len(self.shots), dtype=bool)
+        distance = np.linalg.norm(self.embeddings[mask] - z, axis=1)
+        order = np.argsort(distance, kind='stable')[:k]
+        return {'shot': self.shots[mask][order], 'distance': distance[order]}
+
+
+def fit_frame_basis(shot_numbers, path_shots, rank: int=32, device='2', dark=None, block: int=512):
+    """
+    SpectralBasis of the individual frames of many shots.
+
+    Parameters:
+    - shot_numbers: List of shot numbers.
+    - path_shots: Path to the directory containing the shot files.
+    - rank: Number of components.
+    - device: Device key in data['spectra'].
+    - dark: Optional DarkLibrary.
+    - block: Frames per incremental update.
+    """
+    basis = SpectralBasis(rank)
+    for shot in shot_numbers:
+        spectra = shot_background(load_shot(shot, path_shots), device, dark)
+        for start in range(0, len(spectra), block):
+            frames = spectra[start:start + block]
+            if len(frames) > 1:
+                basis.partial_fit(frames)
+    return basis
+
+
+def compress_shot(data, basis, device='2', dark=None):
+    """
+    Lossy low-rank representation of a shot for quick-look previews.
+
+    Returns:
+    - compressed: Dictionary with 'coefficients' (frames, rank) float32,
+      'time' (frames,) and the relative 'residual' of the reconstruction.
+    """
+    spectra = shot_background(data, device, dark)
+    coefficients = basis.transform(spectra)
+    residual = np.linalg.norm(spectra - basis.inverse_transform(coefficients)) / max(np.linalg.norm(spectra), 1e-12)
+    time_array = device_time(data, device)
+    return {'coefficients': coefficients.astype(np.float32), 'time': time_array - time_array[0],
+            'residual': float(residual)}
+
+
+def preview(compressed, basis, frames=None):
+    """
+    Spectra rebuilt from compress_shot, optionally only some frames.
+    """
+    coefficients = compressed['coefficients'] if frames is None else compressed['coefficients'][frames]
+    return basis.inverse_transform(coefficients)
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    index = SimilarityIndex(os.path.join(path_shots, 'similarity.npz'))
+    print(f'Embedded {len(index.ingest(path_shots))} new shots')
+    index.save()
+    print(index.nearest("000211", k=5))
@@ -0,0 +1,217 @@
+import numpy as np
+import os
+from collections import OrderedDict
+import sys
+from scipy import sparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.check import device_time, device_wave
+from peaks.align import align_shot
+from plots.aniplot import load_shot
+from src.com.dark import shot_background
+from src import tracing
+
+
+def device_waves(data, cal=None, drift: bool=False):
+    """
+    Wavelength axis of every device of a shot.
+
+    Shots saved before the per-device axes were stored only have the axis
+    of the first device, which is then used for all of them.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - cal: Optional dictionary device -> (slope, intercept) correcting the axes.
+    - drift: Remove the wavelength drift stored with the shot, if any. The
+      corrected axes differ from shot to shot, so the cached Stitchers and
+      templates are not reused with it.
+
+    Returns:
+    - waves: Dictionary device -> wavelength array (nm).
+    """
+    waves = {}
+    for device in data['spectra']:
+        wave = device_wave(data, device, drift)
+        if cal is not None and device in cal:
+            slope, intercept = cal[device]
+            wave = wave * slope + intercept
+        waves[device] = wave
+    return waves
+
+
+def common_grid(waves, step: float=None):
+    """
+    Uniform wavelength grid covering all the devices.
+
+    Parameters:
+    - waves: Dictionary device -> wavelength array.
+    - step: Grid spacing in nm; the finest median pixel spacing if None.
+    """
+    if step is None:
+        step = min(np.median(np.diff(wave)) for wave in waves.values())
+    w_min = min(wave[0] for wave in waves.values())
+    w_max = max(wave[-1] for wave in waves.values())
+    return w_min + step * np.arange(int(np.floor((w_max - w_min) / step)) + 1)
+
+
+def resampling_matrix(wave, grid):
+    """
+    Sparse linear interpolation from a device axis onto the grid.
+
+    Grid points outside the device range get an empty column.
+
+    Returns:
+    - R: scipy.sparse CSC matrix of shape (pixels, grid), so that
+      spectra @ R interpolates every frame.
+    """
+    inside = np.flatnonzero((grid >= wave[0]) & (grid <= wave[-1]))
+    right = np.clip(np.searchsorted(wave, grid[inside], side='right'), 1, len(wave) - 1)
+    left = right - 1
+    fraction = (grid[inside] - wave[left]) / (wave[right] - wave[left])
+    rows = np.concatenate((left, right))
+    cols = np.concatenate((inside, inside))
+    values = np.concatenate((1 - fraction, fraction))
+    return sparse.csc_matrix((values, (rows, cols)), shape=(len(wave), len(grid)))
+
+
+def overlap_weights(waves, grid, taper: float=None):
+    """
+    Weight of every device on every grid point, summing one where covered.
+
+    Inside an overlap the weight of a device falls linearly towards its
+    range edge, so the stitched spectrum fades from one device to the
+    next instead of jumping at a cut.
+
+    Parameters:
+    - waves: Dictionary device -> wavelength array.
+    - grid: Common wavelength grid.
+    - taper: Distance (nm) from the range edge over which the weight
+      rises; the whole overlap if None.
+
+    Returns:
+    - weights: Dictionary device -> (grid,) array.
+    """
+    distance = {}
+    for device, wave in waves.items():
+        d = np.minimum(grid - wave[0], wave[-1] - grid)
+        if taper is not None:
+            d = np.minimum(d, taper)
+        # Points exactly on the edge still count
+        distance[device] = np.where(d >= 0, np.maximum(d, 1e-12), 0.0)
+    total = sum(distance.values())
+    total[total == 0] = 1
+    return {device: d / total for device, d in distance.items()}
+
+
+class Stitcher:
+    """
+    Combines the spectra of all the devices onto a common wavelength grid.
+
+    The resampling and overlap weights of every device are folded into a
+    single sparse matrix of shape (all pixels, grid), built once per set
+    of axes (calibration). A stitched shot is then one matrix product of
+    the horizontally stacked (frames, pixels) blocks.
+
+    Parameters:
+    - waves: Dictionary device -> wavelength array (see device_waves).
+    - grid: Common grid; common_grid(waves, step) if None.
+    - step: Grid spacing in nm when grid is None.
+    - taper: See overlap_weights.
+    """
+
+    def __init__(self, waves, grid=None, step: float=None, taper: float=None):
+        self.devices = list(waves)
+        self.grid = common_grid(waves, step) if grid is None else np.asarray(grid, dtype=float)
+        self.pixels = [len(waves[device]) for device in self.devices]
+        weights = overlap_weights(waves, self.grid, taper)
+        blocks = [resampling_matrix(waves[device], self.grid) @ sparse.diags(weights[device])
+                  for device in self.devices]
+        self.M = sparse.vstack(blocks, format='csc')
+        self.coverage = sum(weights.values()) > 0
+
+    def apply(self, spectra):
+        """
+        Stitched spectra.
+
+        Parameters:
+        - spectra: Dictionary device -> (frames, pixels) array. Devices
+          with fewer frames limit the number of stitched frames.
+
+        Returns:
+        - stitched: (frames, grid) array, zero outside every device range.
+        """
+        n_frames = min(len(spectra[device]) for device in self.devices)
+        stacked = np.hstack([np.asarray(spectra[device], dtype=float)[:n_frames]
+                             for device in self.devices])
+        # (M.T @ stacked.T).T keeps the sparse matrix on the left
+        return np.asarray((self.M.T @ stacked.T).T)
+
+
+# Least recently used Stitchers, bounded as drift corrected axes never repeat
+_stitchers = OrderedDict()
+MAX_STITCHERS = 8
+
+
+def stitcher_for(waves, **kwargs):
+    # One Stitcher per set of device axes and settings
+    key = (tuple((device, wave.tobytes()) for device, wave in waves.items()),
+           tuple(sorted(kwargs.items())))
+    if key in _stitchers:
+        _stitchers.move_to_end(key)
+    else:
+        _stitchers[key] = Stitcher(waves, **kwargs)
+        if len(_stitchers) > MAX_STITCHERS:
+            _stitchers.popitem(last=False)
+    return _stitchers[key]
+
+
+@tracing.traced('stitch_shot')
+def stitch_shot(data, dark=None, cal=None, stitcher=None, align: bool=False, drift: bool=False,
+                **kwargs):
+    """
+    Background corrected, time-resolved spectrum of all devices combined.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    - cal: Optional dictionary device -> (slope, intercept).
+    - stitcher: Precomputed Stitcher; built (and reused) from the shot axes if None.
+    - align: Resample the devices onto a common timebase first (see
+      peaks/align.py), otherwise frames are combined by index.
+    - drift: Remove the wavelength drift stored with the shot (see device_waves).
+    - **kwargs: grid, step or taper for the Stitcher.
+
+    Returns:
+    - stitched: Dictionary with 'wave' (grid,), 'spectra' (frames, grid)
+      and 'time' (frames,) from the first device.
+    """
+    if align:
+        data = align_shot(data)
+    if stitcher is None:
+        stitcher = stitcher_for(device_waves(data, cal, drift), **kwargs)
+    spectra = {device: shot_background(data, device, dark) for device in stitcher.devices}
+    stitched = stitcher.apply(spectra)
+    time_array = device_time(data, stitcher.devices[0])[:len(stitched)]
+    return {
+        'wave': stitcher.grid,
+        'spectra': stitched,
+        'time': time_array - time_array[0],
+    }
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+
+    shot_number = "000211"
+    stitched = stitch_shot(load_shot(shot_number, path_shots))
+    fig, ax = plt.subplots()
+    ax.plot(stitched['wave'], stitched['spectra'].max(axis=0), lw=1, color='black')
+    ax.set_xlabel(r'$\lambda$ (nm)')
+    ax.set_ylabel('Counts')
+    ax.set_title(f'Stitched max spectrum, shot {shot_number}')
+    ax.set_yscale('log')
+    plt.show()
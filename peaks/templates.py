@@ -0,0 +1,239 @@
+import numpy as np
+import json
+import os
+import sys
+from collections import OrderedDict
+from scipy.signal import fftconvolve
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.load_NIST import load_NIST_data
+from peaks.check import device_time
+from peaks.stitch import device_waves
+from plots.aniplot import load_shot
+from src.com.dark import shot_background
+from src import tracing
+
+
+def species_lines(lines_files, species):
+    """
+    Tabulated lines of every species.
+
+    Returns:
+    - lines: Dictionary species -> (wave (nm), intensity) arrays.
+    """
+    wave, spec, intensity = [], [], []
+    for line_file in lines_files:
+        line_data = load_NIST_data(line_file)
+        wave.append(np.array(line_data['Wavelength']) * 1e-1)  # Convert from A to nm
+        spec.append(np.array(line_data['Species']))
+        intensity.append(np.array(line_data['Intensity']))
+    wave, spec, intensity = np.concatenate(wave), np.concatenate(spec), np.concatenate(intensity)
+    return {s: (wave[spec == s], intensity[spec == s]) for s in species}
+
+
+def instrument_kernel(step: float, fwhm: float):
+    # Gaussian instrument function sampled every step nm, unit area
+    sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    x = step * np.arange(-int(np.ceil(4 * sigma / step)), int(np.ceil(4 * sigma / step)) + 1)
+    kernel = np.exp(-0.5 * (x / sigma)**2)
+    return kernel / kernel.sum()
+
+
+def synthesize_templates(wavelengths, lines_files, species, fwhm: float=0.3, oversample: int=4):
+    """
+    Synthetic spectrum of every species on a device axis.
+
+    The tabulated lines are placed as sticks on a fine uniform grid,
+    convolved with the instrument function (FFT) and interpolated onto
+    the device pixels. Every template is scaled to unit peak.
+
+    Parameters:
+    - wavelengths: Wavelength axis of the device (nm, ascending).
+    - lines_files: List of paths to NIST-like line files.
+    - species: Species to synthesize (e.g. ['Ar I', 'Ar II']).
+    - fwhm: Instrument function full width at half maximum in nm.
+    - oversample: Fine grid points per device pixel.
+
+    Returns:
+    - templates: Dictionary with 'wave' (pixels,), 'species' and
+      'T' (species, pixels); species without lines in range are dropped.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    step = np.min(np.diff(wavelengths)) / oversample
+    margin = 4 * fwhm
+    fine = wavelengths[0] - margin + step * np.arange(
+        int((wavelengths[-1] - wavelengths[0] + 2 * margin) / step) + 2)
+
+    lines = species_lines(lines_files, species)
+    sticks = np.zeros((len(species), len(fine)))
+    for i, s in enumerate(species):
+        wave, intensity = lines[s]
+        inside = (wave >= fine[0]) & (wave < fine[-1])
+        # Split every line between its two neighbouring fine points
+        position = (wave[inside] - fine[0]) / step
+        left = np.floor(position).astype(int)
+        fraction = position - left
+        np.add.at(sticks[i], left, intensity[inside] * (1 - fraction))
+        np.add.at(sticks[i], left + 1, intensity[inside] * fraction)
+
+    fine_spectra = fftconvolve(sticks, instrument_kernel(step, fwhm)[None, :], mode='same', axes=1)
+    T = np.array([np.interp(wavelengths, fine, row) for row in fine_spectra])
+    peak = T.max(axis=1)
+    keep = peak > 0
+    for s in np.array(species)[~keep]:
+        print(f'No {s} lines in {wavelengths[0]:.1f}-{wavelengths[-1]:.1f} nm, template dropped')
+    return {'wave': wavelengths, 'species': np.array(species)[keep], 'T': T[keep] / peak[keep, None]}
+
+
+# Least recently used templates, bounded as drift corrected axes never repeat
+_templates = OrderedDict()
+MAX_TEMPLATES = 8
+
+
+def templates_for(wavelengths, lines_files, species, **kwargs):
+    # Templates are synthesized once per axis (calibration) and settings
+    key = (np.asarray(wavelengths, dtype=float).tobytes(), tuple(lines_files), tuple(species),
+           tuple(sorted(kwargs.items())))
+    if key in _templates:
+        _templates.move_to_end(key)
+    else:
+        _templates[key] = synthesize_templates(wavelengths, lines_files, species, **kwargs)
+        if len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+    return _templates[key]
+
+
+def batched_nnls(A, B, n_iter: int=500, tol: float=1e-6):
+    """
+    Non-negative least squares for many right hand sides at once.
+
+    Solves min ||A x - b|| with x >= 0 for every column b of B with an
+    accelerated projected gradient (FISTA), so all frames advance together
+    with matrix products only.
+
+    Parameters:
+    - A: (pixels, components) matrix.
+    - B: (pixels, frames) matrix.
+    - n_iter: Maximum number of iterations.
+    - tol: Stop when the relative change of the solution is below tol.
+
+    Returns:
+    - X: (components, frames) non-negative solution.
+    """
+    norms = np.linalg.norm(A, axis=0)
+    norms[norms == 0] = 1
+    A = A / norms
+    G = A.T @ A
+    C = A.T @ B
+    L = np.linalg.eigvalsh(G)[-1]
+    X = np.maximum(np.linalg.lstsq(G, C, rcond=None)[0], 0)
+    Y, t = X, 1.0
+    for _ in range(n_iter):
+        X_new = np.maximum(Y - (G @ Y - C) / L, 0)
+        t_new = (1 + np.sqrt(1 + 4 * t**2)) / 2
+        Y = X_new + (t - 1) / t_new * (X_new - X)
+        change = np.linalg.norm(X_new - X) / max(np.linalg.norm(X_new), 1e-12)
+        X, t = X_new, t_new
+        if change < tol:
+            break
+    return X / norms[:, None]
+
+
+@tracing.traced('species_abundances')
+def species_abundances(data, templates, device='2', dark=None, baseline: bool=True, **kwargs):
+    """
+    Decompose every frame of a shot into species templates.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - templates: Output of synthesize_templates for this device axis.
+    - device: Device key in data['spectra'].
+    - dark: Optional DarkLibrary; without it the first frame is the background.
+    - baseline: Fit a flat continuum too, so it is not taken as lines.
+    - **kwargs: n_iter and tol for batched_nnls.
+
+    Returns:
+    - abundances: Dictionary with 'time' (frames,), 'abundance'
+      (frames, species) in counts at the template peak, 'species',
+      'baseline' (frames,) and the relative 'residual' (frames,).
+    """
+    spectra = shot_background(data, device, dark)
+    A = templates['T'].T
+    if baseline:
+        A = np.hstack((A, np.ones((len(A), 1))))
+    X = batched_nnls(A, spectra.T, **kwargs)
+    residual = np.linalg.norm(spectra.T - A @ X, axis=0) / np.maximum(np.linalg.norm(spectra, axis=1), 1e-12)
+    time_array = device_time(data, device)
+    n_species = len(templates['species'])
+    return {
+        'time': time_array - time_array[0],
+        'abundance': X[:n_species].T,
+        'species': templates['species'],
+        'baseline': X[n_species] if baseline else np.zeros(len(spectra)),
+        'residual': residual,
+    }
+
+
+def campaign_abundances(shot_numbers, path_shots, lines_files, species, device='2', cal=None,
+                        fwhm: float=0.3, dark=None, drift: bool=False, **kwargs):
+    """
+    Species abundance time series of many shots, synthesizing the
+    templates once per device axis.
+
+    Parameters:
+    - shot_numbers: List of shot numbers.
+    - path_shots: Path to the directory containing the shot files.
+    - lines_files: List of paths to NIST-like line files.
+    - species: Species to decompose into.
+    - device: Device key in data['spectra'].
+    - cal: Optional path to a calibration json (slope, intercept).
+    - fwhm: Instrument function FWHM in nm.
+    - dark: Optional DarkLibrary.
+    - drift: Remove the wavelength drift stored with each shot; the templates
+      are then synthesized for every shot.
+    - **kwargs: Passed to species_abundances.
+
+    Returns:
+    - abundances: Dictionary shot_number -> species_abundances output.
+    """
+    calibration = None
+    if cal is not None:
+        with open(cal, 'r') as f:
+            cal_data = json.load(f)
+        calibration = {device: (cal_data['slope'], cal_data['intercept'])}
+    abundances = {}
+    for shot in shot_numbers:
+        try:
+            data = load_shot(shot, path_shots)
+        except FileNotFoundError as e:
+            print(f"Error loading shot {shot}: {e}")
+            continue
+        wavelengths = device_waves(data, calibration, drift)[device]
+        templates = templates_for(wavelengths, lines_files, species, fwhm=fwhm)
+        abundances[shot] = species_abundances(data, templates, device=device, dark=dark, **kwargs)
+    return abundances
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    path_peaks = os.path.dirname(os.path.abspath(__file__))
+
+    lines_files = [os.path.join(path_peaks, 'ArNIST.txt'),
+                   os.path.join(path_peaks, 'NNIST.txt'),
+                   os.path.join(path_peaks, 'ONIST.txt')]
+    species = ['Ar I', 'Ar II', 'N I', 'N II', 'O I']
+    abundances = campaign_abundances(["000181", "000210", "000211"], path_shots, lines_files, species,
+                                     cal=os.path.join(path_peaks, 'cal.json'))
+    for shot, result in abundances.items():
+        fig, ax = plt.subplots()
+        for i, s in enumerate(result['species']):
+            ax.plot(result['time'], result['abundance'][:, i], label=s)
+        ax.set_xlabel('Time (s)')
+        ax.set_ylabel('Abundance (counts)')
+        ax.set_title(f'Shot: {shot}')
+        ax.legend()
+    plt.show()
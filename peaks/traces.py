@@ -0,0 +1,196 @@
+import numpy as np
+import json
+import os
+import sys
+from scipy import sparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.load_NIST import load_NIST_data
+from peaks.check import device_time
+from plots.aniplot import load_shot
+
+
+def select_lines(lines_files, species=None, wave_range=None, min_intensity=0.0,
+                 min_separation=0.0):
+    """
+    Load the tabulated lines to trace.
+
+    Parameters:
+    - lines_files: List of paths to NIST-like line files.
+    - species: Species to keep (e.g. ['Ar I', 'Ar II']); all if None.
+    - wave_range: Optional (min, max) in nm, usually the device range.
+    - min_intensity: Minimum tabulated intensity.
+    - min_separation: Lines closer than this (nm) are blended in the
+      spectrometer; only the most intense one is kept.
+
+    Returns:
+    - lines: Dictionary with 'wave' (nm), 'species' and 'intensity' arrays
+      sorted by wavelength.
+    """
+    wave, spec, intensity = [], [], []
+    for line_file in lines_files:
+        line_data = load_NIST_data(line_file)
+        wave.append(np.array(line_data['Wavelength']) * 1e-1)  # Convert from A to nm
+        spec.append(np.array(line_data['Species']))
+        intensity.append(np.array(line_data['Intensity']))
+    wave = np.concatenate(wave)
+    spec = np.concatenate(spec)
+    intensity = np.concatenate(intensity)
+
+    mask = intensity >= min_intensity
+    if species is not None:
+        mask &= np.isin(spec, species)
+    if wave_range is not None:
+        mask &= (wave >= wave_range[0]) & (wave <= wave_range[1])
+    wave, spec, intensity = wave[mask], spec[mask], intensity[mask]
+
+    if min_separation > 0 and len(wave):
+        # Visit lines from the most intense and drop the ones too close to a kept one
+        keep = np.zeros(len(wave), dtype=bool)
+        kept = []
+        for i in np.argsort(-intensity, kind='stable'):
+            if not kept or np.min(np.abs(np.array(kept) - wave[i])) >= min_separation:
+                keep[i] = True
+                kept.append(wave[i])
+        wave, spec, intensity = wave[keep], spec[keep], intensity[keep]
+
+    order = np.argsort(wave)
+    return {'wave': wave[order], 'species': spec[order], 'intensity': intensity[order]}
+
+
+def _window_indices(wavelengths, lo, hi):
+    # Pixels with lo <= wavelength <= hi for every (lo, hi) pair, as flat
+    # (line index, pixel index) arrays
+    start = np.searchsorted(wavelengths, lo, side='left')
+    stop = np.searchsorted(wavelengths, hi, side='right')
+    counts = np.maximum(stop - start, 0)
+    rows = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, np.repeat(start, counts) + offsets, counts
+
+
+def line_windows(wavelengths, lines, half_width: float=0.4, gap: float=0.3,
+                 bg_width: float=0.6):
+    """
+    Build the sparse matrix integrating every line over its pixel window.
+
+    For every line the signal window is |lambda - line| <= half_width and
+    the background windows are the bg_width wide bands starting gap nm
+    beyond it on both sides. The background mean is scaled to the number
+    of signal pixels and subtracted, so spectra @ W gives the background
+    corrected integrated counts of every line.
+
+    Parameters:
+    - wavelengths: Wavelength axis of the device (nm, ascending).
+    - lines: Line wavelengths in nm.
+    - half_width, gap, bg_width: Window sizes in nm.
+
+    Returns:
+    - W: scipy.sparse CSC matrix of shape (pixels, lines).
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    lines = np.asarray(lines, dtype=float)
+    n_pixels, n_lines = len(wavelengths), len(lines)
+
+    sig_rows, sig_cols, n_sig = _window_indices(wavelengths, lines - half_width, lines + half_width)
+    inner, outer = half_width + gap, half_width + gap + bg_width
+    left_rows, left_cols, n_left = _window_indices(wavelengths, lines - outer, lines - inner)
+    right_rows, right_cols, n_right = _window_indices(wavelengths, lines + inner, lines + outer)
+
+    n_bg = n_left + n_right
+    bg_weight = np.where(n_bg > 0, -n_sig / np.maximum(n_bg, 1), 0.0)
+    rows = np.concatenate((sig_rows, left_rows, right_rows))
+    cols = np.concatenate((sig_cols, left_cols, right_cols))
+    values = np.concatenate((np.ones(len(sig_rows)), bg_weight[left_rows], bg_weight[right_rows]))
+    return sparse.csc_matrix((values, (cols, rows)), shape=(n_pixels, n_lines))
+
+
+def line_traces(data, lines, device='2', W=None, cal=None, **kwargs):
+    """
+    Time evolution of the integrated intensity of every line in a shot.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - lines: Dictionary from select_lines.
+    - device: Device key in data['spectra'].
+    - W: Precomputed line_windows matrix for this wavelength axis.
+    - cal: Optional path to a calibration json (slope, intercept).
+    - **kwargs: Window sizes passed to line_windows.
+
+    Returns:
+    - traces: Dictionary with 'time' (frames,), 'traces' (frames, lines)
+      and the line 'wave', 'species' and 'intensity'.
+    """
+    spectra = np.asarray(data['spectra'][device], dtype=float)
+    if W is None:
+        W = line_windows(calibrated_wave(data, cal, device), lines['wave'], **kwargs)
+    time_array = device_time(data, device)
+    # (W.T @ spectra.T).T keeps the sparse matrix on the left
+    traces = np.asarray((W.T @ spectra.T).T)
+    return {
+        'time': time_array - time_array[0],
+        'traces': traces,
+        'wave': lines['wave'],
+        'species': lines['species'],
+        'intensity': lines['intensity'],
+    }
+
+
+def calibrated_wave(data, cal=None, device='2'):
+    # Axis of the device itself; older shots only store the first one
+    wavelengths = np.asarray(data.get('waves', {}).get(device, data['wave']), dtype=float)
+    if cal is not None:
+        with open(cal, 'r') as f:
+            cal_data = json.load(f)
+        wavelengths = wavelengths * cal_data['slope'] + cal_data['intercept']
+    return wavelengths
+
+
+def campaign_traces(shot_numbers, path_shots, lines, device='2', cal=None, **kwargs):
+    """
+    Line traces of many shots, building the window matrix once per axis.
+
+    Parameters:
+    - shot_numbers: List of shot numbers.
+    - path_shots: Path to the directory containing the shot files.
+    - lines: Dictionary from select_lines.
+    - device: Device key in data['spectra'].
+    - cal: Optional path to a calibration json.
+    - **kwargs: Window sizes passed to line_windows.
+
+    Returns:
+    - traces: Dictionary shot_number -> line_traces output.
+    """
+    windows = {}
+    traces = {}
+    for shot in shot_numbers:
+        try:
+            data = load_shot(shot, path_shots)
+        except FileNotFoundError as e:
+            print(f"Error loading shot {shot}: {e}")
+            continue
+        wavelengths = calibrated_wave(data, cal, device)
+        key = wavelengths.tobytes()
+        if key not in windows:
+            windows[key] = line_windows(wavelengths, lines['wave'], **kwargs)
+        traces[shot] = line_traces(data, lines, device=device, W=windows[key])
+    return traces
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    path_peaks = os.path.dirname(os.path.abspath(__file__))
+
+    lines = select_lines([os.path.join(path_peaks, 'ArNIST.txt'),
+                          os.path.join(path_peaks, 'NNIST.txt'),
+                          os.path.join(path_peaks, 'ONIST.txt')],
+                         species=['Ar I', 'Ar II', 'N I', 'N II', 'O I'],
+                         min_intensity=100, min_separation=0.8)
+    traces = campaign_traces(["000181", "000210", "000211"], path_shots, lines,
+                             cal=os.path.join(path_peaks, 'cal.json'))
+    for shot, trace in traces.items():
+        strongest = np.argmax(trace['traces'].max(axis=0))
+        print(f"Shot {shot}: {trace['traces'].shape}, strongest line "
+              f"{trace['species'][strongest]} {trace['wave'][strongest]:.2f} nm")
@@ -3,6 +3,12 @@ import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import json
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.com.dark import shot_background
+from src import tracing
 
 
 def load_data(file_path):
@@ -19,24 +25,29 @@ def load_data(file_path):
         data = json.load(f)
     return data
 
+@tracing.traced('load_shot')
 def load_shot(shot_number, path_shots):
     """
     Load the spectra data for a specific shot number.
 
     Parameters:
     - shot_number: The shot number to load.
-    - path_shots: Path to the directory containing the shot files.
+    - path_shots: Path to the directory containing the shot files, or the
+      url of a shot data server (src/server/shots.py).
 
     Returns:
     - data: Dictionary containing 'wave', 'spectra', and 'time'.
     """
+    if str(path_shots).startswith(('http://', 'https://')):
+        from src.server.shots import fetch_shot
+        return fetch_shot(shot_number, path_shots)
     file_path = os.path.join(path_shots, f'{shot_number}.json')
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File {file_path} does not exist.")
     return load_data(file_path)
 
 
-def animate_spectra(data, shot_number=None, save_path=None, t_min=None, t_max=None):
+def animate_spectra(data, shot_number=None, save_path=None, t_min=None, t_max=None, dark=None):
     """
     Create an animation of the spectra data, optionally cropped in time.
 
@@ -46,14 +57,15 @@ def animate_spectra(data, shot_number=None, save_path=None, t_min=None, t_max=No
     - save_path: Optional path to save the animation.
     - t_min: Optional minimum time for cropping (in seconds).
     - t_max: Optional maximum time for cropping (in seconds).
+    - dark: Optional DarkLibrary; without it the first frame is the background.
     """
+    from peaks.check import device_time
+
     wavelengths = np.array(data['wave'])
-    spectra = np.array(data['spectra']['2'])
-    time_array = np.array(data['time'])
+    time_array = device_time(data, '2')
 
     # Normalize and align time
-    spectra = spectra - spectra[0, :]
-    spectra = np.clip(spectra, 0, None)
+    spectra = shot_background(data, '2', dark)
     time_array = time_array - time_array[0]
 
     # Apply time cropping
@@ -12,10 +12,48 @@ from peaks.load_NIST import load_NIST_data
 from scipy.signal import find_peaks
 from plots.aniplot import load_data, load_shot
 from peaks.check import multimax, compare_peaks_with_nist, multisum
+from peaks.cache import ProductCache
+from src import tracing
+
+traced_find_peaks = tracing.traced('find_peaks')(find_peaks)
+
+
+def decimate_minmax(x, y, n_bins: int):
+    """
+    Reduce a trace to the minimum and maximum of n_bins pixel bins.
+
+    Keeps every peak visible when the trace has more points than the
+    screen has pixels.
+
+    Args:
+        x (array): X values.
+        y (array): Y values.
+        n_bins (int): Number of bins, usually the plot width in pixels.
+
+    Returns:
+        x, y (array): Decimated trace with 2*n_bins points at most.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(y) <= 2 * n_bins:
+        return x, y
+    size = -(-len(y) // n_bins)
+    n_full = len(y) // size
+    blocks = y[:n_full * size].reshape(n_full, size)
+    offsets = np.arange(n_full) * size
+    index = np.stack((offsets + np.argmin(blocks, axis=1),
+                      offsets + np.argmax(blocks, axis=1)), axis=1)
+    index = np.sort(index, axis=1).ravel()
+    if n_full * size < len(y):
+        tail = np.arange(n_full * size, len(y))
+        index = np.concatenate((index, tail[[np.argmin(y[tail]), np.argmax(y[tail])]]))
+    index = np.unique(index)
+    return x[index], y[index]
 
 def plot_max_spectra(shot_number, path_shots: str, lines_files: list, spec: dict, 
                      ylim: list=[1e0, 5e5], min_peak: float=0.01, cal=None, 
-                     sum=False, log=True, **kwargs):
+                     sum=False, log=True, cache=None, show=True, dpi=900,
+                     save_dir=None, decimate=None, dark=None, drift=True, **kwargs):
     """
     Plot the maximum spectra from a shot file.
 
@@ -26,16 +64,33 @@ def plot_max_spectra(shot_number, path_shots: str, lines_files: list, spec: dict
         spec (dict): Species to check with its respective color for plot.
         ylim (list): Y-axis limits for the plot.
         min_peak (float): Minimum peak height as a fraction of the maximum spectrum to consider a peak.
+        cache (ProductCache): Optional cache reusing the max spectrum, peaks and matches of previous runs.
+        show (bool): Show the figure; False for headless use.
+        dpi (int): Resolution of the saved figure.
+        save_dir (str): Directory for the figure, Plots inside path_shots by default.
+        decimate (bool or int): Min/max decimate the spectrum before drawing, to one bin per pixel
+            column of the saved axes if True, or to this number of bins.
+        dark (DarkLibrary): Optional dark library; without it the first frame is the background.
+        drift (bool): Remove the wavelength drift stored with the shot before matching the lines.
         **kwargs: Additional keyword arguments for plotting.
     """
     
-    data = load_shot(shot_number, path_shots)
-    
+    shot_file = os.path.join(path_shots, f'{shot_number}.json')
+
+    def cached(stage, params, compute):
+        if cache is None:
+            return compute()
+        return cache.get_or_compute(stage, shot_file, params, compute)
+
+    def compute_max():
+        data = load_shot(shot_number, path_shots)
+        if sum:
+            return multisum([data], dark=dark, drift=drift)
+        return multimax([data], dark=dark, drift=drift)
+
     # Get the maximum spectrum
-    if sum:
-        max_spectra = multisum([data])
-    else:
-        max_spectra = multimax([data])
+    dark_params = {'dark': None if dark is None else dark.signature(), 'drift': drift}
+    max_spectra = cached('sum_spectrum' if sum else 'max_spectrum', dark_params, compute_max)
     # Recalibrate the wavelengths??
     if cal is not None:
         with open(cal, 'r') as f:
@@ -48,7 +103,9 @@ def plot_max_spectra(shot_number, path_shots: str, lines_files: list, spec: dict
     height_threshold = min_peak * ylim[1]  # Adjust height threshold as needed
     # height_threshold = min_peak
     print(f"Analyzing peaks for shot {shot_number[0]}")
-    peaks, _ = find_peaks(max_spectra['spectra'][0], height=height_threshold, distance=3)  # Adjust height threshold as needed
+    peak_params = {'sum': sum, 'height': height_threshold, 'distance': 3, **dark_params}
+    peaks = cached('peaks', peak_params,
+                   lambda: traced_find_peaks(max_spectra['spectra'][0], height=height_threshold, distance=3)[0])  # Adjust height threshold as needed
     peak_wavelengths = max_spectra['wave'][0][peaks]
     peak_counts = max_spectra['spectra'][0][peaks]
     print(f"Number of peaks found: {len(peaks)}")
@@ -56,52 +113,66 @@ def plot_max_spectra(shot_number, path_shots: str, lines_files: list, spec: dict
     print(f"Peak wavelengths: {peak_wavelengths}")
     print(f"Peak counts: {peak_counts}")
     
-    # Load tabulated data for lines
-    data_lines = {
-        'Wavelength': np.array([]),
-        'Species': np.array([]),
-        'Intensity': np.array([]),
-        'Ref': np.array([])
-    }
-    for i, line_file in enumerate(lines_files):
-        line_data = load_NIST_data(line_file)
-        data_lines['Wavelength'] = np.concatenate((data_lines['Wavelength'], line_data['Wavelength']))
-        data_lines['Species'] = np.concatenate((data_lines['Species'], line_data['Species']))
-        data_lines['Intensity'] = np.concatenate((data_lines['Intensity'], line_data['Intensity']))
-        data_lines['Ref'] = np.concatenate((data_lines['Ref'], line_data['Ref']))
+    def compute_matches():
+        # Load tabulated data for lines
+        data_lines = {
+            'Wavelength': np.array([]),
+            'Species': np.array([]),
+            'Intensity': np.array([]),
+            'Ref': np.array([])
+        }
+        for i, line_file in enumerate(lines_files):
+            line_data = load_NIST_data(line_file)
+            data_lines['Wavelength'] = np.concatenate((data_lines['Wavelength'], line_data['Wavelength']))
+            data_lines['Species'] = np.concatenate((data_lines['Species'], line_data['Species']))
+            data_lines['Intensity'] = np.concatenate((data_lines['Intensity'], line_data['Intensity']))
+            data_lines['Ref'] = np.concatenate((data_lines['Ref'], line_data['Ref']))
+        
+        # Compare peaks with data
+        return compare_peaks_with_nist(peaks, peak_wavelengths, peak_counts, data_lines, species=list(spec.keys()))
+
+    match_params = {**peak_params, 'cal': cal, 'lines_files': list(lines_files),
+                    'species': list(spec.keys())}
+    data_spec = cached('matches', match_params, compute_matches)
     
-    # Compare peaks with data
-    data_spec = compare_peaks_with_nist(peaks, peak_wavelengths, peak_counts, data_lines, species=list(spec.keys()))
+    with tracing.span('plot', shot=shot_number):
+        fig, ax = plt.subplots()
+        # Plot the maximum spectrum
+        wave_plot, spectrum_plot = max_spectra['wave'][0], max_spectra['spectra'][0]
+        if decimate:
+            # Width of the axes in the saved image, not in the screen figure
+            n_bins = int(ax.bbox.width * dpi / fig.dpi) if decimate is True else int(decimate)
+            wave_plot, spectrum_plot = decimate_minmax(wave_plot, spectrum_plot, n_bins)
+        ax.plot(wave_plot, spectrum_plot, lw=2, label='Spectrum', color='black')
+        # Set how precise are the peaks
+        tolerance = 1.2  # nm tolerance for peak matching
+        for i, key in enumerate(spec.keys()):
+            color = spec[key]
+            mask = abs(data_spec[key]['delta']) < tolerance
+            ax.scatter(data_spec[key]['wave'][mask], 
+                       data_spec[key]['counts'][mask], 
+                       label=f'{key}', marker='x', 
+                       color=color, zorder=i+5, s=50)
+        # Set the legend outside the plot
+        ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize='small')
+        ax.set_xlabel(r'$\lambda$ (nm)')
+        ax.set_ylabel('Counts')
+        if log:
+            ax.set_yscale('log')
+        ax.set_ylim(ylim[0], ylim[1])
+        ax.set_title('Shot: ' + shot_number)
+        ax.set_xlim(np.min(max_spectra['wave'][0]), np.max(max_spectra['wave'][0]))
+        if show:
+            plt.show()
     
-    fig, ax = plt.subplots()
-    # Plot the maximum spectrum
-    ax.plot(max_spectra['wave'][0], max_spectra['spectra'][0], lw=2, label='Spectrum', color='black')
-    # Set how precise are the peaks
-    tolerance = 1.2  # nm tolerance for peak matching
-    for i, key in enumerate(spec.keys()):
-        color = spec[key]
-        mask = abs(data_spec[key]['delta']) < tolerance
-        ax.scatter(data_spec[key]['wave'][mask], 
-                   data_spec[key]['counts'][mask], 
-                   label=f'{key}', marker='x', 
-                   color=color, zorder=i+5, s=50)
-    # Set the legend outside the plot
-    ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize='small')
-    ax.set_xlabel(r'$\lambda$ (nm)')
-    ax.set_ylabel('Counts')
-    if log:
-        ax.set_yscale('log')
-    ax.set_ylim(ylim[0], ylim[1])
-    ax.set_title('Shot: ' + shot_number)
-    ax.set_xlim(np.min(max_spectra['wave'][0]), np.max(max_spectra['wave'][0]))
-    plt.show()
-    
-    fig.savefig(os.path.join(path_shots, 'Plots', f'{shot_number}_max_spectrum.png'), dpi=900, bbox_inches='tight')
+        if save_dir is None:
+            save_dir = os.path.join(path_shots, 'Plots')
+        fig.savefig(os.path.join(save_dir, f'{shot_number}_max_spectrum.png'), dpi=dpi, bbox_inches='tight')
     # fig.savefig(os.path.join(path_shots, 'Plots', f'{shot_number}_max_spectrum.svg'), bbox_inches='tight')
 
     return data_spec, max_spectra
 
-def barplotcheck(wave: np.array=None, counts: np.array=None, intensity: np.array=None, delta: np.array=None, **kwargs):
+def barplotcheck(wave: np.array=None, counts: np.array=None, intensity: np.array=None, delta: np.array=None, show=True, **kwargs):
     """
     Create a bar plot to compare measured peaks with tabulated intensities.
 
@@ -110,6 +181,7 @@ def barplotcheck(wave: np.array=None, counts: np.array=None, intensity: np.array
         counts (array): Measured counts.
         intensity (array): Tabulated intensities.
         delta (array): Difference between measured and tabulated wavelengths.
+        show (bool): Show the figure; False for headless use.
         **kwargs: Additional keyword arguments for plotting.
     """
     fig, ax = plt.subplots()
@@ -131,7 +203,8 @@ def barplotcheck(wave: np.array=None, counts: np.array=None, intensity: np.array
     ax.legend(loc='upper left')
     ax_t.legend(loc='upper right')  
     plt.tight_layout()
-    plt.show()
+    if show:
+        plt.show()
     
     return fig, ax, ax_t
 
@@ -151,6 +224,8 @@ if __name__ == "__main__":
     
     # Callibration file paths
     cal_file_path = os.path.join(path_spectrometer, 'OOSpec_Control', 'peaks', 'cal.json')
+    # Derived products of previous runs, only what changed is recomputed
+    cache = ProductCache(os.path.join(path_shots, 'Cache'))
 
     # Define the colors for each species
     
@@ -185,7 +260,7 @@ if __name__ == "__main__":
         data_list[shot] = plot_max_spectra(shot, path_shots, line_files, 
                                            colors, ylim=[1e1, 5e4], 
                                            min_peak=0.001, cal=cal_file_path, 
-                                           sum=False, log=True)[0]
+                                           sum=False, log=True, cache=cache)[0]
         
         
     
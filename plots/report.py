@@ -0,0 +1,159 @@
+import os
+import sys
+import html
+import time
+import matplotlib
+# Headless: must be selected before pyplot is imported, also in the workers
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plots.plot import plot_max_spectra, barplotcheck
+from peaks.cache import ProductCache
+
+
+def plot_species_matches(data_spec, spec: dict, shot_number=None, log=True):
+    """
+    Stem plot of the matched lines of every species.
+
+    Parameters:
+    - data_spec: Output of compare_peaks_with_nist.
+    - spec: Species to plot with their colors.
+    - shot_number: Optional shot number for the title.
+    - log: Use a logarithmic counts axis.
+
+    Returns:
+    - fig, ax: Matplotlib figure and axis.
+    """
+    fig, ax = plt.subplots()
+    for key, color in spec.items():
+        wave = data_spec[key]['wave']
+        counts = data_spec[key]['counts']
+        if len(wave) == 0:
+            continue
+        ax.vlines(wave, 1, counts, color=color, lw=1.5, label=f'{key} ({len(wave)})')
+        ax.scatter(wave, counts, color=color, s=12)
+    ax.set_xlabel(r'$\lambda$ (nm)')
+    ax.set_ylabel('Counts')
+    if log:
+        ax.set_yscale('log')
+    ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize='small')
+    if shot_number is not None:
+        ax.set_title(f'Shot: {shot_number} matched lines')
+    return fig, ax
+
+
+def render_shot(shot_number, path_shots, lines_files, spec, out_dir, decimate=True,
+                dpi=150, cache_dir=None, **kwargs):
+    """
+    Render the figures of one shot without opening any window.
+
+    Parameters:
+    - shot_number: Shot to render.
+    - path_shots: Path to the directory containing the shot files.
+    - lines_files: Line files passed to plot_max_spectra.
+    - spec: Species with their colors.
+    - out_dir: Directory where the PNG files are written.
+    - decimate: Min/max decimate the spectrum to the pixel width of the
+      saved axes (True), to a number of bins, or not at all (False).
+    - dpi: Resolution of the saved figures.
+    - cache_dir: Optional ProductCache directory shared by the workers.
+    - **kwargs: Passed to plot_max_spectra (ylim, min_peak, cal, ...).
+
+    Returns:
+    - files: List of the written file names (relative to out_dir).
+    """
+    cache = ProductCache(cache_dir) if cache_dir else None
+    files = [f'{shot_number}_max_spectrum.png']
+    try:
+        data_spec, _ = plot_max_spectra(shot_number, path_shots, lines_files, spec,
+                                        cache=cache, show=False, dpi=dpi, save_dir=out_dir,
+                                        decimate=decimate, **kwargs)
+        plt.close('all')
+
+        fig, _ = plot_species_matches(data_spec, spec, shot_number)
+        files.append(f'{shot_number}_species.png')
+        fig.savefig(os.path.join(out_dir, files[-1]), dpi=dpi, bbox_inches='tight')
+        plt.close(fig)
+
+        for key in spec:
+            if len(data_spec[key]['wave']) == 0:
+                continue
+            fig, _, _ = barplotcheck(**data_spec[key], show=False)
+            files.append(f"{shot_number}_barcheck_{key.replace(' ', '')}.png")
+            fig.savefig(os.path.join(out_dir, files[-1]), dpi=dpi, bbox_inches='tight')
+            plt.close(fig)
+    finally:
+        plt.close('all')
+    return files
+
+
+def write_index(out_dir, results: dict, errors: dict):
+    rows = []
+    for shot in sorted(results):
+        images = ''.join(f'<a href="{html.escape(f)}"><img src="{html.escape(f)}" height="240"></a>'
+                         for f in results[shot])
+        rows.append(f'<tr><td>{html.escape(shot)}</td><td>{images}</td></tr>')
+    for shot in sorted(errors):
+        rows.append(f'<tr><td>{html.escape(shot)}</td><td>Failed: {html.escape(errors[shot])}</td></tr>')
+    page = ('<html><head><title>Shot report</title></head><body>'
+            f'<h1>Shot report</h1><p>Generated {time.strftime("%Y-%m-%d %H:%M:%S")}</p>'
+            '<table border="1">' + ''.join(rows) + '</table></body></html>')
+    index = os.path.join(out_dir, 'index.html')
+    with open(index, 'w') as f:
+        f.write(page)
+    return index
+
+
+def batch_report(shot_numbers, path_shots, lines_files, spec, out_dir=None, workers=None, **kwargs):
+    """
+    Render the figures of a range of shots in parallel processes.
+
+    Parameters:
+    - shot_numbers: List of shot numbers.
+    - path_shots: Path to the directory containing the shot files.
+    - lines_files: Line files passed to plot_max_spectra.
+    - spec: Species with their colors.
+    - out_dir: Output directory, Report inside path_shots by default.
+    - workers: Number of processes, one per core by default.
+    - **kwargs: Passed to render_shot.
+
+    Returns:
+    - index: Path of the generated index.html.
+    """
+    if out_dir is None:
+        out_dir = os.path.join(path_shots, 'Report')
+    os.makedirs(out_dir, exist_ok=True)
+    results, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(render_shot, shot, path_shots, lines_files, spec, out_dir, **kwargs): shot
+                   for shot in shot_numbers}
+        for future in as_completed(futures):
+            shot = futures[future]
+            try:
+                results[shot] = future.result()
+                print(f'Shot {shot} rendered')
+            except Exception as e:
+                errors[shot] = f'{type(e).__name__}: {e}'
+                print(f'Shot {shot} failed: {errors[shot]}')
+    return write_index(out_dir, results, errors)
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    path_peaks = os.path.join(path_spectrometer, 'OOSpec_Control', 'peaks')
+
+    # python plots/report.py first_shot last_shot
+    first, last = int(sys.argv[1]), int(sys.argv[2])
+    shot_numbers = [f'{n:06d}' for n in range(first, last + 1)
+                    if os.path.exists(os.path.join(path_shots, f'{n:06d}.json'))]
+    colors = {'Ar I': 'orange', 'Ar II': 'yellow'}
+
+    t1 = time.time()
+    index = batch_report(shot_numbers, path_shots, [os.path.join(path_peaks, 'ArNIST.txt')], colors,
+                         cache_dir=os.path.join(path_shots, 'Cache'),
+                         ylim=[1e1, 5e4], min_peak=0.001, cal=os.path.join(path_peaks, 'cal.json'))
+    print(f'Report of {len(shot_numbers)} shots in {time.time() - t1:.1f} s: {index}')
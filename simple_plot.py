@@ -6,6 +6,7 @@ import soundfile as sf
 from scipy.stats import norm
 from scipy.optimize import curve_fit
 from plots.aniplot import load_shot
+from src.com.dark import DarkLibrary, shot_background
 import scipy.constants as cons
 
 def gaussian(x, a, mu, sigma):
@@ -57,6 +58,7 @@ if __name__ == "__main__":
     # Define the path to the shots directory
     path_current = os.path.dirname(os.path.abspath(__file__))
     path_shots = os.path.join(os.path.dirname(path_current), 'Shots')
+    dark = DarkLibrary(os.path.join(path_shots, 'Dark'))
 
     m_He = 6.6464731*1e-27 * cons.c ** 2 / cons.eV
     m_He_uma = 4.002602
@@ -68,9 +70,7 @@ if __name__ == "__main__":
     for shot in shots:
         data = load_shot(shot, path_shots)
         # Remove the background noise
-        spectra = np.array(data['spectra']['2'])
-        spectra = spectra - spectra[0, :]  # Subtract the first frame as background noise
-        spectra = np.clip(spectra, 0, None)  # Ensure no negative values
+        spectra = shot_background(data, '2', dark)  # Stored dark, or the first frame
         
         wavelengths = np.array(data['wave'])  # Assuming the wavelength data is the same for all shots
         
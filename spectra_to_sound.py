@@ -5,6 +5,7 @@ import soundfile as sf
 
 
 from plots.aniplot import load_shot
+from src.com.dark import DarkLibrary, shot_background
 
 def spectra_to_audio(spectra, sample_rate=44100, duration_per_frame=0.01, amplitude_multiplier=1e-6):
     """
@@ -44,6 +45,7 @@ if __name__ == "__main__":
     # Define the path to the shots directory
     path_current = os.path.dirname(os.path.abspath(__file__))
     path_shots = os.path.join(os.path.dirname(path_current), 'Shots')
+    dark = DarkLibrary(os.path.join(path_shots, 'Dark'))
 
 
     for shot in shots:
@@ -55,8 +57,7 @@ if __name__ == "__main__":
             print(f"An error occurred while processing shot {shot}: {e}")
     
         # Remove the bsackground noise
-        spectra = np.array(data['spectra']['2'])
-        spectra = spectra - spectra[0, :]  # Subtract the first frame as background noise
+        spectra = shot_background(data, '2', dark)  # Stored dark, or the first frame
         
         audio = spectra_to_audio(spectra[420:480, ::-1], sample_rate=44100, duration_per_frame=0.04)
         
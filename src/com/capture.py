@@ -0,0 +1,205 @@
+import time
+import threading
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Last capacity frames of every device in preallocated arrays.
+
+    Parameters:
+    - ids: Device ids.
+    - n_pixels: Number of pixels of every device (list in ids order).
+    - capacity: Number of frames kept.
+    """
+
+    __slots__ = ('ids', 'capacity', 'spectra', 'times', 'count', 'position')
+
+    def __init__(self, ids, n_pixels, capacity: int):
+        self.ids = list(ids)
+        self.capacity = capacity
+        self.spectra = [np.empty((capacity, n)) for n in n_pixels]
+        self.times = np.empty((capacity, len(self.ids)))
+        self.count = 0
+        self.position = 0
+
+    def slot(self):
+        # Index to write the next frame into
+        return self.position
+
+    def advance(self):
+        self.position = (self.position + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self):
+        # Indices of the kept frames, oldest first
+        start = (self.position - self.count) % self.capacity
+        return (start + np.arange(self.count)) % self.capacity
+
+
+class OnsetCapture:
+    """
+    Free-running acquisition that keeps only the frames around a discharge.
+
+    The spectrometers are read continuously into a ring buffer of pre
+    frames. The discharge starts when the summed counts of the detection
+    device (within roi) exceed the baseline by threshold standard
+    deviations, and ends after hold consecutive frames below it. The
+    measurement then holds the pre frames, the discharge and post frames.
+
+    Parameters:
+    - OceanHR: Spectrometer object; its measurement receives the window.
+    - pre: Frames kept before the onset.
+    - post: Frames kept after the end.
+    - threshold: Onset level in baseline standard deviations.
+    - level: Absolute onset level in counts, overrides threshold.
+    - roi: Optional (w_min, w_max) in nm used for the detection.
+    - device: Index in OceanHR.devs of the detection device.
+    - baseline_frames: Frames used to estimate the baseline before arming.
+    - hold: Frames below the level needed to end the discharge.
+    - max_frames: Maximum discharge length, the window is closed after it.
+    """
+
+    def __init__(self, OceanHR, pre: int=50, post: int=100, threshold: float=8.0,
+                 level: float=None, roi=None, device: int=0, baseline_frames: int=20,
+                 hold: int=5, max_frames: int=5000):
+        self.OHR = OceanHR
+        self.pre = pre
+        self.post = post
+        self.threshold = threshold
+        self.level = level
+        self.device = device
+        self.baseline_frames = baseline_frames
+        self.hold = hold
+        self.max_frames = max_frames
+        self.cancelled = threading.Event()
+        wavelengths = np.asarray(OceanHR.devs[device].get_wavelengths())
+        if roi is None:
+            self.roi = slice(None)
+        else:
+            self.roi = (wavelengths >= roi[0]) & (wavelengths <= roi[1])
+
+    def intensity(self, spectrum):
+        return float(np.sum(spectrum[self.roi]))
+
+    def cancel(self):
+        # Stop waiting for the onset (a discharge already started is kept)
+        self.cancelled.set()
+
+    def run(self, timeout: float=None):
+        """
+        Acquire until a discharge has been captured.
+
+        Parameters:
+        - timeout: Seconds to wait for the onset, forever if None.
+
+        Returns:
+        - measurement: OceanHR.measurement holding the captured window, None
+          if cancelled before the onset.
+        """
+        OHR = self.OHR
+        readout = [dev.get_formatted_spectrum for dev in OHR.devs]
+        ring = RingBuffer(OHR.ids, OHR.pixels, max(self.pre + 1, self.baseline_frames))
+        t_end = None if timeout is None else time.time() + timeout
+
+        # Idle: fill the ring buffer and learn the baseline
+        n_seen = 0
+        level = self.level
+        while True:
+            if self.cancelled.is_set():
+                return None
+            if t_end is not None and time.time() > t_end:
+                raise TimeoutError(f'No discharge detected in {timeout} s')
+            j = ring.slot()
+            for i, spectrum in enumerate(readout):
+                ring.times[j, i] = time.time()
+                ring.spectra[i][j] = spectrum()
+            value = self.intensity(ring.spectra[self.device][j])
+            n_seen += 1
+            if level is None and n_seen == self.baseline_frames:
+                history = ring.spectra[self.device][ring.ordered()[-self.baseline_frames:]]
+                values = np.sum(history[:, self.roi], axis=1)
+                level = values.mean() + self.threshold * max(values.std(), 1.0)
+                print(f'Capture armed, onset level {level:.0f} counts')
+            ring.advance()
+            if level is not None and n_seen > self.baseline_frames and value > level:
+                break
+
+        # Onset: keep the last pre frames, including the onset frame
+        measurement = OHR.measurement
+        measurement.clear()
+        measurement.reserve(self.pre + self.post + 256)
+        kept = ring.ordered()[-(self.pre + 1):]
+        for j in kept:
+            for i, id in enumerate(OHR.ids):
+                measurement.append(id, ring.spectra[i][j], ring.times[j, i])
+        onset_index = len(kept) - 1
+
+        # Discharge and post frames
+        below = 0
+        end_index = None
+        while True:
+            frame = []
+            for i, (id, spectrum) in enumerate(zip(OHR.ids, readout)):
+                t = time.time()
+                frame.append(spectrum())
+                measurement.append(id, frame[-1], t)
+            n = measurement.frames
+            if end_index is None:
+                below = below + 1 if self.intensity(np.asarray(frame[self.device])) <= level else 0
+                if below >= self.hold:
+                    # The discharge ended at the first of the frames below
+                    end_index = n - below
+                elif n - onset_index >= self.max_frames:
+                    end_index = n - 1
+            elif n - 1 - end_index >= self.post:
+                break
+
+        measurement.metadata['capture'] = {
+            'onset_index': onset_index,
+            'end_index': end_index,
+            'level': level,
+            'pre': self.pre,
+            'post': self.post,
+        }
+        return measurement
+
+
+class CaptureThread(threading.Thread):
+    """
+    OnsetCapture in the background, so the server keeps answering (and can
+    cancel it) while it waits for the discharge.
+
+    Parameters:
+    - capture: OnsetCapture to run.
+    - save: Function saving the captured measurement, returning the file.
+    - timeout: Seconds to wait for the onset.
+    """
+
+    def __init__(self, capture, save, timeout: float=600):
+        super().__init__(daemon=True)
+        self.capture = capture
+        self.save = save
+        self.timeout = timeout
+        self.filename = None
+        self.error = None
+
+    def run(self):
+        try:
+            if self.capture.run(timeout=self.timeout) is not None:
+                self.filename = self.save()
+                print(f'Discharge captured in {self.filename}')
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            print(f'Capture failed: {self.error}')
+
+    def stop(self):
+        self.capture.cancel()
+        self.join()
+
+    def status(self):
+        if self.is_alive():
+            return 'waiting for the discharge'
+        if self.filename is not None:
+            return f'captured {self.filename}'
+        return f'failed {self.error}' if self.error is not None else 'cancelled'
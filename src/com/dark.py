@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+import numpy as np
+
+
+class DarkLibrary:
+    """
+    Averaged dark spectra per device serial and integration time.
+
+    Each dark is stored as Dark/<serial>_<t_int>.npz and kept in memory
+    once loaded, so every shot with the same settings reuses it. Darks
+    older than max_age seconds are reported as stale. Every dark is also
+    kept as Dark/history/<id>.npz, the id recorded in the shots saved
+    with it, so reprocessing a shot uses the dark it was taken with.
+
+    Parameters:
+    - path: Directory of the library.
+    - max_age: Age in seconds after which a dark should be measured again.
+    """
+
+    def __init__(self, path: str, max_age: float=24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._darks = {}
+        self._history = {}
+        # Shared by the command thread and the ShotWriter (feature index)
+        self._lock = threading.RLock()
+
+    def _file(self, serial, t_int):
+        return os.path.join(self.path, f'{serial}_{int(t_int)}.npz')
+
+    def _history_file(self, dark_id):
+        return os.path.join(self.path, 'history', f'{dark_id}.npz')
+
+    @staticmethod
+    def dark_id(serial, t_int, t):
+        return f'{serial}_{int(t_int)}_{int(round(float(t) * 1000))}'
+
+    def current_id(self, serial, t_int):
+        """
+        Id of the stored dark of a device and integration time, or None.
+        """
+        entry = self.load(serial, t_int)
+        return None if entry is None else self.dark_id(serial, t_int, entry['time'])
+
+    def load_id(self, dark_id):
+        """
+        Dark entry of the history by id, or None if it is not there.
+        """
+        with self._lock:
+            if dark_id not in self._history:
+                try:
+                    with np.load(self._history_file(dark_id)) as f:
+                        self._history[dark_id] = {k: f[k] for k in f.files}
+                except FileNotFoundError:
+                    return None
+            return self._history[dark_id]
+
+    def before(self, serial, t_int, t):
+        """
+        Id of the last dark of the history taken before time t, or None.
+        """
+        prefix = f'{serial}_{int(t_int)}_'
+        try:
+            stamps = [int(f[len(prefix):-4]) for f in os.listdir(os.path.join(self.path, 'history'))
+                      if f.startswith(prefix) and f.endswith('.npz') and f[len(prefix):-4].isdigit()]
+        except FileNotFoundError:
+            return None
+        stamps = [stamp for stamp in stamps if stamp <= t * 1000]
+        return f'{prefix}{max(stamps)}' if stamps else None
+
+    def load(self, serial, t_int):
+        """
+        Stored dark entry, or None if there is none.
+
+        Returns:
+        - entry: Dictionary with 'dark', 'std', 'frames' and 'time'.
+        """
+        key = (str(serial), int(t_int))
+        with self._lock:
+            if key not in self._darks:
+                try:
+                    with np.load(self._file(serial, t_int)) as f:
+                        self._darks[key] = {k: f[k] for k in f.files}
+                except FileNotFoundError:
+                    return None
+            return self._darks[key]
+
+    def get(self, serial, t_int, max_age: float=None):
+        """
+        Averaged dark spectrum, or None if missing or stale.
+
+        Parameters:
+        - serial: Device serial number.
+        - t_int: Integration time in us.
+        - max_age: Overrides the library max_age; np.inf accepts any age.
+        """
+        entry = self.load(serial, t_int)
+        max_age = self.max_age if max_age is None else max_age
+        if entry is None or time.time() - float(entry['time']) > max_age:
+            return None
+        return entry['dark']
+
+    def signature(self):
+        # Changes whenever a dark is added or refreshed, for cache keys
+        if not os.path.isdir(self.path):
+            return []
+        return sorted((e.name, e.stat().st_mtime_ns) for e in os.scandir(self.path)
+                      if e.name.endswith('.npz'))
+
+    def needs_refresh(self, serial, t_int):
+        return self.get(serial, t_int) is None
+
+    def store(self, serial, t_int, frames):
+        """
+        Average and store the dark frames of a device.
+
+        Parameters:
+        - serial: Device serial number.
+        - t_int: Integration time in us.
+        - frames: (frames, pixels) array measured without light.
+        """
+        frames = np.asarray(frames, dtype=float)
+        entry = {
+            'dark': frames.mean(axis=0),
+            'std': frames.std(axis=0),
+            'frames': np.array(len(frames)),
+            'time': np.array(time.time()),
+        }
+        # Created on the first dark, not when the library is only read
+        os.makedirs(os.path.join(self.path, 'history'), exist_ok=True)
+        history = self._history_file(self.dark_id(serial, t_int, entry['time']))
+        with self._lock:
+            for file_path in (history, self._file(serial, t_int)):
+                tmp = file_path + '.tmp.npz'
+                np.savez(tmp, **entry)
+                os.replace(tmp, file_path)
+            self._darks[(str(serial), int(t_int))] = entry
+        return entry
+
+    def record(self, OceanHR, num: int=50):
+        """
+        Measure and store the dark of every device at its current settings.
+
+        The light path must be closed (no discharge) while it runs.
+        """
+        OceanHR.measure(num)
+        t_int = OceanHR.measurement.metadata['integration_time']
+        for id in OceanHR.ids:
+            self.store(OceanHR.serials[id], t_int, OceanHR.measurement[id])
+        OceanHR.measurement.clear()
+
+    def for_shot(self, data, device='2', max_age: float=np.inf):
+        """
+        Dark of a device of a saved shot, from the shot metadata.
+
+        The dark recorded in the shot when it was saved is used. Older
+        shots without it get the last dark taken before the shot, and
+        only then the current one (if not older than max_age).
+
+        Returns:
+        - dark: Averaged dark spectrum, or None if unknown.
+        """
+        metadata = data.get('metadata') if isinstance(data, dict) else None
+        if not metadata or 'serial' not in metadata:
+            return None
+        dark_id = metadata.get('dark', {}).get(str(device))
+        if dark_id is not None:
+            entry = self.load_id(dark_id)
+            if entry is not None:
+                return entry['dark']
+        serial = metadata['serial'].get(str(device), metadata['serial'].get(device))
+        t_int = metadata.get('integration_time')
+        if serial is None or t_int is None:
+            return None
+        times = data.get('times', {}).get(str(device), data.get('time'))
+        if times is not None and len(times):
+            dark_id = self.before(serial, t_int, float(times[0]))
+            if dark_id is not None:
+                return self.load_id(dark_id)['dark']
+        return self.get(serial, t_int, max_age=max_age)
+
+
+def subtract_background(spectra, dark=None):
+    """
+    Background corrected spectra, clipped at zero.
+
+    Parameters:
+    - spectra: (frames, pixels) array.
+    - dark: Dark spectrum; without it the first frame is used, as the
+      older scripts did.
+
+    Returns:
+    - spectra: Corrected (frames, pixels) array.
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    if dark is None:
+        dark = spectra[0, :]
+    return np.clip(spectra - dark, 0, None)
+
+
+def shot_background(data, device='2', library=None):
+    """
+    Background corrected spectra of a device of a saved shot.
+
+    Uses the dark of library matching the shot serial and integration
+    time when available, otherwise the first frame.
+    """
+    dark = library.for_shot(data, device) if library is not None else None
+    return subtract_background(data['spectra'][device], dark)
@@ -0,0 +1,131 @@
+import numpy as np
+
+
+class Measurement:
+    """
+    Frames of every device stored in contiguous, preallocated arrays.
+
+    Each device has a (capacity, n_pixels) spectra array and a matching
+    timestamp array. Only the first counts[id] rows are valid; reading
+    a device returns a view on them, so savers and analysis never copy.
+
+    Parameters:
+    - ids: Device ids.
+    - n_pixels: Number of pixels of each device (int or list per id).
+    - capacity: Frames to preallocate per device.
+    - metadata: Optional dictionary stored with the measurement.
+    """
+
+    __slots__ = ('ids', 'n_pixels', 'capacity', 'counts', 'spectra', 'times', 'metadata')
+
+    def __init__(self, ids, n_pixels, capacity: int=0, metadata: dict=None, dtype=np.float64):
+        self.ids = list(ids)
+        if np.isscalar(n_pixels):
+            n_pixels = [n_pixels] * len(self.ids)
+        self.n_pixels = dict(zip(self.ids, n_pixels))
+        self.metadata = metadata if metadata is not None else {}
+        self.capacity = 0
+        self.counts = {id: 0 for id in self.ids}
+        self.spectra = {id: np.empty((0, self.n_pixels[id]), dtype=dtype) for id in self.ids}
+        self.times = {id: np.empty(0) for id in self.ids}
+        self.reserve(capacity)
+
+    def reserve(self, capacity: int):
+        """
+        Make room for at least capacity frames per device, keeping the data.
+        """
+        if capacity <= self.capacity:
+            return
+        for id in self.ids:
+            n = self.counts[id]
+            spectra = np.empty((capacity, self.n_pixels[id]), dtype=self.spectra[id].dtype)
+            times = np.empty(capacity)
+            spectra[:n] = self.spectra[id][:n]
+            times[:n] = self.times[id][:n]
+            self.spectra[id] = spectra
+            self.times[id] = times
+        self.capacity = capacity
+
+    def append(self, id, spectrum, t: float):
+        n = self.counts[id]
+        if n == self.capacity:
+            self.reserve(max(16, int(self.capacity * 1.5)))
+        self.spectra[id][n] = spectrum
+        self.times[id][n] = t
+        self.counts[id] = n + 1
+
+    def set_count(self, num: int):
+        # After writing rows directly into the preallocated arrays
+        for id in self.ids:
+            self.counts[id] = num
+
+    def clear(self):
+        """
+        Forget the frames but keep the allocated memory for the next shot.
+        """
+        for id in self.ids:
+            self.counts[id] = 0
+
+    def release(self):
+        """
+        Forget the frames and free the allocated memory.
+        """
+        for id in self.ids:
+            self.spectra[id] = np.empty((0, self.n_pixels[id]), dtype=self.spectra[id].dtype)
+            self.times[id] = np.empty(0)
+            self.counts[id] = 0
+        self.capacity = 0
+
+    def __getitem__(self, id):
+        return self.spectra[id][:self.counts[id]]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def keys(self):
+        return list(self.ids)
+
+    def items(self):
+        return [(id, self[id]) for id in self.ids]
+
+    def time(self, id):
+        return self.times[id][:self.counts[id]]
+
+    @property
+    def frames(self):
+        return min(self.counts.values()) if self.ids else 0
+
+    @property
+    def t_array(self):
+        # Legacy layout: one timestamp per readout, frame major, device minor
+        n = self.frames
+        if not self.ids:
+            return np.empty(0)
+        return np.stack([self.times[id][:n] for id in self.ids], axis=1).ravel()
+
+    @property
+    def nbytes(self):
+        return sum(self.spectra[id].nbytes + self.times[id].nbytes for id in self.ids)
+
+    def to_dict(self):
+        """
+        JSON-compatible dictionary in the layout of the shot files.
+
+        Returns:
+        - data: Dictionary with 'spectra' and 'times' per device, the legacy
+          interleaved 'time' list and 'metadata'.
+        """
+        def tolist(value):
+            if isinstance(value, dict):
+                return {k: tolist(v) for k, v in value.items()}
+            return value.tolist() if hasattr(value, 'tolist') else value
+
+        return {
+            'spectra': {id: self[id].tolist() for id in self.ids},
+            'time': self.t_array.tolist(),
+            'times': {id: self.time(id).tolist() for id in self.ids},
+            'metadata': tolist(self.metadata),
+        }
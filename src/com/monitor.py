@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+
+from src.com.measurement import Measurement
+
+
+class Monitor(threading.Thread):
+    """
+    Continuous acquisition into rolling, time-segmented files.
+
+    Frames go into one of two preallocated segment buffers; when a segment
+    is full (segment_seconds elapsed or segment_bytes reached) it is handed
+    to a writer thread and acquisition goes on in the other one, so memory
+    stays constant however long the run is. Every segment is written as
+    <start>.npz with a small <start>_summary.npz (max and mean spectrum,
+    total counts per frame) and a line in segments.jsonl.
+
+    Retention: segments older than downsample_after seconds are replaced
+    by the average of every factor frames (<start>_ds.npz); older than
+    delete_after only the summaries remain. If max_bytes is given the
+    oldest segments are removed to stay below it.
+
+    Parameters:
+    - OceanHR: Spectrometer object (its devices are read by this thread).
+    - path: Output directory; Monitor inside OceanHR.path_shot if None.
+    - segment_seconds: Maximum duration of a segment.
+    - segment_bytes: Maximum size of a segment (and of each buffer).
+    - downsample_after, factor: Age (s) and frame averaging of the downsampling.
+    - delete_after: Age (s) after which the segment frames are deleted.
+    - max_bytes: Optional limit of the segment files in total.
+    """
+
+    def __init__(self, OceanHR, path: str=None, segment_seconds: float=60,
+                 segment_bytes: int=64 * 1024**2, downsample_after: float=6 * 3600, factor: int=10,
+                 delete_after: float=7 * 24 * 3600, max_bytes: int=None):
+        super().__init__(daemon=True)
+        self.OHR = OceanHR
+        self.path = path or os.path.join(OceanHR.path_shot, 'Monitor')
+        self.segment_seconds = segment_seconds
+        self.downsample_after = downsample_after
+        self.factor = factor
+        self.delete_after = delete_after
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+        frame_bytes = sum(8 * (n + 1) for n in OceanHR.pixels)
+        self.capacity = max(int(segment_bytes // frame_bytes), 1)
+        self.free = queue.Queue()
+        for _ in range(2):
+            self.free.put(Measurement(OceanHR.ids, OceanHR.pixels, self.capacity))
+        self.full = queue.Queue()
+        self.writer = threading.Thread(target=self._write_segments, daemon=True)
+        self.running = threading.Event()
+        self.frames = 0
+        self.segments = 0
+        self.waits = 0
+        self.errors = []
+
+    def run(self):
+        OHR = self.OHR
+        readout = [dev.get_formatted_spectrum for dev in OHR.devs]
+        clock = time.time
+        self.running.set()
+        self.writer.start()
+        segment = None
+        try:
+            while self.running.is_set():
+                try:
+                    segment = self.free.get_nowait()
+                except queue.Empty:
+                    self.waits += 1
+                    print('Monitor writer behind, acquisition paused')
+                    segment = self.free.get()
+                segment.clear()
+                segment.metadata = dict(OHR.measurement.metadata)
+                t_end = clock() + self.segment_seconds
+                n = 0
+                while n < self.capacity and self.running.is_set() and clock() < t_end:
+                    for id, spectrum in zip(OHR.ids, readout):
+                        t = clock()
+                        segment.append(id, spectrum(), t)
+                    n += 1
+                self.frames += n
+                self.full.put(segment)
+                segment = None
+        except Exception as e:
+            # A device failed: keep what was measured and report it in STAT
+            print(f'Monitor stopped: {type(e).__name__}: {e}')
+            self.errors.append(f'{type(e).__name__}: {e}')
+            if segment is not None:
+                self.full.put(segment)
+        finally:
+            self.running.clear()
+            self.full.put(None)
+            self.writer.join()
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    def _write_segments(self):
+        while True:
+            segment = self.full.get()
+            if segment is None:
+                return
+            try:
+                if segment.frames:
+                    self.write(segment)
+                    self.segments += 1
+                self.apply_retention()
+            except Exception as e:
+                print(f'Monitor could not write a segment: {type(e).__name__}: {e}')
+                self.errors.append(f'{type(e).__name__}: {e}')
+            finally:
+                self.free.put(segment)
+
+    def write(self, segment):
+        """
+        Write a segment, its summary and its segments.jsonl entry.
+        """
+        ids = segment.ids
+        t_start = float(segment.time(ids[0])[0])
+        name = time.strftime('%Y%m%d_%H%M%S', time.localtime(t_start)) + f'_{int(t_start % 1 * 1e3):03d}'
+        arrays, summary, devices = {}, {}, {}
+        for i, id in enumerate(ids):
+            spectra = segment[id]
+            arrays[f'wave_{id}'] = np.asarray(self.OHR.devs[i].get_wavelengths(), dtype=float)
+            arrays[f'spectra_{id}'] = spectra
+            arrays[f'times_{id}'] = segment.time(id)
+            totals = spectra.sum(axis=1)
+            summary[f'wave_{id}'] = arrays[f'wave_{id}']
+            summary[f'max_{id}'] = spectra.max(axis=0)
+            summary[f'mean_{id}'] = spectra.mean(axis=0)
+            summary[f'total_{id}'] = totals.astype(np.float32)
+            summary[f'times_{id}'] = segment.time(id)
+            devices[str(id)] = {'max_counts': float(summary[f'max_{id}'].max()),
+                                'peak_time': float(segment.time(id)[np.argmax(totals)])}
+        metadata = json.dumps(segment.metadata, default=str)
+        _savez(os.path.join(self.path, f'{name}.npz'), metadata=metadata, **arrays)
+        _savez(os.path.join(self.path, f'{name}_summary.npz'), metadata=metadata, **summary)
+        entry = {'name': name, 't_start': t_start, 't_end': float(segment.time(ids[0])[-1]),
+                 'frames': segment.frames, 'devices': devices}
+        with open(os.path.join(self.path, 'segments.jsonl'), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def segment_files(self):
+        # (start time, path) of the segment frame files, oldest first
+        files = []
+        for e in os.scandir(self.path):
+            # .tmp.npz: being written by _savez, or left by a crash
+            if e.name.endswith('.npz') and not e.name.endswith(('_summary.npz', '.tmp.npz')):
+                files.append((e.stat().st_mtime, e.path, e.stat().st_size))
+        return sorted(files)
+
+    def apply_retention(self):
+        now = time.time()
+        files = self.segment_files()
+        kept = []
+        for mtime, file, size in files:
+            age = now - mtime
+            if age > self.delete_after:
+                os.remove(file)
+            elif age > self.downsample_after and not file.endswith('_ds.npz'):
+                downsampled = file[:-4] + '_ds.npz'
+                _savez(downsampled, **downsample_segment(read_segment(file), self.factor))
+                os.utime(downsampled, (mtime, mtime))
+                os.remove(file)
+                kept.append((mtime, downsampled, os.path.getsize(downsampled)))
+            else:
+                kept.append((mtime, file, size))
+        if self.max_bytes is not None:
+            total = sum(size for _, _, size in kept)
+            for _, file, size in kept:
+                if total <= self.max_bytes:
+                    break
+                os.remove(file)
+                total -= size
+
+    def status(self):
+        state = 'running' if self.running.is_set() else 'stopped'
+        status = (f'{state} frames {self.frames} segments {self.segments} '
+                  f'pending {self.full.qsize()} waits {self.waits} failed {len(self.errors)}')
+        if self.errors:
+            status += f' last error {self.errors[-1]}'
+        return status
+
+
+def _savez(file, **arrays):
+    tmp = file + '.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, file)
+
+
+def read_segment(file):
+    """
+    Arrays of a segment (or summary) file.
+
+    Returns:
+    - segment: Dictionary of arrays, keys 'wave_<id>', 'spectra_<id>',
+      'times_<id>' and 'metadata' (json text).
+    """
+    with np.load(file) as f:
+        return {key: f[key] for key in f.files}
+
+
+def downsample_segment(segment, factor: int):
+    # Average every factor frames (and timestamps) of every device
+    result = {}
+    for key, value in segment.items():
+        if key.startswith(('spectra_', 'times_')) and len(value) >= factor:
+            n = len(value) // factor * factor
+            value = value[:n].reshape(n // factor, factor, *value.shape[1:]).mean(axis=1)
+        result[key] = value
+    return result
+
+
+def load_segments(path, t_min: float=None, t_max: float=None, device='2'):
+    """
+    Frames of one device from all the segments overlapping a time range.
+
+    Parameters:
+    - path: Monitor directory.
+    - t_min, t_max: Range in time.time() seconds; everything if None.
+    - device: Device id.
+
+    Returns:
+    - data: Dictionary with 'wave', 'spectra' (frames, pixels) and 'time'.
+    """
+    entries = []
+    with open(os.path.join(path, 'segments.jsonl'), 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    wave, spectra, times = None, [], []
+    for entry in entries:
+        if (t_min is not None and entry['t_end'] < t_min) or (t_max is not None and entry['t_start'] > t_max):
+            continue
+        for name in (f"{entry['name']}.npz", f"{entry['name']}_ds.npz"):
+            file = os.path.join(path, name)
+            if os.path.exists(file):
+                segment = read_segment(file)
+                wave = segment[f'wave_{device}']
+                spectra.append(segment[f'spectra_{device}'])
+                times.append(segment[f'times_{device}'])
+                break
+    if not spectra:
+        return {'wave': wave, 'spectra': np.empty((0, 0)), 'time': np.empty(0)}
+    spectra, times = np.concatenate(spectra), np.concatenate(times)
+    mask = np.ones(len(times), dtype=bool)
+    if t_min is not None:
+        mask &= times >= t_min
+    if t_max is not None:
+        mask &= times <= t_max
+    return {'wave': wave, 'spectra': spectra[mask], 'time': times[mask]}
@@ -0,0 +1,80 @@
+import os
+import sys
+import psutil
+
+
+def pin_thread(cores):
+    """
+    Pin the calling thread to the given CPU cores.
+
+    On Windows only the thread is pinned (SetThreadAffinityMask), on Linux
+    sched_setaffinity(0) also acts on the calling thread. Elsewhere the
+    whole process is pinned with psutil.
+
+    Parameters:
+    - cores: List of core indices.
+
+    Returns:
+    - pinned: True if the affinity could be changed.
+    """
+    cores = list(cores)
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            mask = sum(1 << core for core in cores)
+            kernel32 = ctypes.windll.kernel32
+            kernel32.GetCurrentThread.restype = ctypes.c_void_p
+            kernel32.SetThreadAffinityMask.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            return kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), mask) != 0
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+            return True
+        psutil.Process().cpu_affinity(cores)
+        return True
+    except (OSError, ValueError, AttributeError, psutil.Error) as e:
+        print(f'Could not pin to cores {cores}: {e}')
+        return False
+
+
+def raise_priority():
+    """
+    Raise the priority of this process as far as permitted.
+
+    Returns:
+    - priority: The new priority (class on Windows, nice value elsewhere),
+      or None if it could not be changed.
+    """
+    p = psutil.Process()
+    if sys.platform == 'win32':
+        # REALTIME would starve the USB driver threads the readout needs
+        levels = [psutil.HIGH_PRIORITY_CLASS, psutil.ABOVE_NORMAL_PRIORITY_CLASS]
+    else:
+        levels = [-20, -10, -5]
+    for level in levels:
+        try:
+            p.nice(level)
+            return p.nice()
+        except (psutil.AccessDenied, PermissionError):
+            continue
+    print('Could not raise the process priority')
+    return None
+
+
+def lower_priority():
+    """
+    Run this process (CPU and disk) only when nothing else needs it, for
+    background work that must not disturb the acquisition.
+
+    Returns:
+    - priority: The new priority (class on Windows, nice value elsewhere).
+    """
+    p = psutil.Process()
+    p.nice(psutil.IDLE_PRIORITY_CLASS if sys.platform == 'win32' else 19)
+    try:
+        if sys.platform == 'win32':
+            p.ionice(psutil.IOPRIO_VERYLOW)
+        elif hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+            p.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, OSError, AttributeError) as e:
+        print(f'Could not lower the I/O priority: {e}')
+    return p.nice()
@@ -0,0 +1,89 @@
+import os
+import time
+import tempfile
+import numpy as np
+
+from src.com.spec import OceanHR
+
+# Strong Ar I / Ar II lines (nm) used to draw the synthetic discharge
+SIM_LINES = [434.8, 476.5, 480.6, 488.0, 696.5, 706.7, 738.4, 750.4,
+             763.5, 772.4, 794.8, 811.5, 842.5, 912.3]
+
+
+class SimulatedDevice:
+    """
+    Stand-in for an OceanDirect device returning a synthetic Ar discharge.
+
+    The emission follows a gaussian envelope in frames centred on
+    pulse_frame, on top of a constant dark level with shot noise.
+    """
+
+    def __init__(self, serial, w_min, w_max, n_pixels=2048, pulse_frame=100,
+                 pulse_width=20, dark=1000, peak=4e4, seed=None):
+        self.serial = serial
+        self.wave = np.linspace(w_min, w_max, n_pixels)
+        self.pulse_frame = pulse_frame
+        self.pulse_width = pulse_width
+        self.dark = dark
+        self.rng = np.random.default_rng(seed)
+        self.integration_time = 7200
+        self.frame = 0
+        lines = [l for l in SIM_LINES if w_min <= l <= w_max]
+        self.emission = np.zeros(n_pixels)
+        for line in lines:
+            self.emission += peak * np.exp(-(self.wave - line)**2 / (2 * 0.3**2))
+
+    def set_integration_time(self, t_int):
+        self.integration_time = t_int
+
+    def get_integration_time(self):
+        return self.integration_time
+
+    def get_serial_number(self):
+        return self.serial
+
+    def get_wavelengths(self):
+        return self.wave.tolist()
+
+    def get_formatted_spectrum(self):
+        time.sleep(self.integration_time * 1e-6)
+        envelope = np.exp(-((self.frame - self.pulse_frame) / self.pulse_width)**2)
+        self.frame += 1
+        mean = self.dark + envelope * self.emission
+        return self.rng.poisson(mean).astype(float).tolist()
+
+
+class SimulatedHR(OceanHR):
+    """
+    OceanHR backed by simulated devices instead of the OceanDirect SDK.
+
+    Used as a local stand-in for acquisition PCs when testing servers,
+    coordinators and analysis without hardware. The devices split
+    w_min-w_max in n_devices ranges with a 10% overlap.
+    """
+
+    def __init__(self, n_devices=3, path_shot=None, n_pixels=2048,
+                 w_min=190.0, w_max=1100.0, pulse_frame=100, **kwargs):
+        self.n_devices = n_devices
+        self.n_pixels = n_pixels
+        self.w_range = (w_min, w_max)
+        self.pulse_frame = pulse_frame
+        if path_shot is None:
+            path_shot = tempfile.mkdtemp(prefix='OHR_Shots_')
+        os.makedirs(path_shot, exist_ok=True)
+        super().__init__(path_shot=path_shot, **kwargs)
+
+    def find_usb_devices(self):
+        return self.n_devices
+
+    def get_device_ids(self):
+        return list(range(1, self.n_devices + 1))
+
+    def open_device(self, id):
+        w_min, w_max = self.w_range
+        span = (w_max - w_min) / self.n_devices
+        start = w_min + (id - 1) * span
+        return SimulatedDevice(f'SIM{id:05d}', start - 0.05*span*(id > 1),
+                               start + span + 0.05*span*(id < self.n_devices),
+                               n_pixels=self.n_pixels, pulse_frame=self.pulse_frame,
+                               seed=id)
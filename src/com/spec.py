@@ -1,22 +1,52 @@
 import os
 import sys
-import psutil
 import time
 
 # Add OceanDirect path
 # sys.path.append('/usr/local/OceanOptics/OceanDirect/python')
 sys.path.append('C:\Program Files\Ocean Optics\OceanDirect SDK\Python')
 
-from oceandirect.OceanDirectAPI import *
+try:
+    from oceandirect.OceanDirectAPI import *
+except ImportError:
+    # Without the SDK only the simulated spectrometers of src.com.sim work
+    OceanDirectAPI = object
 import numpy as np
 
+from src.com.realtime import pin_thread, raise_priority
+from src.com.measurement import Measurement
+from src.com.dark import DarkLibrary
+from peaks.drift import DriftReference
+from src import tracing
+
 
 class OceanHR(OceanDirectAPI):
 
-    def __init__(self, **kwargs):
+    def __init__(self, path_shot=None, cores=None, priority=False, feature_index=None,
+                 drift_reference=None, **kwargs):
+        # Optional peaks.index.FeatureIndex updated every time a shot is saved
+        self.feature_index = feature_index
+        # Optional src.server.writer.ShotWriter saving the shots in the background
+        self.writer = None
+        # Optional src.com.monitor.Monitor while in continuous acquisition
+        self.monitor = None
+        # Optional src.com.capture.CaptureThread of the last CAPT
+        self.capture = None
+        # peaks.drift.DriftReference (Shots/drift_reference.npz by default), the
+        # wavelength drift of every saved shot against it is stored in the shot
+        self.drift_reference = drift_reference
+        self.cores = cores
+        self.priority = priority
+        self.armed = None
+        self.trigger_latency = None
+        self.trigger_latencies = []
         self.path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        self.path_shot = os.path.join(os.path.dirname(self.path), 'Shots')
+        self.path_shot = path_shot or os.path.join(os.path.dirname(self.path), 'Shots')
         self.next_shot = self.check_last_shot()+1
+        self.dark_library = DarkLibrary(os.path.join(self.path_shot, 'Dark'))
+        reference = os.path.join(self.path_shot, 'drift_reference.npz')
+        if self.drift_reference is None and os.path.exists(reference):
+            self.drift_reference = DriftReference(reference)
         super().__init__()
         self.find_usb_devices()
         self.ids = self.get_device_ids()
@@ -24,33 +54,104 @@ class OceanHR(OceanDirectAPI):
         self.devs = []
         for id in self.ids:
             self.devs.append(self.open_device(id))
-         
+        self.pixels = [len(dev.get_wavelengths()) for dev in self.devs]
+        self.serials = {id: self.devs[i].get_serial_number() for i, id in enumerate(self.ids)}
+
+        self.measurement = Measurement(self.ids, self.pixels)
         self.reset_measurement()
         self._set_integration_time(**kwargs)
     
     def _set_integration_time(self, t_int: float=7200, **kwargs):
         self.integrantion_time = t_int
+        self.measurement.metadata['integration_time'] = t_int
         for i, id in enumerate(self.ids):
             self.devs[i].set_integration_time(t_int)
 
     def reset_measurement(self):
-        self.measurement = {}
-        for i, id in enumerate(self.ids):
-            self.measurement[id] = []
+        # Free the frames of the previous shot instead of keeping them around
+        self.measurement.release()
+        self.armed = None
+        self.measurement.metadata = {
+            'integration_time': getattr(self, 'integrantion_time', None),
+            'serial': self.serials,
+        }
+
+    @property
+    def t_array(self):
+        return self.measurement.t_array
+
+    def arm(self, num=750):
+        """
+        Get ready for a trigger so the readout starts with minimal work.
+
+        Preallocates the measurement for num frames, pins the calling thread
+        to self.cores and raises the process priority if self.priority.
+
+        Parameters:
+        - num: Number of frames the next trigger will measure.
+        """
+        if self.cores:
+            pin_thread(self.cores)
+        if self.priority:
+            raise_priority()
+        self.measurement.clear()
+        self.measurement.reserve(num)
+        self.armed = {
+            'num': num,
+            'readout': [dev.get_formatted_spectrum for dev in self.devs],
+        }
+
+    def _measure_armed(self, num, t_trigger=None):
+        readout = self.armed['readout']
+        # Looked up now: the measurement may have been swapped (writer) since arming
+        buffers = [self.measurement.spectra[id] for id in self.ids]
+        times = [self.measurement.times[id] for id in self.ids]
+        clock = time.time
+        t_start = time.perf_counter()
+        for j in range(num):
+            for i, spectrum in enumerate(readout):
+                times[i][j] = clock()
+                buffers[i][j] = spectrum()
+        self.armed = None
+
+        if t_trigger is not None:
+            self.trigger_latency = t_start - t_trigger
+            self.trigger_latencies.append(self.trigger_latency)
+        self.measurement.set_count(num)
+        return self.measurement, self.t_array
+
+    @tracing.traced('measure')
+    def measure(self, num=750, t_trigger=None):
+        """
+        Measure num frames of every device.
+
+        Every call starts a new set of frames, reusing the memory of the
+        previous one.
 
-    def measure(self, num=750):
-        self.t_array = []
+        Parameters:
+        - num: Number of frames.
+        - t_trigger: time.perf_counter() when the trigger was received, to
+          record the trigger to first readout latency.
+        """
+        if self.armed is not None and self.armed['num'] >= num and self.measurement.capacity >= num:
+            return self._measure_armed(num, t_trigger)
+        self.armed = None
+        if t_trigger is not None:
+            self.trigger_latency = time.perf_counter() - t_trigger
+            self.trigger_latencies.append(self.trigger_latency)
+        self.measurement.clear()
+        self.measurement.reserve(num)
         for j in range(num):
             for i, id in enumerate(self.ids):
-                self.t_array.append(time.time())
-                self.measurement[id].append(self.devs[i].get_formatted_spectrum())
+                self.measurement.append(id, self.devs[i].get_formatted_spectrum(), time.time())
         return self.measurement, self.t_array
     
     def check_last_shot(self):
         files = os.listdir(self.path_shot)
-        files = [f for f in files if f.endswith('.json')]
+        # Only numbered shots, not the other json files of the directory
+        files = [f for f in files if f.endswith('.json') and f[:-5].isdigit()]
         if len(files) == 0:
-            return None
+            return 0
         files.sort()
         last_file = files[-1]
         shot_number = last_file.split('.')[0]
@@ -0,0 +1,65 @@
+import socket
+
+from src.server import protocol
+
+
+class OHRClient(socket.socket):
+    """
+    Client for the framed protocol of OHRServer.
+
+    Commands are sent in batches and every command gets its own reply,
+    so several commands cost a single round trip.
+    """
+
+    def __init__(self, HOST, PORT=12345, timeout=None):
+        super().__init__(socket.AF_INET, socket.SOCK_STREAM)
+        self.settimeout(timeout)
+        self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect((HOST, int(PORT)))
+        self.sendall(protocol.MAGIC)
+
+    def send_commands(self, *commands):
+        """
+        Send a batch of commands and wait for all the replies.
+
+        Parameters:
+        - commands: Command strings, e.g. 'PREP 7200', 'TRIG 100', 'GET'.
+
+        Returns:
+        - replies: List of (status, body) tuples, one per command. The body
+          is a str, except for a successful GET where it is the decoded
+          measurement dictionary.
+        """
+        if not commands:
+            return []
+        if any('\n' in command for command in commands):
+            raise ValueError('Commands cannot contain new lines')
+        protocol.send_frame(self, '\n'.join(commands).encode())
+        replies = []
+        for command in commands:
+            payload = self.recv_frame()
+            status, = protocol.STATUS.unpack_from(payload)
+            body = memoryview(payload)[protocol.STATUS.size:]
+            if status == protocol.STATUS_OK and command.split()[:1] == ['GET']:
+                replies.append((status, protocol.decode_measurement(body)))
+            else:
+                replies.append((status, bytes(body).decode()))
+        return replies
+
+    def recv_frame(self):
+        payload = protocol.recv_frame(self)
+        if payload is None:
+            raise ConnectionError('Server closed the connection')
+        return payload
+
+    def get(self):
+        """
+        Retrieve the current measurement of the server.
+
+        Returns:
+        - data: Dictionary with 'wave', 'spectra' and 'time' as numpy arrays.
+        """
+        status, body = self.send_commands('GET')[0]
+        if status != protocol.STATUS_OK:
+            raise RuntimeError(f'GET failed with status {status}: {body}')
+        return body
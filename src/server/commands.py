@@ -3,6 +3,12 @@ import os  # To run shell commands (optional)
 # from com.turbo import Turbo
 # import time
 import json
+import time
+
+from src.com.capture import OnsetCapture, CaptureThread
+from src.com.monitor import Monitor
+from peaks.drift import DriftReference
+from src import tracing
 
 
 
@@ -15,53 +21,263 @@ def decompose_command(command):
     command = command + order
     return command
 
-def execute_command(command, OceanHR):
+def wait_until(t_fire):
+    # Sleep most of the wait and spin the last milliseconds, sleep() alone
+    # overshoots by the OS timer resolution (~15 ms on Windows)
+    remaining = t_fire - time.time()
+    if remaining > 0.02:
+        time.sleep(remaining - 0.02)
+    while time.time() < t_fire:
+        pass
+
+def shot_header(OceanHR, measurement=None):
+    # Content of a shot file that does not come from the frames, taken when
+    # the shot is saved (a DARK may run before the writer gets to it)
+    measurement = OceanHR.measurement if measurement is None else measurement
+    header = {
+        'wave': OceanHR.devs[0].get_wavelengths(),
+        'waves': {id: dev.get_wavelengths() for id, dev in zip(OceanHR.ids, OceanHR.devs)},
+        'trigger_latency': OceanHR.trigger_latency,
+        'dark': None,
+        'darks': {},
+    }
+    t_int = measurement.metadata.get('integration_time')
+    if t_int is not None:
+        library = OceanHR.dark_library
+        header['dark'] = {str(id): library.current_id(OceanHR.serials[id], t_int) for id in measurement.ids}
+        header['darks'] = {id: library.get(OceanHR.serials[id], t_int) for id in measurement.ids}
+    return header
+
+def shot_data(OceanHR, measurement=None, header=None):
+    # JSON-compatible content of a shot file
+    measurement = OceanHR.measurement if measurement is None else measurement
+    header = shot_header(OceanHR, measurement) if header is None else header
+    data = {
+        'wave': header['wave'],
+        'waves': header['waves'],
+        **measurement.to_dict(),
+        'trigger_latency': header['trigger_latency'],
+    }
+    if header['dark'] is not None:
+        # The darks analysis must subtract, whatever is measured later
+        data['metadata']['dark'] = header['dark']
+    if OceanHR.drift_reference is not None:
+        with tracing.span('drift'):
+            data['drift'] = OceanHR.drift_reference.estimate(measurement, header['darks'])
+    return data
+
+def write_shot(data, filename, feature_index=None):
+    with tracing.span('json_dump', file=os.path.basename(filename)):
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=4)
+    if feature_index is not None:
+        # The shot is already safe on disk, indexing problems are only reported
+        try:
+            feature_index.append(os.path.splitext(os.path.basename(filename))[0], data)
+        except Exception as e:
+            print(f'Could not index {filename}: {e}')
+    return filename
+
+def save_shot(OceanHR, filename):
+    if OceanHR.writer is not None:
+        # Written in the background, OceanHR gets a fresh buffer right away
+        return OceanHR.writer.submit(filename)
+    return write_shot(shot_data(OceanHR), filename, OceanHR.feature_index)
+
+def next_shot_file(OceanHR):
+    filename = os.path.join(OceanHR.path_shot, f'{OceanHR.next_shot:06d}.json')
+    OceanHR.next_shot += 1
+    return filename
+
+def execute_command(command, OceanHR, t_received=None):
+    if not tracing.enabled():
+        return run_command(command, OceanHR, t_received)
+    with tracing.span(command[0], args=' '.join(command[1:])):
+        result = run_command(command, OceanHR, t_received)
+    if command[0] in ('SAVE', 'MEAS') and OceanHR.writer is None:
+        # One trace per shot, written after the request; the ShotWriter
+        # writes it instead once the shot is on disk
+        tracing.dump_later(trace_file(result))
+    return result
+
+def trace_file(filename):
+    # Trace of a shot, next to the shot files
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(os.path.dirname(filename), 'Traces', f'{name}.trace.json')
+
+def trace_command(command):
+    # TRAC ON [MEM] | TRAC OFF | TRAC STAT, PROF ON [interval ms] | PROF OFF
+    setting = command[1] if len(command)>1 else 'STAT'
+    match (command[0], setting):
+        case ('TRAC', 'ON'):
+            tracing.enable(memory=len(command)>2 and command[2] == 'MEM')
+        case ('TRAC', 'OFF'):
+            tracing.disable()
+        case ('TRAC', 'STAT'):
+            return '\n'.join(f"{name}: {s['count']} x {s['mean']/1e3:.3f} ms (max {s['max']/1e3:.3f} ms, {s['memory']/1e6:.1f} MB)"
+                             for name, s in tracing.stats().items())
+        case ('PROF', 'ON'):
+            interval = float(command[2]) / 1e3 if len(command)>2 else 0.005
+            tracing.start_profiler(interval)
+        case ('PROF', 'OFF'):
+            tracing.stop_profiler()
+        case _:
+            raise ValueError(f'Invalid {command[0]} setting {setting}')
+    return None
+
+def monitor_command(command, OceanHR):
+    # MONI START #segment_seconds | MONI STOP | MONI
+    setting = command[1] if len(command)>1 else 'STAT'
+    monitor = OceanHR.monitor
+    match setting:
+        case 'START':
+            if monitor is not None and monitor.is_alive():
+                raise ValueError('Already monitoring')
+            if busy(OceanHR):
+                raise ValueError(f'MONI START not available while {busy(OceanHR)}')
+            settings = {'segment_seconds': float(command[2])} if len(command)>2 else {}
+            if not settings.get('segment_seconds', 1) > 0:
+                raise ValueError('MONI START needs a positive segment_seconds')
+            OceanHR.monitor = Monitor(OceanHR, **settings)
+            OceanHR.monitor.start()
+            return OceanHR.monitor.path
+        case 'STOP':
+            if monitor is not None:
+                monitor.stop()
+            return monitor.status() if monitor is not None else None
+        case 'STAT':
+            return monitor.status() if monitor is not None else 'Not monitoring'
+        case _:
+            raise ValueError(f'Invalid MONI setting {setting}')
+
+def capture_shot(OceanHR):
+    # Saves a background capture (CAPT) as the next shot
+    filename = save_shot(OceanHR, next_shot_file(OceanHR))
+    if tracing.enabled() and OceanHR.writer is None:
+        tracing.dump_later(trace_file(filename))
+    return filename
+
+def capture_command(command, OceanHR):
+    # CAPT [#pre #post #timeout(s)] | CAPT STOP | CAPT STAT
+    setting = command[1] if len(command)>1 else 'START'
+    capture = OceanHR.capture
+    match setting:
+        case 'STOP':
+            if capture is not None:
+                capture.stop()
+            return capture.status() if capture is not None else None
+        case 'STAT':
+            return capture.status() if capture is not None else 'Not capturing'
+    # Free-running capture of the next discharge, in the background
+    settings = {}
+    if len(command)>1:
+        settings['pre'] = int(command[1])
+    if len(command)>2:
+        settings['post'] = int(command[2])
+    timeout = float(command[3]) if len(command)>3 else 600
+    OceanHR.capture = CaptureThread(OnsetCapture(OceanHR, **settings), lambda: capture_shot(OceanHR), timeout)
+    OceanHR.capture.start()
+    return None
+
+def busy(OceanHR):
+    # Background acquisition reading the devices, if any
+    if OceanHR.monitor is not None and OceanHR.monitor.is_alive():
+        return 'monitoring, run MONI STOP'
+    if OceanHR.capture is not None and OceanHR.capture.is_alive():
+        return 'capturing, run CAPT STOP'
+    return None
+
+# Commands that read the devices or change the measurement the monitor copies
+ACQUISITION_COMMANDS = ('ARM', 'PREP', 'DARK', 'TRIG', 'SAVE', 'MEAS', 'CAPT')
+
+def run_command(command, OceanHR, t_received=None):
+    if command[0] in ACQUISITION_COMMANDS and command[1:2] not in (['STOP'], ['STAT']) and busy(OceanHR):
+        raise ValueError(f'{command[0]} not available while {busy(OceanHR)}')
     match command[0]:
+        case 'ARM':
+            if len(command)>1:
+                OceanHR.arm(int(command[1]))
+            else:
+                OceanHR.arm()
+            return None
         case 'PREP':
             OceanHR.reset_measurement()
             if len(command)>1:
                 OceanHR._set_integration_time(int(command[1]))
+            t_int = OceanHR.measurement.metadata['integration_time']
+            stale = [s for s in OceanHR.serials.values() if OceanHR.dark_library.needs_refresh(s, t_int)]
+            if stale:
+                print(f'Dark spectra missing or too old for {stale} at {t_int} us, run DARK')
+            return None
+        case 'DARK':
+            # Light path must be closed: DARK #numberofcaptures
+            num = int(command[1]) if len(command)>1 else 50
+            OceanHR.dark_library.record(OceanHR, num)
             return None
+        case 'TIME':
+            return f'{time.time():.6f}'
         case 'TRIG':
+            if len(command)>2:
+                # Scheduled trigger, in the clock of this computer
+                wait_until(float(command[2]))
+                t_received = time.perf_counter()
             if len(command)>1:
-                return OceanHR.measure(int(command[1]))
+                return OceanHR.measure(int(command[1]), t_trigger=t_received)
             else:
-                return OceanHR.measure()
+                return OceanHR.measure(t_trigger=t_received)
         case 'SAVE':
+            # SAVE #filename [WAIT], WAIT returns once the file is written
             if len(command)>1:
                     filename = os.path.join(OceanHR.path_shot, f'{command[1]}.json')
-                    data = {
-                        'wave': OceanHR.devs[0].get_wavelengths(),
-                        'spectra': OceanHR.measurement,
-                        'time': OceanHR.t_array,
-                    }
-                    with open(filename, 'w') as f:
-                        json.dump(data, f, indent=4)
+                    filename = save_shot(OceanHR, filename)
+                    if len(command)>2 and command[2] == 'WAIT' and OceanHR.writer is not None:
+                        OceanHR.writer.flush()
+                        error = OceanHR.writer.failed(filename)
+                        if error is not None:
+                            raise RuntimeError(f'Could not save {filename}: {error}')
+                    return filename
+            raise ValueError('SAVE needs a filename')
         
         case 'MEAS':
             print(f'Current Shot: {OceanHR.next_shot:06d}')
-            filename = os.path.join(OceanHR.path_shot, f'{OceanHR.next_shot:06d}.json')
+            filename = next_shot_file(OceanHR)
             
             if len(command)>1:
                 print(f'Measuring for {command[1]} frames') 
-                OceanHR.measure(int(command[1]))
+                OceanHR.measure(int(command[1]), t_trigger=t_received)
             else:
                 print(f'Measuring for 750 frames')
-                OceanHR.measure()
+                OceanHR.measure(t_trigger=t_received)
             
-            data = {
-                'wave': OceanHR.devs[0].get_wavelengths(),
-                'spectra': OceanHR.measurement,
-                'time': OceanHR.t_array,
-            }
-            with open(filename, 'w') as f:
-                json.dump(data, f, indent=4)
-
-                
-        case _:
-            print('Invalid command')
+            return save_shot(OceanHR, filename)
+
+        case 'CAPT':
+            return capture_command(command, OceanHR)
+
+        case 'MONI':
+            return monitor_command(command, OceanHR)
+
+        case 'DRIF':
+            # Reference for the drift of the next shots: DRIF #shotname
+            if len(command)<2:
+                raise ValueError('DRIF needs a shot name')
+            reference = DriftReference(os.path.join(OceanHR.path_shot, 'drift_reference.npz'))
+            with open(os.path.join(OceanHR.path_shot, f'{command[1]}.json'), 'r') as f:
+                reference.set(json.load(f), command[1], OceanHR.dark_library)
+            OceanHR.drift_reference = reference
             return None
 
+        case 'STAT':
+            if OceanHR.writer is None:
+                return 'Shots written synchronously'
+            return OceanHR.writer.status()
+
+        case 'TRAC' | 'PROF':
+            return trace_command(command)
+
+        case _:
+            raise ValueError(f'Invalid command {command[0]}')
+
 
 
 
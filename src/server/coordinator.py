@@ -0,0 +1,200 @@
+import json
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from src.server.client import OHRClient
+from src.server import protocol
+
+
+class OHRCoordinator:
+    """
+    Trigger and collect several OHRServer instances as a single shot.
+
+    Every node gets its own connection and worker thread, so a slow or
+    dead node only shows up in the report and never delays the others.
+
+    Parameters:
+    - nodes: Dictionary name -> (host, port) of the OHRServer instances.
+    - timeout: Seconds to wait for a node before reporting it as failed.
+    """
+
+    def __init__(self, nodes: dict, timeout: float=60):
+        self.nodes = nodes
+        self.timeout = timeout
+        self.clients = {}
+        self.offsets = {}
+        self.report = {name: {} for name in nodes}
+        self.executor = ThreadPoolExecutor(max_workers=max(len(nodes), 1))
+
+    def _broadcast(self, task, names=None):
+        """
+        Run task(name) for every node in parallel.
+
+        Returns:
+        - results: Dictionary name -> result of the nodes that succeeded.
+          Failures and timeouts are stored in self.report[name]['error'].
+        """
+        names = list(self.clients) if names is None else names
+        futures = {self.executor.submit(task, name): name for name in names}
+        done, not_done = wait(futures, timeout=self.timeout)
+        results = {}
+        for future in done:
+            name = futures[future]
+            try:
+                results[name] = future.result()
+                self.report[name]['error'] = None
+            except Exception as e:
+                self.report[name]['error'] = f'{type(e).__name__}: {e}'
+                self._drop(name)
+        for future in not_done:
+            name = futures[future]
+            self.report[name]['error'] = f'Timeout after {self.timeout} s'
+            # Also wakes up the worker still waiting for the node
+            self._drop(name)
+        return results
+
+    def _drop(self, name):
+        client = self.clients.pop(name, None)
+        if client is not None:
+            client.close()
+
+    def connect(self):
+        def task(name):
+            host, port = self.nodes[name]
+            t0 = time.perf_counter()
+            client = OHRClient(host, port, timeout=self.timeout)
+            self.report[name]['connect'] = time.perf_counter() - t0
+            self.clients[name] = client
+        self._broadcast(task, names=list(self.nodes))
+        return list(self.clients)
+
+    def measure_offsets(self, samples: int=8):
+        """
+        Estimate the clock offset of every node (node clock - local clock).
+
+        The sample with the shortest round trip is kept, the offset
+        uncertainty is half of that round trip.
+        """
+        def task(name):
+            best = None
+            for _ in range(samples):
+                t0 = time.time()
+                status, body = self.clients[name].send_commands('TIME')[0]
+                t1 = time.time()
+                if status != protocol.STATUS_OK:
+                    raise RuntimeError(body)
+                sample = (t1 - t0, float(body) - (t0 + t1) / 2)
+                if best is None or sample[0] < best[0]:
+                    best = sample
+            self.report[name]['rtt'], self.report[name]['offset'] = best
+            return best[1]
+        self.offsets.update(self._broadcast(task))
+        return self.offsets
+
+    def _command(self, name, *commands):
+        t0 = time.perf_counter()
+        replies = self.clients[name].send_commands(*commands)
+        self.report[name]['latency'] = time.perf_counter() - t0
+        for command, (status, body) in zip(commands, replies):
+            if status != protocol.STATUS_OK:
+                raise RuntimeError(f'{command} failed with status {status}: {body}')
+        return replies
+
+    def prep(self, t_int=None):
+        command = 'PREP' if t_int is None else f'PREP {int(t_int)}'
+        return self._broadcast(lambda name: self._command(name, command))
+
+    def shot(self, num: int=750, lead: float=0.2):
+        """
+        Trigger all nodes at the same instant and gather their spectra.
+
+        Parameters:
+        - num: Number of frames per device.
+        - lead: Seconds between sending the trigger and firing it; must
+          cover the slowest node's network latency.
+
+        Returns:
+        - shot: Merged shot with one 'spectra' entry per node and device
+          ('node:id'), times converted to the coordinator clock.
+        """
+        if not self.offsets:
+            self.measure_offsets()
+        t_fire = time.time() + lead
+
+        def task(name):
+            t_node = t_fire + self.offsets.get(name, 0.0)
+            replies = self._command(name, f'TRIG {num} {t_node:.6f}', 'GET')
+            return replies[1][1]
+
+        results = self._broadcast(task)
+        return self.merge(results, t_fire)
+
+    def merge(self, results: dict, t_fire: float=None):
+        shot = {
+            'wave': None,
+            'waves': {},
+            'spectra': {},
+            'time': {},
+            't_fire': t_fire,
+            'nodes': self.report,
+        }
+        for name in sorted(results):
+            data = results[name]
+            offset = self.offsets.get(name, 0.0)
+            shot['time'][name] = data['time'] - offset
+            for id, spectra in data['spectra'].items():
+                key = f'{name}:{id}'
+                shot['waves'][key] = data['waves'][id]
+                shot['spectra'][key] = spectra
+                if shot['wave'] is None:
+                    shot['wave'] = data['waves'][id]
+        return shot
+
+    def save(self, shot: dict, filename: str):
+        def tolist(value):
+            if isinstance(value, dict):
+                return {k: tolist(v) for k, v in value.items()}
+            return value.tolist() if hasattr(value, 'tolist') else value
+        with open(filename, 'w') as f:
+            json.dump(tolist(shot), f, indent=4)
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+        self.executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    # Local stand-in: three simulated acquisition PCs on this computer
+    from src.server.server import OHRServer
+    from src.com.sim import SimulatedHR
+
+    servers, nodes, shots = [], {}, []
+    coordinator = None
+    try:
+        for i in range(3):
+            shots.append(tempfile.TemporaryDirectory(prefix='OHR_Shots_'))
+            server = OHRServer(PORT=0, HOST='127.0.0.1', spectrometer=SimulatedHR, t_int=2000,
+                               path_shot=shots[-1].name)
+            threading.Thread(target=server.run, daemon=True).start()
+            servers.append(server)
+            nodes[f'node{i}'] = ('127.0.0.1', server.PORT)
+
+        coordinator = OHRCoordinator(nodes)
+        coordinator.connect()
+        coordinator.measure_offsets()
+        coordinator.prep(2000)
+        shot = coordinator.shot(num=50)
+        for name, report in coordinator.report.items():
+            print(name, report)
+        print(f"Merged {len(shot['spectra'])} spectra")
+    finally:
+        if coordinator is not None:
+            coordinator.close()
+        for server in servers:
+            server.stop()
+        for directory in shots:
+            directory.cleanup()
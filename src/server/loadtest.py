@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import psutil
+
+from src.server.server import OHRServer
+from src.server.client import OHRClient
+from src.com.sim import SimulatedHR
+
+# Scripted session of every client; {client} and {i} are replaced by the
+# client number and the iteration
+SCRIPT = ['PREP 1000', 'ARM 10', 'TRIG 10', 'SAVE lt_{client:03d}_{i:04d}', 'MEAS 10']
+
+
+def start_server(**kwargs):
+    """
+    OHRServer with simulated spectrometers on a free local port.
+
+    Returns:
+    - server: The running OHRServer (served from a daemon thread).
+    """
+    settings = {'n_devices': 3, 't_int': 1000, **kwargs}
+    server = OHRServer(PORT=0, HOST='127.0.0.1', spectrometer=SimulatedHR, **settings)
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+
+def run_client(HOST, PORT, client, iterations, script, results, batch=False, legacy=False):
+    # One client session; every command latency is appended to results
+    sock = None
+    try:
+        t0 = time.perf_counter()
+        if legacy:
+            sock = socket.create_connection((HOST, PORT))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = OHRClient(HOST, PORT)
+        results['connect'].append(time.perf_counter() - t0)
+        if not legacy:
+            # The server serves one connection at a time: the first reply
+            # comes once the clients connected before are done
+            t = time.perf_counter()
+            sock.send_commands('TIME')
+            results['wait'].append(time.perf_counter() - t)
+        for i in range(iterations):
+            commands = [c.format(client=client, i=i) for c in script]
+            if legacy:
+                # No replies in the text protocol, only the send time is measured
+                for command in commands:
+                    t = time.perf_counter()
+                    sock.sendall(f'{command}\n'.encode())
+                    results['latency'].setdefault(command.split()[0], []).append(time.perf_counter() - t)
+                continue
+            groups = [commands] if batch else [[c] for c in commands]
+            for group in groups:
+                t = time.perf_counter()
+                replies = sock.send_commands(*group)
+                elapsed = time.perf_counter() - t
+                for command, (status, body) in zip(group, replies):
+                    name = command.split()[0]
+                    results['latency'].setdefault(name, []).append(elapsed / len(group))
+                    if status != 0:
+                        results['errors'].append(f'{command}: {body}')
+    except (OSError, ConnectionError) as e:
+        results['errors'].append(f'client {client}: {type(e).__name__}: {e}')
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def drain(HOST, PORT):
+    # One framed round trip: the server serves the connections in order, so
+    # it replies once every command sent before (legacy ones too) has run
+    with OHRClient(HOST, PORT) as client:
+        client.send_commands('TIME')
+
+
+def sample_memory(process, samples, stop, interval):
+    while not stop.is_set():
+        samples.append((time.perf_counter(), process.memory_info().rss))
+        stop.wait(interval)
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1e3
+    if not len(values):
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'count': len(values), 'mean_ms': float(values.mean()), 'p50_ms': float(p50),
+            'p90_ms': float(p90), 'p99_ms': float(p99), 'max_ms': float(values.max())}
+
+
+def version():
+    # Commit of the server code, to tell reports apart
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def load_test(clients: int=8, iterations: int=20, script=None, HOST=None, PORT=None, batch=False,
+              legacy=False, memory_interval: float=0.5, **kwargs):
+    """
+    Drive an OHRServer with concurrent scripted clients.
+
+    The server handles the connections one after the other, so the clients
+    queue: 'wait' is the time every client waited to be served and the
+    command latencies are measured once it is. The duration ends with a
+    framed round trip after the clients, once the server has run every
+    command sent (legacy clients do not wait for it).
+
+    Parameters:
+    - clients: Number of concurrent clients.
+    - iterations: Times every client runs the script.
+    - script: List of commands, SCRIPT by default.
+    - HOST, PORT: Server to test; a simulated local server is started if None.
+    - batch: Send every iteration as a single framed batch.
+    - legacy: Use the unframed text protocol (send times only).
+    - memory_interval: Seconds between memory samples of the local server
+      (this process); memory is not reported for a remote server.
+    - **kwargs: Passed to SimulatedHR for the local server, whose shots go
+      to a temporary directory removed at the end.
+
+    Returns:
+    - report: Dictionary with the latency percentiles per command,
+      connection times, throughput, memory growth and errors.
+    """
+    script = SCRIPT if script is None else script
+    server, shots = None, None
+    if HOST is None:
+        shots = tempfile.TemporaryDirectory(prefix='OHR_loadtest_')
+        server = start_server(path_shot=shots.name, **kwargs)
+        HOST, PORT = server.HOST, server.PORT
+    results = {'connect': [], 'wait': [], 'latency': {}, 'errors': []}
+
+    samples, stop = [], threading.Event()
+    if server is not None:
+        sampler = threading.Thread(target=sample_memory, args=(psutil.Process(), samples, stop, memory_interval),
+                                   daemon=True)
+        sampler.start()
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=run_client,
+                                args=(HOST, PORT, c, iterations, script, results, batch, legacy))
+               for c in range(clients)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        try:
+            drain(HOST, PORT)
+        except OSError as e:
+            results['errors'].append(f'drain: {type(e).__name__}: {e}')
+        duration = time.perf_counter() - t_start
+    finally:
+        if server is not None:
+            stop.set()
+            sampler.join()
+            # Writes the queued shots before their directory is removed
+            server.stop()
+            shots.cleanup()
+
+    rss = np.array([s[1] for s in samples], dtype=float)
+    t = np.array([s[0] for s in samples]) - t_start
+    n_commands = sum(len(v) for v in results['latency'].values())
+    return {
+        'version': version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'settings': {'clients': clients, 'iterations': iterations, 'script': script,
+                     'batch': batch, 'legacy': legacy, 'simulated': server is not None,
+                     'connections': 'sequential'},
+        'duration_s': duration,
+        'throughput_cmd_s': n_commands / duration,
+        'connect': percentiles(results['connect']),
+        'wait': percentiles(results['wait']),
+        'latency': {name: percentiles(v) for name, v in results['latency'].items()},
+        'memory': {
+            'start_mb': float(rss[0] / 1e6) if len(rss) else None,
+            'peak_mb': float(rss.max() / 1e6) if len(rss) else None,
+            'end_mb': float(rss[-1] / 1e6) if len(rss) else None,
+            # Linear trend, a steady growth over a long run is a leak
+            'growth_mb_per_min': float(np.polyfit(t, rss, 1)[0] * 60 / 1e6) if len(rss) > 2 else None,
+        },
+        'errors': results['errors'][:50],
+        'n_errors': len(results['errors']),
+    }
+
+
+def compare(old, new):
+    """
+    Print the change of the main figures between two reports.
+    """
+    print(f"{'':24s}{old['version'] or 'old':>14s}{new['version'] or 'new':>14s}{'change':>10s}")
+
+    def row(label, a, b):
+        if a is None or b is None:
+            return
+        change = (b - a) / a * 100 if a else float('nan')
+        print(f'{label:24s}{a:14.3f}{b:14.3f}{change:9.1f}%')
+
+    row('throughput (cmd/s)', old['throughput_cmd_s'], new['throughput_cmd_s'])
+    row('connect p50 (ms)', old['connect'].get('p50_ms'), new['connect'].get('p50_ms'))
+    row('wait p50 (ms)', old.get('wait', {}).get('p50_ms'), new['wait'].get('p50_ms'))
+    for name in new['latency']:
+        for p in ('p50_ms', 'p99_ms'):
+            row(f'{name} {p[:-3]} (ms)', old['latency'].get(name, {}).get(p), new['latency'][name].get(p))
+    row('memory growth (MB/min)', old['memory']['growth_mb_per_min'], new['memory']['growth_mb_per_min'])
+
+
+if __name__ == "__main__":
+    # e.g. python -m src.server.loadtest --clients=16 --iterations=100 --out=report.json --compare=old.json
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    flags = [a[2:] for a in sys.argv[1:] if a.startswith('--') and '=' not in a]
+    HOST, PORT = options.get('host'), options.get('port')
+    if HOST is not None or PORT is not None:
+        # Remote server, on the OHRServer defaults for what is not given
+        HOST, PORT = HOST or '127.0.0.1', int(PORT or 12345)
+    report = load_test(clients=int(options.get('clients', 8)), iterations=int(options.get('iterations', 20)),
+                       HOST=HOST, PORT=PORT,
+                       batch='batch' in flags, legacy='legacy' in flags)
+    print(json.dumps({k: v for k, v in report.items() if k != 'errors'}, indent=4))
+    if 'out' in options:
+        with open(options['out'], 'w') as f:
+            json.dump(report, f, indent=4)
+    if 'compare' in options:
+        with open(options['compare'], 'r') as f:
+            compare(json.load(f), report)
@@ -0,0 +1,287 @@
+import time
+import struct
+import socket
+import numpy as np
+
+from src import tracing
+
+# A framed client announces itself by sending MAGIC right after connecting.
+# After that every message in both directions is a frame:
+#   <uint32 little-endian payload length> <payload>
+# Requests are UTF-8 text with one command per line (a batch). The server
+# answers every command of the batch with one frame, in order:
+#   <uint8 status> <body>
+# For GET the body is the binary measurement described by GET_HEADER.
+MAGIC = b'OHRF'
+LENGTH = struct.Struct('<I')
+STATUS = struct.Struct('<B')
+MAX_FRAME = 1 << 30
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_INVALID = 2
+STATUS_NODATA = 3
+
+# GET body: header, time[n_times], then for every device a DEVICE_HEADER
+# followed by wave[n_pixels] and spectra[n_frames, n_pixels]. All float64 LE.
+GET_MAGIC = b'OHRD'
+GET_VERSION = 1
+GET_HEADER = struct.Struct('<4sHHI')    # magic, version, n_devices, n_times
+DEVICE_HEADER = struct.Struct('<iII')   # device id, n_frames, n_pixels
+DTYPE = np.dtype('<f8')
+
+# Pieces smaller than this are joined before sending, so the length prefix,
+# status and headers do not travel as separate tiny TCP segments.
+COALESCE = 1 << 16
+
+
+def is_framed(sock, timeout: float=1.0):
+    """
+    Check whether a freshly accepted client speaks the framed protocol.
+
+    The magic is consumed when present; otherwise nothing is read, so
+    plain text clients keep working as before.
+
+    Parameters:
+    - sock: Connected client socket.
+    - timeout: Seconds to wait for the rest of a partially received magic.
+
+    Returns:
+    - framed: True if the client sent MAGIC.
+    """
+    peek = sock.recv(len(MAGIC), socket.MSG_PEEK)
+    deadline = time.monotonic() + timeout
+    while len(peek) < len(MAGIC):
+        if not peek or not MAGIC.startswith(peek) or time.monotonic() > deadline:
+            return False
+        # Peeking again returns at once with the same bytes until more arrive
+        time.sleep(0.001)
+        peek = sock.recv(len(MAGIC), socket.MSG_PEEK)
+    if peek != MAGIC:
+        return False
+    recv_exact(sock, len(MAGIC))
+    return True
+
+
+def recv_exact(sock, size):
+    """
+    Receive exactly size bytes into a single preallocated buffer.
+
+    Parameters:
+    - sock: Connected socket.
+    - size: Number of bytes to receive.
+
+    Returns:
+    - buffer: bytearray with the received data.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError(f'Connection closed after {received} of {size} bytes')
+        received += n
+    return buffer
+
+
+def recv_frame(sock):
+    """
+    Receive one length-prefixed frame.
+
+    Parameters:
+    - sock: Connected socket.
+
+    Returns:
+    - payload: bytearray with the frame payload, or None if the peer
+      closed the connection between frames.
+    """
+    first = sock.recv(LENGTH.size)
+    if not first:
+        return None
+    if len(first) < LENGTH.size:
+        first += recv_exact(sock, LENGTH.size - len(first))
+    size, = LENGTH.unpack(first)
+    if size > MAX_FRAME:
+        raise ValueError(f'Frame of {size} bytes exceeds the {MAX_FRAME} bytes limit')
+    return recv_exact(sock, size)
+
+
+def send_frame(sock, *buffers):
+    """
+    Send one frame made of several buffers without joining large ones.
+
+    Parameters:
+    - sock: Connected socket.
+    - buffers: bytes-like objects (bytes, memoryview, contiguous arrays).
+    """
+    views = [memoryview(b).cast('B') for b in buffers]
+    size = sum(v.nbytes for v in views)
+    pending = [LENGTH.pack(size)]
+    for view in views:
+        if view.nbytes < COALESCE:
+            pending.append(view)
+            continue
+        sock.sendall(b''.join(pending))
+        pending = []
+        sock.sendall(view)
+    if pending:
+        sock.sendall(b''.join(pending))
+
+
+def send_reply(sock, status, body=b''):
+    """
+    Send a status reply for a single command.
+
+    Parameters:
+    - sock: Connected socket.
+    - status: One of the STATUS_* codes.
+    - body: Optional text or bytes body.
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    send_frame(sock, STATUS.pack(status), body)
+
+
+def split_batch(payload):
+    """
+    Split a request payload into its commands, one per line.
+
+    Parameters:
+    - payload: Request frame payload.
+
+    Returns:
+    - commands: List of command strings. Blank lines, including a
+      trailing one, are kept (as empty strings) so every line sent gets
+      its reply.
+    """
+    return [line.strip() for line in bytes(payload).decode().split('\n')]
+
+
+def shot_buffers(time_array, devices):
+    """
+    Build a GET body from arrays as a list of buffers.
+
+    Parameters:
+    - time_array: Timestamps (legacy interleaved layout).
+    - devices: List of (id, wave, spectra) tuples.
+
+    Returns:
+    - buffers: Header and array buffers ready for send_frame.
+    """
+    times = np.ascontiguousarray(time_array, dtype=DTYPE)
+    buffers = [GET_HEADER.pack(GET_MAGIC, GET_VERSION, len(devices), times.size), times]
+    for id, wave, spectra in devices:
+        wave = np.ascontiguousarray(wave, dtype=DTYPE)
+        spectra = np.ascontiguousarray(spectra, dtype=DTYPE)
+        buffers += [DEVICE_HEADER.pack(int(id), len(spectra), wave.size), wave, spectra]
+    return buffers
+
+
+def measurement_buffers(OceanHR, measurement=None):
+    """
+    Build the GET body of a measurement as a list of buffers.
+
+    Parameters:
+    - OceanHR: Spectrometer object holding the measurement.
+    - measurement: Measurement to send; the current one of OceanHR if None.
+
+    Returns:
+    - buffers: Header and array buffers ready for send_frame.
+    """
+    measurement = OceanHR.measurement if measurement is None else measurement
+    # Views on the measurement arrays, nothing is copied
+    devices = [(id, OceanHR.devs[i].get_wavelengths(), measurement[id])
+               for i, id in enumerate(OceanHR.ids)]
+    return shot_buffers(measurement.t_array, devices)
+
+
+def served_measurement(OceanHR):
+    # The current measurement, or right after a background SAVE the shot
+    # handed to the writer (the current buffer is then empty)
+    measurement = OceanHR.measurement
+    writer = getattr(OceanHR, 'writer', None)
+    if not measurement.frames and writer is not None and writer.last is not None:
+        measurement = writer.last
+    return measurement
+
+
+def decode_measurement(body):
+    """
+    Decode a GET body into the same layout returned by load_shot.
+
+    The arrays are views on body, no data is copied.
+
+    Parameters:
+    - body: GET reply body (without the status byte).
+
+    Returns:
+    - data: Dictionary with 'wave', 'spectra', 'time' and 'waves'
+      (the wavelengths of every device).
+    """
+    view = memoryview(body)
+    magic, version, n_devices, n_times = GET_HEADER.unpack_from(view)
+    if magic != GET_MAGIC or version != GET_VERSION:
+        raise ValueError(f'Unknown measurement format {magic!r} v{version}')
+    offset = GET_HEADER.size
+    time_array = np.frombuffer(view, DTYPE, n_times, offset)
+    offset += time_array.nbytes
+    data = {'wave': None, 'spectra': {}, 'time': time_array, 'waves': {}}
+    for _ in range(n_devices):
+        id, n_frames, n_pixels = DEVICE_HEADER.unpack_from(view, offset)
+        offset += DEVICE_HEADER.size
+        wave = np.frombuffer(view, DTYPE, n_pixels, offset)
+        offset += wave.nbytes
+        spectra = np.frombuffer(view, DTYPE, n_frames*n_pixels, offset).reshape(n_frames, n_pixels)
+        offset += spectra.nbytes
+        if data['wave'] is None:
+            data['wave'] = wave
+        data['waves'][str(id)] = wave
+        data['spectra'][str(id)] = spectra
+    return data
+
+
+def serve_client(client_socket, OceanHR, execute):
+    """
+    Answer framed requests from a client until it disconnects.
+
+    Parameters:
+    - client_socket: Connected client socket (MAGIC already consumed).
+    - OceanHR: Spectrometer object the commands act on.
+    - execute: Callable(command_list, OceanHR, t_received) running a
+      decomposed command.
+    """
+    while True:
+        payload = recv_frame(client_socket)
+        t_received = time.perf_counter()
+        if payload is None:
+            return
+        with tracing.span('request', bytes=len(payload)):
+            _serve_batch(client_socket, OceanHR, execute, payload, t_received)
+        tracing.dump_pending()
+
+
+def _serve_batch(client_socket, OceanHR, execute, payload, t_received):
+    from src.server.commands import decompose_command
+
+    for command in split_batch(payload):
+        if not command:
+            send_reply(client_socket, STATUS_INVALID, 'Empty command')
+            continue
+        command = decompose_command(command)
+        if command[0] == 'GET':
+            measurement = served_measurement(OceanHR)
+            if not OceanHR.ids or not measurement.frames:
+                send_reply(client_socket, STATUS_NODATA, 'No measurement available')
+                continue
+            send_frame(client_socket, STATUS.pack(STATUS_OK), *measurement_buffers(OceanHR, measurement))
+            continue
+        try:
+            result = execute(command, OceanHR, t_received)
+        except ValueError as e:
+            send_reply(client_socket, STATUS_INVALID, str(e))
+            continue
+        except Exception as e:
+            send_reply(client_socket, STATUS_ERROR, f'{type(e).__name__}: {e}')
+            continue
+        send_reply(client_socket, STATUS_OK, result if isinstance(result, str) else '')
@@ -1,53 +1,129 @@
 import os
 import sys
-import psutil
-import numpy as np
 import time
-import matplotlib.pyplot as plt
 import json
 import socket
 
 
 from src.com.spec import OceanHR
 from src.server.commands import execute_command, decompose_command
+from src.server import protocol
+from src import tracing
+from src.server.writer import ShotWriter
 
 class OHRServer(socket.socket):
 
-    def __init__(self, PORT=12345, **kwargs):
-        self.PORT = PORT
+    def __init__(self, PORT=12345, HOST=None, spectrometer=OceanHR, buffers=2, index=False, **kwargs):
+        self.PORT = int(PORT)
 #        this_ip = os.popen("hostname -I").read().split()[0]
-        hostname = socket.gethostname()
-        this_ip = socket.gethostbyname(hostname)
-        self.HOST = this_ip
+        if HOST is None:
+            hostname = socket.gethostname()
+            HOST = socket.gethostbyname(hostname)
+        self.HOST = HOST
 
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
         self.bind((self.HOST, self.PORT))
+        self.PORT = self.getsockname()[1]
         self.listen(5)
+        self._stopped = False
 
         print(f"Listening for commands on {self.HOST}:{self.PORT}")
-        OHR = OceanHR(**kwargs)
+        # Kept for the lifetime of the server so a measurement can be
+        # retrieved (GET) from a different connection than the trigger
+        self.OHR = spectrometer(**kwargs)
+        if index:
+            # Every saved shot is added to Shots/features.npz (peaks/index.py)
+            from peaks.index import open_index
+            self.OHR.feature_index = open_index(self.OHR.path_shot, dark=self.OHR.dark_library)
+        # With two or more buffers shots are saved while the next one is measured
+        if buffers > 1:
+            self.OHR.writer = ShotWriter(self.OHR, buffers)
+            self.OHR.writer.start()
         
 
     
     def run(self, **kwargs):
+        try:
+            self._serve()
+        finally:
+            # Also on Ctrl+C: the queued shots must reach the disk
+            self.stop()
 
+    def _serve(self):
         while True:
-            client_socket, client_address = self.accept()
+            try:
+                client_socket, client_address = self.accept()
+            except OSError:
+                if self._stopped:
+                    return
+                raise
             print(f'Connection stablished with {client_address}')
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            try:
+                if protocol.is_framed(client_socket):
+                    protocol.serve_client(client_socket, self.OHR, execute_command)
+                else:
+                    self.serve_text(client_socket)
+            except (OSError, ValueError) as e:
+                print(f'Client {client_address} dropped: {e}')
+            finally:
+                client_socket.close()
+            print(f'Client {client_address} disconnected')
+
+    def stop(self):
+        """
+        Stop accepting clients, stop monitoring (or capturing) and write the queued shots.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self.close()
+        if self.OHR.monitor is not None and self.OHR.monitor.is_alive():
+            self.OHR.monitor.stop()
+        if self.OHR.capture is not None and self.OHR.capture.is_alive():
+            self.OHR.capture.stop()
+        if self.OHR.writer is not None:
+            print(f'Writing {self.OHR.writer.pending()} pending shots')
+            self.OHR.writer.close()
+
+    def serve_text(self, client_socket):
+        # Legacy protocol, no replies: one unterminated command per recv, or
+        # newline terminated commands once the client has sent a newline
+        pending = b''
+        lines = False
+        while True:
 
-            OHR = OceanHR(**kwargs)
-
-            while True:
-
-                command = client_socket.recv(1028).decode().strip()
-
-                if not command:
-                    print(f'Client {client_address} disconnected')
-                    break
-
-                command = decompose_command(command)
-
-                execute_command(command, OHR)
+            received = client_socket.recv(1028)
+            t_received = time.perf_counter()
+            if not received:
+                break
+
+            lines = lines or b'\n' in received
+            if not lines:
+                commands = [received]
+            else:
+                # Only complete lines run, the unfinished tail waits for the next recv
+                *commands, pending = (pending + received).split(b'\n')
+            for command in commands:
+                command = command.decode()
+                if command.strip():
+                    self.run_text(decompose_command(command), t_received)
+
+    def run_text(self, command, t_received):
+        try:
+            execute_command(command, self.OHR, t_received)
+        except ValueError as e:
+            print(e)
+            return
+        except Exception as e:
+            # No reply channel: report it and keep serving, as serve_client does
+            print(f'{command[0]} failed: {type(e).__name__}: {e}')
+            return
+        finally:
+            tracing.dump_pending()
+        if command[0] in ('TRIG', 'MEAS') and self.OHR.trigger_latency is not None:
+            print(f'Trigger latency: {self.OHR.trigger_latency*1e3:.3f} ms')
 
 
 
@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import threading
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from peaks.check import device_time
+from plots.aniplot import load_data
+
+# Shots decoded once into shared memory and read by any process of this computer.
+# The service keeps one block per shot holding every array, and answers on a local
+# connection:
+#   ('get', shot)        -> ('ok', layout)     the block name and where each array is
+#   ('release', (shot, mtime)) -> ('ok', None) one holder less
+#   ('status', None)     -> ('ok', status)
+# A block is only unlinked once nobody holds it; a client that disconnects releases
+# everything it held.
+
+ADDRESS = ('127.0.0.1', 12348)
+AUTHKEY = b'OOSpec'
+ALIGN = 64
+
+
+def pack_shot(data):
+    """
+    Arrays of a shot and where they go in one shared block.
+
+    Returns:
+    - arrays: Dictionary name -> array ('wave', 'time', 'waves/<device>',
+      'spectra/<device>', 'times/<device>').
+    - layout: Dictionary name -> (offset, shape, dtype).
+    - nbytes: Size of the block.
+    """
+    arrays = {'wave': np.asarray(data['wave'], dtype=float),
+              'time': np.asarray(data['time'], dtype=float)}
+    for device in data['spectra']:
+        arrays[f'waves/{device}'] = np.asarray(data.get('waves', {}).get(device, data['wave']), dtype=float)
+        arrays[f'spectra/{device}'] = np.asarray(data['spectra'][device], dtype=float)
+        arrays[f'times/{device}'] = device_time(data, device)
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = (offset, array.shape, array.dtype.str)
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    return arrays, layout, max(offset, 1)
+
+
+def unpack_shot(buffer, layout, extra):
+    """
+    Shot dictionary (layout of load_shot) of read-only views of a block.
+
+    The views hold an export of buffer, so the block cannot be unmapped
+    (SharedMemory.close raises BufferError) while any of them is alive.
+    """
+    # np.ndarray(buffer=...) alone keeps no export and would dangle
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    views = {}
+    for name, (offset, shape, dtype) in layout.items():
+        view = np.ndarray(tuple(shape), dtype=np.dtype(dtype), buffer=raw, offset=offset)
+        view.flags.writeable = False
+        views[name] = view
+    data = {'wave': views['wave'], 'time': views['time'], 'waves': {}, 'spectra': {}, 'times': {}}
+    for name, view in views.items():
+        if '/' in name:
+            group, device = name.split('/', 1)
+            data[group][device] = view
+    data.update(extra)
+    return data
+
+
+def attach(name):
+    # The block belongs to the service: attaching must not register it with
+    # this process' resource tracker, which would unlink it at exit
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    block = shared_memory.SharedMemory(name=name)
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+class SharedShotCache:
+    """
+    Service keeping decoded shots in shared memory for every local process.
+
+    Parameters:
+    - path_shots: Directory with the shot files.
+    - max_bytes: Shared memory allowed; least recently used shots nobody
+      holds are removed beyond it.
+    - address: (host, port) of the local connection.
+    - authkey: Key clients must present.
+    """
+
+    def __init__(self, path_shots: str, max_bytes: int=4 * 1024**3, address=ADDRESS, authkey=AUTHKEY):
+        self.path_shots = path_shots
+        self.max_bytes = max_bytes
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._closed = False
+        print(f'Shared shot cache of {path_shots} on {self.address[0]}:{self.address[1]}')
+
+    def _load(self, shot):
+        if os.path.basename(shot) != shot:
+            raise FileNotFoundError(f'Invalid shot {shot}')
+        file_path = os.path.join(self.path_shots, f'{shot}.json')
+        mtime = os.stat(file_path).st_mtime_ns
+        with self._lock:
+            entry = self._current(shot)
+            if entry is not None and entry['mtime'] == mtime:
+                return self._hold(shot, entry)
+            loading = self._loading.setdefault(shot, threading.Lock())
+        with loading:
+            with self._lock:
+                entry = self._current(shot)
+                if entry is not None and entry['mtime'] == mtime:
+                    return self._hold(shot, entry)
+            data = load_data(file_path)
+            arrays, layout, nbytes = pack_shot(data)
+            block = shared_memory.SharedMemory(create=True, size=nbytes)
+            for name, array in arrays.items():
+                offset, shape, dtype = layout[name]
+                np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = array
+            extra = {k: v for k, v in data.items() if k not in ('wave', 'waves', 'spectra', 'time', 'times')}
+            entry = {'block': block, 'layout': layout, 'extra': json.dumps(extra), 'nbytes': nbytes,
+                     'mtime': mtime, 'refs': 0, 'stale': False}
+            with self._lock:
+                old = self._blocks.pop(shot, None)
+                if old is not None:
+                    # Changed on disk: the old copy goes once its holders release it
+                    old['stale'] = True
+                    self._blocks[(shot, old['mtime'])] = old
+                self._blocks[shot] = entry
+                self._loading.pop(shot, None)
+                layout = self._hold(shot, entry)
+                self._evict()
+            return layout
+
+    def _current(self, shot):
+        entry = self._blocks.get(shot)
+        if entry is not None:
+            self._blocks.move_to_end(shot)
+        return entry
+
+    def _hold(self, shot, entry):
+        entry['refs'] += 1
+        return {'shot': shot, 'mtime': entry['mtime'], 'name': entry['block'].name,
+                'layout': entry['layout'], 'extra': entry['extra']}
+
+    def _release(self, shot, mtime):
+        with self._lock:
+            key = shot if self._blocks.get(shot, {}).get('mtime') == mtime else (shot, mtime)
+            entry = self._blocks.get(key)
+            if entry is None:
+                return
+            entry['refs'] = max(entry['refs'] - 1, 0)
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        for key, entry in list(self._blocks.items()):
+            if entry['stale'] and entry['refs'] == 0:
+                self._unlink(key)
+        total = sum(e['nbytes'] for e in self._blocks.values())
+        for key, entry in list(self._blocks.items()):
+            if total <= self.max_bytes:
+                break
+            if entry['refs'] == 0:
+                total -= entry['nbytes']
+                self._unlink(key)
+        if total > self.max_bytes:
+            print(f'Shared shot cache over budget: {total / 1e6:.0f} MB held by clients')
+
+    def _unlink(self, key):
+        entry = self._blocks.pop(key)
+        block = entry['block']
+        if os.name == 'posix' and sys.version_info < (3, 13):
+            # A client sharing this process' resource tracker may have
+            # unregistered the block when attaching (see attach)
+            from multiprocessing import resource_tracker
+            resource_tracker.register(block._name, 'shared_memory')
+        block.close()
+        block.unlink()
+
+    def status(self):
+        with self._lock:
+            return {'shots': {str(key): {'mb': e['nbytes'] / 1e6, 'refs': e['refs'], 'stale': e['stale']}
+                              for key, e in self._blocks.items()},
+                    'used_mb': sum(e['nbytes'] for e in self._blocks.values()) / 1e6,
+                    'max_mb': self.max_bytes / 1e6}
+
+    def serve_client(self, conn):
+        held = []
+        try:
+            while True:
+                try:
+                    request, argument = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    match request:
+                        case 'get':
+                            layout = self._load(str(argument))
+                            held.append((layout['shot'], layout['mtime']))
+                            conn.send(('ok', layout))
+                        case 'release':
+                            shot, mtime = argument
+                            if (shot, mtime) in held:
+                                held.remove((shot, mtime))
+                                self._release(shot, mtime)
+                            conn.send(('ok', None))
+                        case 'status':
+                            conn.send(('ok', self.status()))
+                        case _:
+                            conn.send(('error', f'Unknown request {request}'))
+                except (OSError, ValueError, KeyError) as e:
+                    conn.send(('error', f'{type(e).__name__}: {e}'))
+        finally:
+            for shot, mtime in held:
+                self._release(shot, mtime)
+            conn.close()
+
+    def serve_forever(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if self._closed:
+                    break
+                continue
+            threading.Thread(target=self.serve_client, args=(conn,), daemon=True).start()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        """
+        Stop listening and unlink every block.
+        """
+        self._closed = True
+        self.listener.close()
+        with self._lock:
+            for key in list(self._blocks):
+                self._unlink(key)
+
+
+class SharedShot:
+    """
+    A shot held in the shared cache. data is a dictionary in the layout of
+    load_shot whose arrays are read-only views of the shared block. close()
+    lets the service evict the shot; arrays still referenced stay valid and
+    the block is unmapped once they are gone.
+    """
+
+    def __init__(self, client, layout):
+        self._client = client
+        self._key = (layout['shot'], layout['mtime'])
+        self._block = attach(layout['name'])
+        self.data = unpack_shot(self._block.buf, layout['layout'], json.loads(layout['extra']))
+
+    def close(self):
+        if self._block is None:
+            return
+        self.data = None
+        block, self._block = self._block, None
+        self._client._request('release', self._key)
+        self._client._unmap(block)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedShotClient:
+    """
+    Connection of a process to a SharedShotCache.
+
+    Parameters:
+    - address: (host, port) of the service.
+    - authkey: Key of the service.
+    """
+
+    def __init__(self, address=ADDRESS, authkey=AUTHKEY):
+        self.conn = Client(tuple(address), authkey=authkey)
+        self._lock = threading.Lock()
+        # Blocks of closed shots whose arrays were still referenced
+        self._mapped = []
+
+    def _request(self, request, argument=None):
+        with self._lock:
+            self.conn.send((request, argument))
+            status, value = self.conn.recv()
+        if status != 'ok':
+            if str(value).startswith('FileNotFoundError'):
+                raise FileNotFoundError(value)
+            raise RuntimeError(value)
+        return value
+
+    def get(self, shot_number):
+        """
+        Hold a shot, decoding it in the service if nobody did yet.
+
+        Returns:
+        - shot: SharedShot; use it as a context manager or close() it
+          when its arrays are no longer needed.
+        """
+        self._unmap()
+        return SharedShot(self, self._request('get', str(shot_number)))
+
+    def _unmap(self, block=None):
+        # Close the blocks of the closed shots nobody uses any more
+        if block is not None:
+            self._mapped.append(block)
+        mapped = []
+        for block in self._mapped:
+            try:
+                block.close()
+            except BufferError:
+                mapped.append(block)
+        self._mapped = mapped
+
+    def status(self):
+        return self._request('status')
+
+    def close(self):
+        self._unmap()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    cache = SharedShotCache(sys.argv[1] if len(sys.argv) > 1 else path_shots)
+    try:
+        cache.serve_forever()
+    finally:
+        cache.close()
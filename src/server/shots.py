@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import threading
+import urllib.error
+import urllib.request
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from src.server import protocol
+from peaks.check import device_time
+from plots.aniplot import load_data
+
+# Read-only HTTP access to the Shots directory:
+#   GET /shots                      JSON list of the shots
+#   GET /shots/<shot>/info          JSON devices, frames, wavelength ranges and metadata
+#   GET /shots/<shot>?device=2&start=0&stop=300&w_min=400&w_max=500
+#                                   binary body of the framed protocol GET (see protocol.py),
+#                                   with the other keys of the shot file (metadata, drift, ...)
+#                                   as JSON in the X-Shot-Data header
+# Every query argument is optional; device may list several devices (device=1,2).
+
+
+class ShotStore:
+    """
+    Decoded shots of a directory, kept in memory least recently used first.
+
+    Parameters:
+    - path_shots: Directory with the shot files.
+    - max_bytes: Memory allowed for the decoded shots.
+    """
+
+    def __init__(self, path_shots: str, max_bytes: int=2 * 1024**3):
+        self.path_shots = path_shots
+        self.max_bytes = max_bytes
+        self._shots = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def shots(self):
+        return sorted(f[:-5] for f in os.listdir(self.path_shots) if f.endswith('.json'))
+
+    def _decode(self, file_path):
+        data = load_data(file_path)
+        devices = {}
+        for device in data['spectra']:
+            devices[device] = {
+                'wave': np.asarray(data.get('waves', {}).get(device, data['wave']), dtype=float),
+                'spectra': np.asarray(data['spectra'][device], dtype=float),
+                'times': device_time(data, device),
+            }
+        nbytes = sum(a.nbytes for d in devices.values() for a in d.values())
+        # Everything else of the file (metadata, trigger_latency, drift...) as is
+        extra = {k: v for k, v in data.items() if k not in ('wave', 'waves', 'spectra', 'time', 'times')}
+        extra.setdefault('metadata', {})
+        extra.setdefault('trigger_latency', None)
+        return {'devices': devices, 'extra': extra, 'metadata': extra['metadata'],
+                'trigger_latency': extra['trigger_latency'], 'nbytes': nbytes}
+
+    def get(self, shot):
+        """
+        Decoded shot, loaded once even with concurrent requests.
+
+        Returns:
+        - shot: Dictionary with 'devices' (device -> 'wave', 'spectra',
+          'times' arrays), 'metadata', 'trigger_latency' and 'extra' (every
+          other key of the shot file, metadata and trigger_latency included).
+        """
+        if os.path.basename(shot) != shot:
+            raise FileNotFoundError(f'Invalid shot {shot}')
+        file_path = os.path.join(self.path_shots, f'{shot}.json')
+        key = (shot, os.stat(file_path).st_mtime_ns)
+        with self._lock:
+            if key in self._shots:
+                self._shots.move_to_end(key)
+                return self._shots[key]
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = threading.Lock()
+        with loading:
+            with self._lock:
+                if key in self._shots:
+                    return self._shots[key]
+            decoded = self._decode(file_path)
+            with self._lock:
+                self._shots[key] = decoded
+                self._loading.pop(key, None)
+                self._evict()
+        return decoded
+
+    def _evict(self):
+        total = sum(s['nbytes'] for s in self._shots.values())
+        while total > self.max_bytes and len(self._shots) > 1:
+            _, oldest = self._shots.popitem(last=False)
+            total -= oldest['nbytes']
+
+    def select(self, shot, devices=None, start=None, stop=None, w_min=None, w_max=None):
+        """
+        Frame and wavelength ranges of some devices of a shot.
+
+        The devices are cut to the frames they all have, as the timestamps
+        are interleaved.
+
+        Returns:
+        - time_array: Interleaved timestamps of the selected frames.
+        - selected: List of (id, wave, spectra) views for protocol.shot_buffers.
+        - extra: The other keys of the shot, with the drift of the selected
+          devices moved to the selected pixels.
+        """
+        decoded = self.get(shot)
+        devices = list(decoded['devices']) if devices is None else devices
+        extra = dict(decoded['extra'])
+        drift = extra.pop('drift', None)
+        selected, times, first = [], [], {}
+        for device in devices:
+            d = decoded['devices'][device]
+            lo = 0 if w_min is None else int(np.searchsorted(d['wave'], w_min, side='left'))
+            hi = len(d['wave']) if w_max is None else np.searchsorted(d['wave'], w_max, side='right')
+            frames = slice(start, stop)
+            selected.append((device, d['wave'][lo:hi], d['spectra'][frames, lo:hi]))
+            times.append(d['times'][frames])
+            first[device] = lo
+        n = min(len(t) for t in times)
+        selected = [(device, wave, spectra[:n]) for device, wave, spectra in selected]
+        time_array = np.stack([t[:n] for t in times], axis=1).ravel()
+        if drift is not None:
+            # The drift is a function of the pixel of the whole axis
+            extra['drift'] = {device: {**drift[device], 'center': drift[device].get('center', 0.0) - first[device]}
+                              for device in devices if device in drift}
+        return time_array, selected, extra
+
+
+class ShotRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        store = self.server.store
+        try:
+            if parts == ['shots']:
+                return self.send_json(store.shots())
+            if len(parts) == 3 and parts[0] == 'shots' and parts[2] == 'info':
+                decoded = store.get(parts[1])
+                info = {device: {'frames': len(d['spectra']), 'pixels': len(d['wave']),
+                                 'w_min': float(d['wave'][0]), 'w_max': float(d['wave'][-1])}
+                        for device, d in decoded['devices'].items()}
+                return self.send_json({'devices': info, **decoded['extra']})
+            if len(parts) == 2 and parts[0] == 'shots':
+                devices = query['device'].split(',') if 'device' in query else None
+                numbers = {k: float(query[k]) for k in ('w_min', 'w_max') if k in query}
+                frames = {k: int(query[k]) for k in ('start', 'stop') if k in query}
+                time_array, selected, extra = store.select(parts[1], devices, **frames, **numbers)
+                return self.send_arrays(protocol.shot_buffers(time_array, selected), extra)
+            self.send_error(404, 'Unknown path')
+        except FileNotFoundError as e:
+            self.send_error(404, str(e))
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f'Invalid query: {e}')
+
+    def send_json(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_arrays(self, buffers, extra):
+        views = [memoryview(b).cast('B') for b in buffers]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(sum(v.nbytes for v in views)))
+        self.send_header('X-Shot-Data', json.dumps(extra))
+        self.end_headers()
+        for view in views:
+            self.wfile.write(view)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ShotServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering shot queries from a ShotStore.
+
+    Parameters:
+    - path_shots: Directory with the shot files.
+    - PORT: Port to listen on, 0 for any free one.
+    - HOST: Address to listen on, '0.0.0.0' to serve other computers.
+    - max_bytes: Memory allowed for the decoded shot cache.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path_shots: str, PORT=12347, HOST='127.0.0.1', max_bytes: int=2 * 1024**3):
+        self.store = ShotStore(path_shots, max_bytes)
+        super().__init__((HOST, int(PORT)), ShotRequestHandler)
+        self.PORT = self.server_address[1]
+        print(f"Serving {path_shots} on http://{HOST}:{self.PORT}")
+
+
+def fetch_shot(shot_number, url: str, device=None, start: int=None, stop: int=None,
+               w_min: float=None, w_max: float=None, timeout: float=60):
+    """
+    Load (part of) a shot from a ShotServer, in the layout of load_shot.
+
+    Parameters:
+    - shot_number: The shot number to load.
+    - url: Base url of the server, e.g. 'http://192.168.0.10:12347'.
+    - device: Device key or list of keys; all devices if None.
+    - start, stop: Frame range.
+    - w_min, w_max: Wavelength range in nm.
+    - timeout: Seconds to wait for the server.
+
+    Returns:
+    - data: Dictionary with 'wave', 'waves', 'spectra', 'time', 'times'
+      and every other key of the shot file ('metadata', 'drift'...).
+    """
+    query = {'start': start, 'stop': stop, 'w_min': w_min, 'w_max': w_max}
+    if device is not None:
+        query['device'] = device if isinstance(device, str) else ','.join(map(str, device))
+    query = urllib.parse.urlencode({k: v for k, v in query.items() if v is not None})
+    request = f"{url.rstrip('/')}/shots/{shot_number}" + (f'?{query}' if query else '')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            extra = json.loads(response.headers.get('X-Shot-Data', '{}'))
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            raise FileNotFoundError(f'Shot {shot_number} not found on {url}') from e
+        raise
+    data = protocol.decode_measurement(body)
+    devices = list(data['spectra'])
+    data['times'] = {device: data['time'][i::len(devices)] for i, device in enumerate(devices)}
+    data.update(extra)
+    data.setdefault('metadata', {})
+    return data
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    ShotServer(sys.argv[1] if len(sys.argv) > 1 else path_shots).serve_forever()
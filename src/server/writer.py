@@ -0,0 +1,144 @@
+import os
+import time
+import queue
+import threading
+
+from src.com.measurement import Measurement
+from src.server.commands import shot_header, shot_data, write_shot, trace_file
+from src import tracing
+
+
+class ShotWriter(threading.Thread):
+    """
+    Saves shots in the background while the spectrometers keep measuring.
+
+    OceanHR owns one measurement buffer at a time. When a shot is saved
+    its buffer is handed to this thread and a free one takes its place,
+    so the next trigger never waits for (or modifies) the data being
+    written. With every buffer still pending, submit waits for the oldest
+    write to finish (backpressure) and says so.
+
+    Parameters:
+    - OceanHR: Spectrometer object whose shots are written.
+    - buffers: Measurement buffers in total, including the one in use.
+    """
+
+    def __init__(self, OceanHR, buffers: int=2):
+        super().__init__(daemon=True)
+        self.OHR = OceanHR
+        self.queue = queue.Queue()
+        self.free = queue.Queue()
+        for _ in range(max(buffers - 1, 1)):
+            self.free.put(Measurement(OceanHR.ids, OceanHR.pixels))
+        self.saved = 0
+        self.waits = 0
+        self.errors = []
+        # Last submitted measurement, still served by GET until the next shot
+        self.last = None
+        self._closed = False
+
+    def submit(self, filename):
+        """
+        Queue the current measurement of OceanHR to be saved as filename.
+
+        Raises RuntimeError once the writer is closed, also while waiting
+        for a free buffer.
+
+        Returns:
+        - filename: The file that will be written.
+        """
+        if self._closed:
+            raise RuntimeError('Shot writer is closed')
+        OHR = self.OHR
+        header = shot_header(OHR)
+        try:
+            spare = self.free.get_nowait()
+        except queue.Empty:
+            self.waits += 1
+            print(f'Writer behind ({self.pending()} shots pending), waiting for a free buffer')
+            t_wait = time.perf_counter()
+            spare = None
+            while spare is None:
+                try:
+                    spare = self.free.get(timeout=0.5)
+                except queue.Empty:
+                    if self._closed or not self.is_alive():
+                        raise RuntimeError('Shot writer is closed') from None
+            print(f'Waited {(time.perf_counter() - t_wait)*1e3:.1f} ms for the writer')
+            if self._closed:
+                # Freed by the last writes, nothing would write this shot
+                self.free.put(spare)
+                raise RuntimeError('Shot writer is closed')
+
+        measurement = OHR.measurement
+        spare.clear()
+        spare.metadata = {k: v for k, v in measurement.metadata.items() if k != 'capture'}
+        OHR.measurement = spare
+        self.last = measurement
+        if OHR.armed is not None:
+            # The armed buffers belong to the shot being written
+            OHR.arm(OHR.armed['num'])
+        self.queue.put((filename, measurement, header))
+        tracing.counter('writer', pending=self.pending())
+        return filename
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            filename, measurement, header = item
+            try:
+                write_shot(shot_data(self.OHR, measurement, header), filename, self.OHR.feature_index)
+                self.saved += 1
+            except Exception as e:
+                # The acquisition goes on, the failure is kept for STAT
+                print(f'Could not save {filename}: {type(e).__name__}: {e}')
+                self.errors.append((os.path.basename(filename), f'{type(e).__name__}: {e}'))
+            else:
+                self.dump_trace(filename)
+            finally:
+                # Frames kept (GET) until the buffer is reused by submit
+                self.free.put(measurement)
+                self.queue.task_done()
+
+    def dump_trace(self, filename):
+        # The shot is written: a trace that cannot be saved is not its error
+        if not tracing.enabled():
+            return
+        try:
+            print(f'Trace saved to {tracing.dump(trace_file(filename))}')
+        except Exception as e:
+            print(f'Could not save the trace of {filename}: {type(e).__name__}: {e}')
+
+    def pending(self):
+        # Shots queued or being written
+        return self.queue.unfinished_tasks
+
+    def flush(self):
+        # Wait until every queued shot is on disk
+        self.queue.join()
+
+    def failed(self, filename):
+        # Error of the last write of filename, if it failed
+        for name, error in reversed(self.errors):
+            if name == os.path.basename(filename):
+                return error
+        return None
+
+    def close(self):
+        """
+        Write every queued shot and stop the thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self.join()
+
+    def status(self):
+        status = f'pending {self.pending()} saved {self.saved} waits {self.waits} failed {len(self.errors)}'
+        if self.errors:
+            status += f' last error {self.errors[-1][0]}: {self.errors[-1][1]}'
+        return status
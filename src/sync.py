@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.com.realtime import lower_priority
+
+CHUNK = 8 * 1024**2
+# Never copied: caches that can be rebuilt and files still being written
+EXCLUDE_DIRS = {'Cache'}
+EXCLUDE_SUFFIXES = ('.tmp', '.part', '.tmp.npz')
+MANIFEST = '.sync_manifest.json'
+
+
+def sha256(file_path, limit: int=None):
+    # Content hash of the file, or of its first limit bytes
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(file_path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(CHUNK if remaining is None else min(CHUNK, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+def copy_resumable(source, destination, checksum):
+    """
+    Copy a file in chunks through destination.part, verifying it on arrival.
+
+    An existing .part from an interrupted copy is continued when it is a
+    prefix of the source. The file only takes its final name once its
+    hash matches checksum.
+
+    Returns:
+    - copied: Bytes transferred by this call.
+    """
+    part = f'{destination}.part'
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    size = os.path.getsize(source)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size or (offset and sha256(part) != sha256(source, offset)):
+        offset = 0
+    with open(source, 'rb') as src, open(part, 'r+b' if offset else 'wb') as dst:
+        src.seek(offset)
+        dst.seek(offset)
+        while True:
+            block = src.read(CHUNK)
+            if not block:
+                break
+            dst.write(block)
+        dst.truncate()
+        dst.flush()
+        os.fsync(dst.fileno())
+    if sha256(part) != checksum:
+        os.remove(part)
+        raise IOError(f'Checksum mismatch copying {source}')
+    os.replace(part, destination)
+    return size - offset
+
+
+class ShotSync:
+    """
+    Incremental copy of the Shots directory to an archive directory.
+
+    A manifest in the target directory records the size, mtime and
+    sha256 of every file already synced, so only new or changed files
+    are hashed and copied. It stays out of the source, where it would be
+    listed among the shots. Files are copied with several parallel
+    streams, resumably, and verified at the destination.
+
+    Parameters:
+    - source: Shots directory (OceanHR.path_shot).
+    - target: Archive directory (network share or local stand-in).
+    - streams: Files copied at the same time.
+    - settle: Seconds a file must stay unchanged to be considered final.
+    """
+
+    def __init__(self, source: str, target: str, streams: int=4, settle: float=5):
+        self.source = source
+        self.target = target
+        self.streams = streams
+        self.settle = settle
+        self.manifest_file = os.path.join(target, MANIFEST)
+        self.manifest = {}
+        # Manifests used to be kept in the source, moved on the next save
+        self.old_manifest = os.path.join(source, MANIFEST)
+        for file in (self.manifest_file, self.old_manifest):
+            if os.path.exists(file):
+                with open(file, 'r') as f:
+                    self.manifest = json.load(f)
+                break
+
+    def files(self):
+        # Relative paths of the finalized files of the source
+        now = time.time()
+        files = []
+        for root, dirs, names in os.walk(self.source):
+            dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS]
+            for name in names:
+                if name == MANIFEST or name.endswith(EXCLUDE_SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Removed or renamed since it was listed
+                    continue
+                if now - stat.st_mtime >= self.settle:
+                    files.append((os.path.relpath(path, self.source), stat))
+        return files
+
+    def pending(self):
+        """
+        Files new or changed since they were last synced.
+
+        Returns:
+        - pending: List of (relative path, size, mtime_ns).
+        """
+        pending = []
+        for relative, stat in self.files():
+            entry = self.manifest.get(relative)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                pending.append((relative, stat.st_size, stat.st_mtime_ns))
+        return pending
+
+    def _sync_file(self, relative, size, mtime_ns):
+        source = os.path.join(self.source, relative)
+        checksum = sha256(source)
+        entry = self.manifest.get(relative)
+        destination = os.path.join(self.target, relative)
+        if entry is not None and entry['sha256'] == checksum and os.path.exists(destination):
+            # Touched but not changed
+            return relative, {**entry, 'size': size, 'mtime_ns': mtime_ns}, 0
+        copied = copy_resumable(source, destination, checksum)
+        return relative, {'size': size, 'mtime_ns': mtime_ns, 'sha256': checksum,
+                          'synced': time.time()}, copied
+
+    def sync(self):
+        """
+        Copy every pending file once.
+
+        Returns:
+        - report: Dictionary with 'files', 'bytes' copied and 'errors'.
+        """
+        pending = self.pending()
+        report = {'files': 0, 'bytes': 0, 'errors': []}
+        changed = False
+        if not pending:
+            return report
+        with ThreadPoolExecutor(max_workers=self.streams) as executor:
+            futures = {executor.submit(self._sync_file, *item): item[0] for item in pending}
+            for future, relative in futures.items():
+                try:
+                    relative, entry, copied = future.result()
+                except OSError as e:
+                    report['errors'].append(f'{relative}: {e}')
+                    continue
+                changed = changed or self.manifest.get(relative) != entry
+                self.manifest[relative] = entry
+                report['files'] += copied > 0
+                report['bytes'] += copied
+        # Rewritten only when an entry changed (copied or touched files)
+        if changed:
+            self.save_manifest()
+        return report
+
+    def save_manifest(self):
+        os.makedirs(self.target, exist_ok=True)
+        tmp = f'{self.manifest_file}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_file)
+        if os.path.exists(self.old_manifest):
+            os.remove(self.old_manifest)
+
+    def verify(self):
+        """
+        Check the archive copies against the manifest.
+
+        The bad copies are dropped from the manifest, so the next sync
+        copies them again.
+
+        Returns:
+        - bad: Relative paths missing in the target or with another hash.
+        """
+        bad = []
+        for relative, entry in self.manifest.items():
+            destination = os.path.join(self.target, relative)
+            if not os.path.exists(destination) or sha256(destination) != entry['sha256']:
+                bad.append(relative)
+        if bad:
+            for relative in bad:
+                del self.manifest[relative]
+            self.save_manifest()
+        return bad
+
+    def watch(self, interval: float=30):
+        """
+        Sync forever at idle priority, every interval seconds.
+
+        A pass that fails (e.g. the share is unreachable) is reported and
+        retried on the next one.
+        """
+        lower_priority()
+        while True:
+            try:
+                report = self.sync()
+            except OSError as e:
+                print(f'Sync failed: {e}')
+                time.sleep(interval)
+                continue
+            if report['files'] or report['errors']:
+                print(f"Synced {report['files']} files ({report['bytes']/1e6:.1f} MB)"
+                      + (f", errors: {report['errors']}" if report['errors'] else ''))
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+    # python -m src.sync <target> [--once]
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    shot_sync = ShotSync(path_shots, sys.argv[1])
+    if '--once' in sys.argv:
+        lower_priority()
+        print(shot_sync.sync())
+    else:
+        shot_sync.watch()
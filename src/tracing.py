@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from collections import deque
+from contextlib import nullcontext
+
+# Lightweight tracing of the shot lifecycle. While disabled span() only
+# checks a flag and returns a shared null context manager.
+#
+#   from src import tracing
+#   tracing.enable()
+#   with tracing.span('measure', num=750):
+#       ...
+#   tracing.dump('000123.trace.json')   # open in chrome://tracing or Perfetto
+#
+# Only the last MAX_EVENTS events (and profiler samples) are kept between dumps.
+
+MAX_EVENTS = 200000
+_enabled = False
+_memory = False
+_lock = threading.Lock()
+_events = deque(maxlen=MAX_EVENTS)
+_pending = []
+_stats = {}
+_profiler = None
+_NULL = nullcontext()
+_PID = os.getpid()
+
+
+def enable(memory: bool=False):
+    """
+    Start recording spans.
+
+    Parameters:
+    - memory: Also record the traced memory (tracemalloc) change of every
+      span, which slows down allocations while enabled.
+    """
+    global _enabled, _memory
+    _memory = memory
+    with _lock:
+        _stats.clear()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+
+def disable():
+    global _enabled, _memory
+    _enabled = False
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memory = False
+
+
+def enabled():
+    return _enabled
+
+
+def _now():
+    return time.perf_counter_ns() / 1e3
+
+
+class _Span:
+
+    __slots__ = ('name', 'args', 't0', 'mem0')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.mem0 = tracemalloc.get_traced_memory()[0] if _memory else 0
+        self.t0 = _now()
+        return self
+
+    def __exit__(self, *exc):
+        duration = _now() - self.t0
+        args = self.args
+        memory = 0
+        if _memory:
+            memory = tracemalloc.get_traced_memory()[0] - self.mem0
+            args = {**args, 'memory': memory}
+        event = {'name': self.name, 'ph': 'X', 'ts': self.t0, 'dur': duration,
+                 'pid': _PID, 'tid': threading.get_ident(), 'args': args}
+        with _lock:
+            _events.append(event)
+            stat = _stats.setdefault(self.name, {'count': 0, 'total': 0.0, 'max': 0.0, 'memory': 0})
+            stat['count'] += 1
+            stat['total'] += duration
+            stat['max'] = max(stat['max'], duration)
+            stat['memory'] += memory
+        return False
+
+
+def span(name: str, **args):
+    """
+    Context manager timing a named stage.
+
+    Parameters:
+    - name: Stage name.
+    - **args: Values shown with the span in the trace viewer.
+    """
+    if not _enabled:
+        return _NULL
+    return _Span(name, args)
+
+
+def traced(name: str=None):
+    """
+    Decorator running the function inside a span.
+    """
+    def decorator(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(label, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def counter(name: str, **values):
+    """
+    Record counter values (e.g. queue length) at this instant.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _events.append({'name': name, 'ph': 'C', 'ts': _now(), 'pid': _PID, 'args': values})
+
+
+def stats():
+    """
+    Aggregated time (us) and memory (bytes) per span name since enable().
+    """
+    with _lock:
+        return {name: {**stat, 'mean': stat['total'] / stat['count']} for name, stat in _stats.items()}
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the Python stacks of all the other threads every interval.
+
+    The samples are written with the spans, so the trace viewer shows
+    which functions were running inside every stage.
+
+    Parameters:
+    - interval: Seconds between samples.
+    """
+
+    def __init__(self, interval: float=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.running = threading.Event()
+        # Held while sampling and while trace() reads or resets the samples
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.samples = deque(maxlen=MAX_EVENTS)
+
+    def _frame_id(self, frame):
+        # Stack frames are shared between samples: (code location, parent) -> id
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        parent = None
+        for name in reversed(stack):
+            key = (name, parent)
+            if key not in self.frames:
+                self.frames[key] = len(self.frames)
+            parent = self.frames[key]
+        return parent
+
+    def run(self):
+        self.running.set()
+        own = threading.get_ident()
+        while self.running.is_set():
+            ts = _now()
+            with self.lock:
+                for tid, frame in sys._current_frames().items():
+                    if tid != own:
+                        self.samples.append({'ts': ts, 'tid': tid, 'sf': self._frame_id(frame), 'weight': 1})
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    def trace(self, reset: bool=False):
+        # Stack frames and samples so far, optionally starting over
+        with self.lock:
+            frames, samples = self.frames, self.samples
+            if reset:
+                self.frames, self.samples = {}, deque(maxlen=MAX_EVENTS)
+            else:
+                frames, samples = dict(frames), list(samples)
+        stack_frames = {}
+        for (name, parent), id in frames.items():
+            stack_frames[str(id)] = {'name': name} if parent is None else {'name': name, 'parent': str(parent)}
+        return stack_frames, [{**s, 'cpu': 0, 'sf': str(s['sf'])} for s in samples]
+
+
+def start_profiler(interval: float=0.005):
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler(interval)
+        _profiler.start()
+
+
+def stop_profiler():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+def dump(path: str, reset: bool=True):
+    """
+    Write the recorded spans (and profiler samples) as a trace file.
+
+    Parameters:
+    - path: Output json file, in the Chrome trace event format.
+    - reset: Start a new trace afterwards; stats() keeps aggregating.
+    """
+    with _lock:
+        trace = {'traceEvents': list(_events), 'displayTimeUnit': 'ms',
+                 'otherData': {'stats': {k: dict(v) for k, v in _stats.items()}}}
+        if reset:
+            _events.clear()
+    profiler = _profiler
+    if profiler is not None:
+        trace['stackFrames'], trace['samples'] = profiler.trace(reset)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(trace, f)
+    return path
+
+
+def dump_later(path: str):
+    """
+    Dump the trace to path once the enclosing request is over (dump_pending),
+    so it contains every span of the request, including its own.
+    """
+    if _enabled:
+        with _lock:
+            _pending.append(path)
+
+
+def dump_pending():
+    with _lock:
+        paths = list(_pending)
+        _pending.clear()
+    for path in paths:
+        try:
+            print(f'Trace saved to {dump(path)}')
+        except OSError as e:
+            print(f'Could not save the trace {path}: {e}')
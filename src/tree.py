@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peaks.check import device_time
+
+# Local store of the OHR_Spectro node tree, one directory per shot:
+#   Tree/<shot>/numeric.npz         every numeric node, written together
+#   Tree/<shot>/<node>.npy          data of every signal node (frames, pixels)
+#   Tree/<shot>/<node>.time.npy     its time dimension
+#   Tree/<shot>/<node>.wave.npy     its wavelength dimension
+#   Tree/<shot>/tree.json           node index, written last: a shot without it is incomplete
+# Signal files are standard .npy files, so a single node can be memory mapped.
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'OHR_Spectro.json')
+NODE_TYPES = ('numeric', 'signal')
+
+
+def load_schema(path: str=SCHEMA):
+    """
+    Node tree expected by the facility database.
+
+    Returns:
+    - schema: Dictionary spectrometer node -> {node: type}.
+    """
+    with open(path, 'r') as f:
+        schema = json.load(f)
+    for spectrometer, nodes in schema.items():
+        for node, kind in nodes.items():
+            if kind not in NODE_TYPES:
+                raise ValueError(f'Unknown type {kind} of node {spectrometer}.{node}')
+    return schema
+
+
+def device_nodes(data, schema):
+    # Spectrometer nodes in schema order against the devices sorted by id
+    devices = sorted(data['spectra'], key=int)
+    if len(devices) > len(schema):
+        raise ValueError(f'{len(devices)} devices but only {len(schema)} spectrometers in the schema')
+    return dict(zip(schema, devices))
+
+
+def numeric_value(data, device, node):
+    metadata = data.get('metadata', {})
+    match node:
+        case 'integration_time':
+            return np.array(metadata.get('integration_time', np.nan), dtype=float)
+        case 'average':
+            return np.array(metadata.get('average', 1), dtype=float)
+        case 'calibration':
+            return np.asarray(data.get('waves', {}).get(device, data['wave']), dtype=float)
+    raise ValueError(f'No value for numeric node {node}')
+
+
+def write_signal(folder, name, spectra, time_array, wave, chunk: int=256):
+    """
+    Stream a signal node to disk chunk by chunk.
+
+    Parameters:
+    - folder: Shot directory.
+    - name: Node path, e.g. 'OceanHR1.spectra'.
+    - spectra: Sequence of frames (array or list of lists).
+    - time_array, wave: Dimensions of the signal.
+    - chunk: Frames converted and written at a time.
+
+    Returns:
+    - entry: Index entry of the node.
+    """
+    n_frames, n_pixels = len(spectra), len(wave)
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype('<f8')), 'fortran_order': False,
+              'shape': (n_frames, n_pixels)}
+    with open(os.path.join(folder, f'{name}.npy'), 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        for start in range(0, n_frames, chunk):
+            f.write(np.ascontiguousarray(spectra[start:start + chunk], dtype='<f8').tobytes())
+    np.save(os.path.join(folder, f'{name}.time.npy'), np.asarray(time_array, dtype='<f8'))
+    np.save(os.path.join(folder, f'{name}.wave.npy'), np.asarray(wave, dtype='<f8'))
+    return {'type': 'signal', 'shape': [n_frames, n_pixels], 'dtype': '<f8'}
+
+
+def write_tree(data, shot, path_tree, schema=None, workers: int=4, chunk: int=256):
+    """
+    Write a shot in the OHR_Spectro tree layout.
+
+    The numeric nodes of all spectrometers are batched into one file and
+    the signal nodes are written concurrently, chunk by chunk.
+
+    Parameters:
+    - data: Shot dictionary as returned by load_shot.
+    - shot: Shot number.
+    - path_tree: Root directory of the tree store.
+    - schema: Dictionary from load_schema; OHR_Spectro.json if None.
+    - workers: Signal nodes written at the same time.
+    - chunk: Frames per write of a signal node.
+
+    Returns:
+    - folder: Directory of the shot.
+    """
+    schema = load_schema() if schema is None else schema
+    folder = os.path.join(path_tree, str(shot))
+    tmp = f'{folder}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    try:
+        index, numeric, signals = {}, {}, []
+        for spectrometer, device in device_nodes(data, schema).items():
+            for node, kind in schema[spectrometer].items():
+                name = f'{spectrometer}.{node}'
+                if kind == 'numeric':
+                    numeric[name] = numeric_value(data, device, node)
+                    index[name] = {'type': 'numeric', 'shape': list(numeric[name].shape), 'dtype': '<f8'}
+                else:
+                    wave = numeric_value(data, device, 'calibration')
+                    signals.append((name, data['spectra'][device], device_time(data, device), wave))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {name: executor.submit(write_signal, tmp, name, spectra, time_array, wave, chunk)
+                       for name, spectra, time_array, wave in signals}
+            np.savez(os.path.join(tmp, 'numeric.npz'), **numeric)
+            for name, future in futures.items():
+                index[name] = future.result()
+
+        index = {'shot': str(shot), 'devices': device_nodes(data, schema), 'nodes': index}
+        with open(os.path.join(tmp, 'tree.json'), 'w') as f:
+            json.dump(index, f, indent=4)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(tmp, folder)
+    except BaseException:
+        # Nothing half written is left next to the shots
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return folder
+
+
+class Signal:
+    """
+    Signal node opened lazily: data is memory mapped, dimensions are
+    read on first use.
+    """
+
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(os.path.join(self.folder, f'{self.name}.npy'), mmap_mode='r')
+        return self._data
+
+    @property
+    def time(self):
+        return np.load(os.path.join(self.folder, f'{self.name}.time.npy'))
+
+    @property
+    def wave(self):
+        return np.load(os.path.join(self.folder, f'{self.name}.wave.npy'))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return np.asarray(self.data[index])
+
+
+class TreeShot:
+    """
+    Read access to one shot of the tree store without loading it whole.
+
+    Parameters:
+    - path_tree: Root directory of the tree store.
+    - shot: Shot number.
+    """
+
+    def __init__(self, path_tree, shot):
+        self.folder = os.path.join(path_tree, str(shot))
+        index_file = os.path.join(self.folder, 'tree.json')
+        if not os.path.exists(index_file):
+            raise FileNotFoundError(f'Shot {shot} is not in the tree {path_tree}')
+        with open(index_file, 'r') as f:
+            self.index = json.load(f)
+        self._numeric = None
+
+    def nodes(self):
+        return list(self.index['nodes'])
+
+    def node(self, name):
+        """
+        Value of a node: an array for numeric nodes, a Signal otherwise.
+        """
+        entry = self.index['nodes'].get(name)
+        if entry is None:
+            raise KeyError(f'No node {name}')
+        if entry['type'] == 'signal':
+            return Signal(self.folder, name)
+        if self._numeric is None:
+            # NpzFile reads every member only when it is accessed
+            self._numeric = np.load(os.path.join(self.folder, 'numeric.npz'))
+        return self._numeric[name]
+
+    __getitem__ = node
+
+    def close(self):
+        if self._numeric is not None:
+            self._numeric.close()
+
+
+def convert_shots(shot_numbers, path_shots, path_tree, schema=None, **kwargs):
+    """
+    Write saved json shots into the tree store, skipping the ones already there.
+    """
+    from plots.aniplot import load_shot
+
+    schema = load_schema() if schema is None else schema
+    written = []
+    for shot in shot_numbers:
+        if os.path.exists(os.path.join(path_tree, str(shot), 'tree.json')):
+            continue
+        try:
+            write_tree(load_shot(shot, path_shots), shot, path_tree, schema, **kwargs)
+            written.append(shot)
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Error writing shot {shot} to the tree: {e}')
+    return written
+
+
+if __name__ == "__main__":
+    path_spectrometer = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    path_shots = os.path.join(path_spectrometer, 'Shots')
+    path_tree = os.path.join(path_spectrometer, 'Tree')
+    shots = sorted(f[:-5] for f in os.listdir(path_shots) if f.endswith('.json'))
+    print(f'Written {len(convert_shots(shots, path_shots, path_tree))} shots to {path_tree}')